@@ -0,0 +1,482 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Local HTTP API with push of pullup events for Home Assistant.
+# An asyncio server on a background thread exposes the count, time stamps and
+# settings over REST, pushes pullup events and setting changes over Server-Sent
+# Events and WebSocket, and accepts setting changes and counter reset directly.
+# The legacy txt files in data/ are still written for backward compatibility.
+# Endpoints:
+# GET  /api/state     count, time stamps, settings and activity
+# GET  /api/settings  settings
+# POST /api/settings  change settings, json {"sonosRoom": "Koket", "sonosVolume": 30, ...}
+# POST /api/reset     reset the pullup counter, in multi-stream mode of the stream given as ?stream=<name> or json {"stream": "<name>"}
+# GET  /api/history   daily and weekly totals and newest sessions from the pullup history
+# GET  /api/events    Server-Sent Events stream
+# GET  /api/ws        WebSocket stream, accepts the same json as POST /api/settings
+# If data.apiToken is set, POST requests and settings sent over WebSocket need the header
+# "Authorization: Bearer <token>" or "X-Api-Token: <token>".
+# *********************************************************************************
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import struct
+import threading
+import time
+from urllib.parse import parse_qs
+# Load modules
+from commonConfig import commonConfigClass
+from repHistory import getDailyTotals, getWeeklyTotals, getSessions
+conf = commonConfigClass()
+
+# Settings that can be changed through the API, pullupCounts is changed with reset only
+apiSettingKeys = ['soundStatus', 'soundTheme', 'sonosRoom', 'sonosVolume', 'operationMode']
+# Magic string of the WebSocket handshake, RFC 6455
+webSocketGuid = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class apiServerClass:
+    """
+    Class describing the API server.
+    Runs its own event loop on a daemon thread, messages are published from any thread.
+    """
+
+    def __init__ (self, supportMethods, host=None, port=None):
+        """
+        Init function
+
+        supportMethods: supportMethodsClass
+            Support methods holding the control state and pullup state
+        host: string
+            Host to listen on, from config if not given
+        port: int
+            Port to listen on, from config if not given
+        """
+        self.supportMethods = supportMethods
+        self.host = conf.data.apiHost if host is None else host
+        self.port = conf.data.apiPort if port is None else port
+        self.loop = None
+        self.server = None
+        self.thread = None
+        # Queue of every connected push client
+        self.clientQueues = set()
+        # Functions returning extra values for /api/state, for example the activity state
+        self.stateProviders = {}
+        # Streams by name in multi-stream mode, None in single stream mode
+        self.streams = None
+        self.counters = {'requests': 0, 'clients': 0, 'published': 0, 'dropped': 0}
+        # Push setting changes made from Home Assistant files or from the API
+        for key in apiSettingKeys:
+            self.supportMethods.controlState.registerCallback(key, self.onSettingChanged)
+
+
+    def start(self):
+        """
+        This function starts the event loop thread and the server
+        """
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.worker, args=(started,), name='pullupApiServer', daemon=True)
+        self.thread.start()
+        started.wait(5.0)
+
+
+    def stop(self):
+        """
+        This function stops the server and the event loop
+        """
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join(5.0)
+            self.thread = None
+
+
+    def worker(self, started):
+        """
+        This function runs the event loop until stopped
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.handleConnection, self.host, self.port))
+            print('API served on http://' + self.host + ':' + str(self.port) + '/api/state')
+        except OSError as e:
+            print('Failed to start API server')
+            print(e)
+            self.loop.close()
+            self.loop = None
+            started.set()
+            return
+        started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            # Let open push connections finish before the loop is closed
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+
+    def registerStateProvider(self, name, function):
+        """
+        This function adds a value returned by function to /api/state
+        """
+        self.stateProviders[name] = function
+
+
+    def registerStreams(self, streams):
+        """
+        This function switches to multi-stream mode. Reset and /api/state then use the counters of the streams,
+        the single stream counter is not counted in this mode.
+
+        streams: list
+            Streams of type pullupStreamClass
+        """
+        self.streams = {stream.name: stream for stream in streams}
+        # Count, time stamps and activity of every stream in /api/state
+        self.registerStateProvider('streams', lambda: {stream.name: dict(stream.statePersistence.get(), activity=stream.motionGate.state) for stream in streams})
+
+
+    def getSettings(self):
+        """
+        This function returns the current settings held by the control state
+        """
+        return {key: self.supportMethods.controlState.get(key) for key in apiSettingKeys}
+
+
+    def getState(self):
+        """
+        This function returns the pullup state, settings and values of the state providers.
+        In multi-stream mode the counts are only given per stream.
+        """
+        state = self.supportMethods.statePersistence.get() if self.streams is None else {}
+        state['settings'] = self.getSettings()
+        for name, function in self.stateProviders.items():
+            state[name] = function()
+        return state
+
+
+    def getHistory(self):
+        """
+        This function returns the daily and weekly totals and the newest sessions of the pullup history
+        """
+        if self.supportMethods.repHistory is None:
+            return {'days': [], 'weeks': [], 'sessions': []}
+        databaseFilePath = self.supportMethods.repHistory.databaseFilePath
+        return {'days': getDailyTotals(7, databaseFilePath=databaseFilePath),
+                'weeks': getWeeklyTotals(4, databaseFilePath=databaseFilePath),
+                'sessions': getSessions(10, databaseFilePath=databaseFilePath)}
+
+
+    def applySettings(self, values):
+        """
+        This function changes settings, raises ValueError for unknown keys and invalid values.
+        All values are validated before any is written, so an invalid request changes nothing.
+        Writes setting files, run it in an executor and not in the event loop.
+
+        values: dict
+            Setting key and new value
+        """
+        if not isinstance(values, dict):
+            raise ValueError('Settings must be a json object')
+        for key, value in values.items():
+            if key not in apiSettingKeys:
+                raise ValueError('Unknown setting ' + str(key))
+            try:
+                self.supportMethods.controlState.validate(key, value)
+            except (ValueError, AssertionError, TypeError) as e:
+                raise ValueError('Invalid value for setting ' + key + ': ' + str(e))
+        for key, value in values.items():
+            self.supportMethods.controlState.set(key, value)
+        return self.getSettings()
+
+
+    def resetPullupCounts(self, streamName=None):
+        """
+        This function resets the pullup counter, the counter of the named stream in multi-stream mode.
+        Raises ValueError if the stream name is missing or unknown. Writes files, run it in an executor.
+
+        streamName: string
+            Name of the stream, required in multi-stream mode
+        """
+        if self.streams is None:
+            if streamName is not None:
+                raise ValueError('No streams in single stream mode')
+            self.supportMethods.resetPullupCounts()
+            return
+        if streamName is None:
+            raise ValueError('Stream name required in multi-stream mode, one of ' + ', '.join(sorted(self.streams)))
+        if streamName not in self.streams:
+            raise ValueError('Unknown stream ' + str(streamName))
+        print('Pullup counter of stream ' + streamName + ' reset from API')
+        self.streams[streamName].statePersistence.reset()
+
+
+    def isAuthorized(self, headers):
+        """
+        This function checks the shared token of a request, always True if no token is configured
+        """
+        if conf.data.apiToken is None:
+            return True
+        token = headers.get('x-api-token')
+        authorization = headers.get('authorization', '')
+        if authorization.lower().startswith('bearer '):
+            token = authorization[len('bearer '):].strip()
+        return token is not None and hmac.compare_digest(token.encode('utf-8'), str(conf.data.apiToken).encode('utf-8'))
+
+
+    def onSettingChanged(self, key, oldValue, newValue):
+        """
+        This function pushes a changed setting to the clients
+        """
+        self.publish({'type': 'setting', 'key': key, 'value': newValue})
+
+
+    def publish(self, message):
+        """
+        This function pushes a message to all connected clients. Can be called from any thread.
+        Slow clients lose the oldest messages instead of blocking the publisher.
+
+        message: dict
+            Message sent as json
+        """
+        if self.loop is None:
+            return
+        message = dict(message)
+        message.setdefault('time', time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+        text = json.dumps(message, default=str)
+        try:
+            self.loop.call_soon_threadsafe(self.putMessage, text)
+        except RuntimeError:
+            # Event loop has been closed
+            pass
+
+
+    def putMessage(self, text):
+        """
+        This function puts a message on the queue of every client, run in the event loop
+        """
+        self.counters['published'] += 1
+        for clientQueue in self.clientQueues:
+            if clientQueue.full():
+                clientQueue.get_nowait()
+                self.counters['dropped'] += 1
+            clientQueue.put_nowait(text)
+
+
+    async def handleConnection(self, reader, writer):
+        """
+        This function handles one HTTP connection
+        """
+        try:
+            requestLine = (await reader.readline()).decode('latin-1').strip()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            parts = requestLine.split()
+            if len(parts) < 2:
+                return
+            method = parts[0]
+            path, _, query = parts[1].partition('?')
+            self.counters['requests'] += 1
+            try:
+                contentLength = int(headers.get('content-length', 0))
+            except ValueError:
+                contentLength = -1
+            if contentLength < 0:
+                await self.sendJson(writer, 400, {'error': 'Invalid Content-Length'})
+                return
+            if contentLength > conf.data.apiMaxBodyBytes:
+                await self.sendJson(writer, 413, {'error': 'Request body larger than ' + str(conf.data.apiMaxBodyBytes) + ' bytes'})
+                return
+            body = await reader.readexactly(contentLength) if contentLength > 0 else b''
+            authorized = self.isAuthorized(headers)
+            if method == 'GET' and path == '/api/events':
+                await self.streamEvents(writer)
+            elif method == 'GET' and path == '/api/ws':
+                await self.streamWebSocket(reader, writer, headers, authorized)
+            else:
+                status, response = await self.handleRequest(method, path, body, authorized, query)
+                await self.sendJson(writer, status, response)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Server is stopping
+            pass
+        except Exception as e:
+            print('Failed to handle API request')
+            print(e)
+        finally:
+            writer.close()
+
+
+    async def handleRequest(self, method, path, body, authorized, query=''):
+        """
+        This function answers the REST requests, returns tuple (status, response).
+        File and database access is run in the default executor so the event loop keeps serving push clients.
+        """
+        if method == 'POST' and not authorized:
+            return 401, {'error': 'Missing or wrong API token'}
+        if method == 'GET' and path == '/api/state':
+            return 200, self.getState()
+        if method == 'GET' and path == '/api/settings':
+            return 200, self.getSettings()
+        if method == 'POST' and path == '/api/settings':
+            try:
+                return 200, await self.loop.run_in_executor(None, self.applySettings, json.loads(body or b'{}'))
+            except ValueError as e:
+                return 400, {'error': str(e)}
+        if method == 'GET' and path == '/api/history':
+            return 200, await self.loop.run_in_executor(None, self.getHistory)
+        if method == 'POST' and path == '/api/reset':
+            try:
+                values = json.loads(body or b'{}')
+                if not isinstance(values, dict):
+                    raise ValueError('Reset must be a json object')
+                streamName = parse_qs(query).get('stream', [values.get('stream')])[0]
+                await self.loop.run_in_executor(None, self.resetPullupCounts, streamName)
+            except ValueError as e:
+                return 400, {'error': str(e)}
+            return 200, self.getState()
+        return 404, {'error': 'Not found'}
+
+
+    async def sendJson(self, writer, status, response):
+        """
+        This function writes a json response and closes the connection
+        """
+        body = json.dumps(response, default=str).encode('utf-8')
+        reasons = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 413: 'Payload Too Large'}
+        header = 'HTTP/1.1 ' + str(status) + ' ' + reasons.get(status, '') + '\r\nContent-Type: application/json\r\nContent-Length: ' + str(len(body)) + '\r\nConnection: close\r\n\r\n'
+        writer.write(header.encode('latin-1') + body)
+        await writer.drain()
+
+
+    def addClient(self):
+        """
+        This function creates the message queue of a new push client, starting with the current state
+        """
+        clientQueue = asyncio.Queue(maxsize=conf.data.apiClientQueueSize)
+        clientQueue.put_nowait(json.dumps(dict(self.getState(), type='state'), default=str))
+        self.clientQueues.add(clientQueue)
+        self.counters['clients'] += 1
+        return clientQueue
+
+
+    async def streamEvents(self, writer):
+        """
+        This function pushes messages as Server-Sent Events until the client disconnects
+        """
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n')
+        clientQueue = self.addClient()
+        try:
+            while True:
+                try:
+                    text = await asyncio.wait_for(clientQueue.get(), conf.data.apiKeepAliveSeconds)
+                    writer.write(b'data: ' + text.encode('utf-8') + b'\n\n')
+                except asyncio.TimeoutError:
+                    # Comment line keeps proxies from closing an idle connection
+                    writer.write(b': keepalive\n\n')
+                await writer.drain()
+        finally:
+            self.clientQueues.discard(clientQueue)
+
+
+    def encodeWebSocketFrame(self, payload, opcode=1):
+        """
+        This function returns an unmasked WebSocket frame, server frames are never masked
+        """
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        return header + payload
+
+
+    async def readWebSocketFrame(self, reader):
+        """
+        This function reads one WebSocket frame from the client, returns tuple (opcode, payload).
+        Raises ValueError for frames larger than data.apiMaxBodyBytes, before the payload is read.
+        """
+        first, second = struct.unpack('!BB', await reader.readexactly(2))
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', await reader.readexactly(8))[0]
+        if length > conf.data.apiMaxBodyBytes:
+            raise ValueError('WebSocket frame larger than ' + str(conf.data.apiMaxBodyBytes) + ' bytes')
+        mask = await reader.readexactly(4) if second & 0x80 else None
+        payload = await reader.readexactly(length)
+        if mask is not None:
+            payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+        return first & 0x0F, payload
+
+
+    async def streamWebSocket(self, reader, writer, headers, authorized):
+        """
+        This function pushes messages over a WebSocket until the client disconnects.
+        Text frames from the client are applied as settings if the upgrade request was authorized.
+        Oversized frames close the connection with status 1009.
+        """
+        key = headers.get('sec-websocket-key')
+        if key is None or 'websocket' not in headers.get('upgrade', '').lower():
+            await self.sendJson(writer, 400, {'error': 'WebSocket upgrade expected'})
+            return
+        accept = base64.b64encode(hashlib.sha1((key + webSocketGuid).encode('latin-1')).digest()).decode('latin-1')
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+        clientQueue = self.addClient()
+        readTask = asyncio.ensure_future(self.readWebSocketFrame(reader))
+        try:
+            while True:
+                getTask = asyncio.ensure_future(clientQueue.get())
+                done, pending = await asyncio.wait([readTask, getTask], timeout=conf.data.apiKeepAliveSeconds, return_when=asyncio.FIRST_COMPLETED)
+                if getTask in done:
+                    writer.write(self.encodeWebSocketFrame(getTask.result().encode('utf-8')))
+                else:
+                    getTask.cancel()
+                if readTask in done:
+                    try:
+                        opcode, payload = readTask.result()
+                    except ValueError:
+                        # Frame too large, close with status 1009 without reading it
+                        writer.write(self.encodeWebSocketFrame(struct.pack('!H', 1009), 8))
+                        await writer.drain()
+                        return
+                    if opcode == 8:
+                        writer.write(self.encodeWebSocketFrame(b'', 8))
+                        await writer.drain()
+                        return
+                    if opcode == 9:
+                        writer.write(self.encodeWebSocketFrame(payload, 10))
+                    if opcode == 1 and not authorized:
+                        response = {'type': 'error', 'error': 'Missing or wrong API token'}
+                        writer.write(self.encodeWebSocketFrame(json.dumps(response).encode('utf-8')))
+                    elif opcode == 1:
+                        try:
+                            settings = await self.loop.run_in_executor(None, self.applySettings, json.loads(payload))
+                            response = {'type': 'settings', 'settings': settings}
+                        except ValueError as e:
+                            response = {'type': 'error', 'error': str(e)}
+                        writer.write(self.encodeWebSocketFrame(json.dumps(response, default=str).encode('utf-8')))
+                    readTask = asyncio.ensure_future(self.readWebSocketFrame(reader))
+                if not done:
+                    # Ping keeps proxies from closing an idle connection
+                    writer.write(self.encodeWebSocketFrame(b'', 9))
+                await writer.drain()
+        finally:
+            readTask.cancel()
+            self.clientQueues.discard(clientQueue)
@@ -0,0 +1,187 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Tracking of the athlete among several detected persons.
+# Detected persons are associated across frames by box overlap (IoU), with box
+# center distance as fallback. The tracker locks onto the person under the bar
+# and reorders the pose so the athlete is always index 0, the person used by the
+# counter, region of interest and keypoint store. A spotter or passer-by can
+# therefore not take over or break the count.
+# *********************************************************************************
+import numpy as np
+# Load modules
+from commonConfig import commonConfigClass
+conf = commonConfigClass()
+
+# COCO keypoint indices of shoulders and wrists, used to find the person hanging from the bar
+shoulderIndices = [5, 6]
+wristIndices = [9, 10]
+
+
+def getIou(boxes, otherBoxes):
+    """
+    This function returns the intersection over union of every pair of boxes.
+
+    boxes: numpy array (N, 4)
+        Boxes x1, y1, x2, y2
+    otherBoxes: numpy array (M, 4)
+        Boxes x1, y1, x2, y2
+
+    Returns numpy array (N, M)
+    """
+    topLeft = np.maximum(boxes[:, None, :2], otherBoxes[None, :, :2])
+    bottomRight = np.minimum(boxes[:, None, 2:], otherBoxes[None, :, 2:])
+    intersection = np.prod(np.clip(bottomRight - topLeft, 0, None), axis=2)
+    areas = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    otherAreas = np.prod(otherBoxes[:, 2:] - otherBoxes[:, :2], axis=1)
+    union = areas[:, None] + otherAreas[None, :] - intersection
+    return intersection / np.maximum(union, 1e-6)
+
+
+def selectPersons(pose, order):
+    """
+    This function returns the pose with the persons in the given order, an empty list gives an empty pose
+
+    pose: dict
+        Full frame pose from getFullFramePose
+    order: list
+        Person indices to keep
+    """
+    order = np.asarray(order, dtype=np.int64)
+    return {key: value[order] for key, value in pose.items()}
+
+
+class athleteTrackerClass:
+    """
+    Class describing the tracker of detected persons and the lock on the athlete.
+    The number of persons is small, so association is done greedily on the IoU matrix.
+    """
+
+    def __init__ (self, barRelativeHight=None):
+        """
+        Init function
+
+        barRelativeHight: float
+            Relative height of the bar in the image, from config if not given
+        """
+        self.barRelativeHight = conf.data.barRelativeHight if barRelativeHight is None else barRelativeHight
+        self.nextTrackId = 0
+        self.counters = {'frames': 0, 'locks': 0, 'athleteMissed': 0, 'reordered': 0}
+        self.reset()
+
+
+    def reset(self):
+        """
+        This function removes all tracks and the lock, the athlete is searched for again
+        """
+        # Tracks with id, box in full frame pixels and number of frames missed
+        self.tracks = []
+        self.athleteTrackId = None
+
+
+    def associate(self, boxes):
+        """
+        This function matches detected boxes to tracks. Returns a list with the track index of every box, None if new.
+        Pairs are taken in order of highest IoU, boxes without overlap are matched by center distance.
+        """
+        matches = [None] * len(boxes)
+        if len(self.tracks) == 0 or len(boxes) == 0:
+            return matches
+        trackBoxes = np.array([track['box'] for track in self.tracks], dtype=np.float32)
+        iou = getIou(boxes, trackBoxes)
+        # Center distance relative to the diagonal of the track box
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        trackCenters = (trackBoxes[:, :2] + trackBoxes[:, 2:]) / 2
+        trackDiagonals = np.maximum(np.linalg.norm(trackBoxes[:, 2:] - trackBoxes[:, :2], axis=1), 1e-6)
+        distance = np.linalg.norm(centers[:, None, :] - trackCenters[None, :, :], axis=2) / trackDiagonals[None, :]
+        # Higher is better, overlapping pairs always before pairs matched on distance
+        score = np.where(iou >= conf.data.trackIouThreshold, 1.0 + iou, np.where(distance <= conf.data.trackMaxCentroidDistance, 1.0 - distance, 0.0))
+        for _ in range(min(len(boxes), len(self.tracks))):
+            boxIndex, trackIndex = np.unravel_index(np.argmax(score), score.shape)
+            if score[boxIndex, trackIndex] <= 0.0:
+                break
+            matches[boxIndex] = trackIndex
+            score[boxIndex, :] = 0.0
+            score[:, trackIndex] = 0.0
+        return matches
+
+
+    def getAthleteScore(self, pose, personIndex, fullHeight):
+        """
+        This function returns how likely a person is the athlete, 0 if the person does not reach the bar.
+        A person reaching up to the bar gets a higher score if hanging (wrists above shoulders), confident and large.
+        """
+        x1, y1, x2, y2 = pose['boxes'][personIndex]
+        # Top of the box must be near or above the bar and the bottom below it
+        if y1 / fullHeight > self.barRelativeHight + conf.data.trackBarMargin or y2 / fullHeight < self.barRelativeHight:
+            return 0.0
+        score = 1.0 + float(pose['boxConf'][personIndex])
+        keypointsXyn = pose['keypointsXyn'][personIndex]
+        keypointsConf = pose['keypointsConf'][personIndex]
+        shouldersConfident = keypointsConf[shoulderIndices] > conf.data.noseConfidenceThreshold
+        wristsConfident = keypointsConf[wristIndices] > conf.data.noseConfidenceThreshold
+        if shouldersConfident.any() and wristsConfident.any():
+            if keypointsXyn[wristIndices, 1][wristsConfident].mean() < keypointsXyn[shoulderIndices, 1][shouldersConfident].mean():
+                score += 1.0
+        # Larger persons are closer to the camera, limited so it only breaks ties
+        score += min(1.0, (y2 - y1) / fullHeight)
+        return score
+
+
+    def update(self, pose, fullShape):
+        """
+        This function updates the tracks with the persons of a frame and returns the pose with the athlete as index 0.
+        Other persons follow after the athlete. While locked, an empty pose is returned if the athlete is not detected,
+        so nobody else is counted. Before the lock the pose is returned unchanged.
+
+        pose: dict
+            Full frame pose from getFullFramePose
+        fullShape: tuple
+            Shape (height, width) of the full frame
+        """
+        if not conf.data.athleteTrackingEnabled:
+            return pose
+        self.counters['frames'] += 1
+        boxes = pose['boxes']
+        if len(boxes) != len(pose['keypointsXyn']):
+            # Boxes and keypoints do not belong together, nothing to track
+            return pose
+        confident = pose['boxConf'] >= conf.data.roiBoxConfidenceThreshold
+        matches = self.associate(boxes[confident])
+        personIndices = np.flatnonzero(confident)
+        # Track id of every detected person, None if not confident
+        personTrackIds = [None] * len(boxes)
+        matchedTracks = set()
+        for personIndex, trackIndex in zip(personIndices, matches):
+            if trackIndex is None:
+                track = {'id': self.nextTrackId, 'box': None, 'missed': 0}
+                self.nextTrackId += 1
+                self.tracks.append(track)
+            else:
+                track = self.tracks[trackIndex]
+            track['box'] = tuple(float(value) for value in boxes[personIndex])
+            track['missed'] = 0
+            matchedTracks.add(track['id'])
+            personTrackIds[personIndex] = track['id']
+        # Tracks not seen for a while are removed
+        for track in self.tracks:
+            if track['id'] not in matchedTracks:
+                track['missed'] += 1
+        self.tracks = [track for track in self.tracks if track['missed'] <= conf.data.trackMaxMissedFrames]
+        if self.athleteTrackId is not None and all(track['id'] != self.athleteTrackId for track in self.tracks):
+            # Athlete has left, lock onto the next person under the bar
+            self.athleteTrackId = None
+        if self.athleteTrackId is None:
+            scores = [self.getAthleteScore(pose, personIndex, fullShape[0]) if personTrackIds[personIndex] is not None else 0.0 for personIndex in range(len(boxes))]
+            if len(scores) == 0 or max(scores) <= 0.0:
+                # Nobody at the bar yet, counted as before from the first person
+                return pose
+            self.athleteTrackId = personTrackIds[int(np.argmax(scores))]
+            self.counters['locks'] += 1
+        if self.athleteTrackId not in personTrackIds:
+            # Athlete is missed in this frame, other persons must not be counted
+            self.counters['athleteMissed'] += 1
+            return selectPersons(pose, [])
+        athleteIndex = personTrackIds.index(self.athleteTrackId)
+        if athleteIndex != 0:
+            self.counters['reordered'] += 1
+        return selectPersons(pose, [athleteIndex] + [personIndex for personIndex in range(len(boxes)) if personIndex != athleteIndex])
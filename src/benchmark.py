@@ -0,0 +1,335 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Offline replay and benchmark of the counting pipeline.
+# Replays a recorded video through region of interest, inference and counting,
+# or replays saved keypoint txt files through counting only. Reports fps,
+# latency percentiles per stage, memory and counted pullups vs ground truth.
+# Usage:
+# python benchmark.py --video data/pullupSave/video_20240101_120000.avi --truth truth.txt
+# python benchmark.py --labels data/pullupSave/labels --truth 12
+# python benchmark.py --synthetic --fps 5
+# *********************************************************************************
+import argparse
+import json
+import os
+import time
+import numpy as np
+# resource is not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+# Load modules
+from commonConfig import commonConfigClass
+from keypointFiles import readKeypointTxt, listKeypointTxtFiles
+from repCounter import repDetectorClass
+conf = commonConfigClass()
+
+
+class benchmarkClass:
+    """
+    Class describing a benchmark run, collecting latency per stage and counted pullups.
+    """
+
+    def __init__ (self):
+        """
+        Init function
+        """
+        # Latency in milliseconds for every call of every stage
+        self.stageLatencies = {}
+        # Frame index of every counted pullup
+        self.pullupFrames = []
+        self.framesRead = 0
+        self.framesProcessed = 0
+        self.startTime = None
+        self.endTime = None
+        # Same pullup detector as the live counter
+        self.repDetector = repDetectorClass()
+
+
+    def recordStage(self, stageName, elapsedMs):
+        """
+        This function stores the latency of a stage
+        """
+        self.stageLatencies.setdefault(stageName, []).append(elapsedMs)
+
+
+    def countPose(self, pose, frameIndex, timestamp):
+        """
+        This function runs the counting logic on a pose and stores counted pullups.
+        """
+        countStart = time.perf_counter()
+        repEvent = self.repDetector.update(pose, timestamp, frameIndex)
+        self.recordStage('counting', (time.perf_counter() - countStart) * 1000)
+        if repEvent is not None:
+            self.pullupFrames.append(frameIndex)
+
+
+    def runVideo(self, videoFilePath, stride=1, useRoi=True):
+        """
+        This function replays a video file through region of interest, inference and counting.
+        Every frame is read, every stride frame is inferred.
+
+        videoFilePath: string
+            Path of the video file
+        stride: int
+            Infer every stride frame
+        useRoi: bool
+            Crop region of interest around the athlete as in the live counter
+        """
+        import cv2
+        from modelBackend import loadPoseModel, measureModelLatency
+        from roiTracker import roiTrackerClass, getFullFramePose, getInferenceSize
+        from athleteTracker import athleteTrackerClass
+        model, backend = loadPoseModel()
+        # Warm up so first inference is not part of the results
+        measureModelLatency(model, backend)
+        conf.data.roiEnabled = useRoi
+        roiTracker = roiTrackerClass()
+        athleteTracker = athleteTrackerClass()
+        capture = cv2.VideoCapture(videoFilePath)
+        assert capture.isOpened(), 'The video file could not be opened'
+        # Frame time is taken from the video frame rate
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        self.startTime = time.perf_counter()
+        while True:
+            decodeStart = time.perf_counter()
+            ok, frame = capture.read()
+            if not ok:
+                break
+            self.recordStage('decode', (time.perf_counter() - decodeStart) * 1000)
+            self.framesRead += 1
+            frameIndex = self.framesRead
+            if (frameIndex - 1) % stride != 0:
+                continue
+            stageStart = time.perf_counter()
+            region, offset = roiTracker.getCrop(frame)
+            self.recordStage('roi', (time.perf_counter() - stageStart) * 1000)
+            stageStart = time.perf_counter()
+            r = model(region, device="CPU", imgsz=getInferenceSize(region), verbose=False)[0]
+            self.recordStage('model', (time.perf_counter() - stageStart) * 1000)
+            # Split of model time reported by YOLO
+            for speedName, speedMs in r.speed.items():
+                if speedMs is not None:
+                    self.recordStage('model.' + speedName, speedMs)
+            stageStart = time.perf_counter()
+            pose = getFullFramePose(r, offset, frame.shape)
+            self.recordStage('pose', (time.perf_counter() - stageStart) * 1000)
+            stageStart = time.perf_counter()
+            pose = athleteTracker.update(pose, frame.shape)
+            self.recordStage('tracking', (time.perf_counter() - stageStart) * 1000)
+            stageStart = time.perf_counter()
+            roiTracker.update(pose)
+            self.recordStage('roiUpdate', (time.perf_counter() - stageStart) * 1000)
+            self.countPose(pose, frameIndex, frameIndex / fps)
+            self.framesProcessed += 1
+        self.endTime = time.perf_counter()
+        capture.release()
+
+
+    def runLabels(self, labelsFolderPath, fps=25.0):
+        """
+        This function replays saved keypoint txt files through the counting logic only.
+
+        labelsFolderPath: string
+            Folder with txt files named <video>_<frameIndex>.txt
+        fps: float
+            Frame rate of the stream the files were saved from, used for frame time
+        """
+        keypointFiles = listKeypointTxtFiles(labelsFolderPath)
+        self.startTime = time.perf_counter()
+        for frameIndex, filePath in keypointFiles:
+            stageStart = time.perf_counter()
+            pose = readKeypointTxt(filePath)
+            self.recordStage('read', (time.perf_counter() - stageStart) * 1000)
+            self.framesRead += 1
+            self.countPose(pose, frameIndex, frameIndex / fps)
+            self.framesProcessed += 1
+        self.endTime = time.perf_counter()
+
+
+    def runSynthetic(self, peakOffsets, fps=25.0, repSeconds=2.0):
+        """
+        This function replays synthetic pullups through the counting logic only, to check counting near the bar.
+        Every pullup is a cosine from hanging down to a peak at the bar plus an offset, negative offsets are above the bar.
+        Returns the frame indices of the pullups that should be counted, the first sampled frame above the bar of every pullup.
+        A peak above the bar that falls between two frames is not expected to be counted.
+
+        peakOffsets: list of float
+            Relative head height of every peak compared to the bar
+        fps: float
+            Frame rate of the synthetic stream
+        repSeconds: float
+            Duration of every pullup, rounded to an even number of frames
+        """
+        bar = self.repDetector.barRelativeHight
+        hangHeight = bar + 0.25
+        # Even number of frames so the peak is always a sampled frame
+        framesPerRep = max(2, 2 * int(round(repSeconds * fps / 2)))
+        # One confident person, wrists at the bar and shoulders below the head
+        pose = {
+            'boxes': np.array([[0.0, 0.0, 1.0, 1.0]], dtype=np.float32),
+            'boxConf': np.ones(1, dtype=np.float32),
+            'keypointsXy': np.zeros((1, 17, 2), dtype=np.float32),
+            'keypointsXyn': np.full((1, 17, 2), 0.5, dtype=np.float32),
+            'keypointsConf': np.ones((1, 17), dtype=np.float32),
+        }
+        pose['keypointsXyn'][0, [9, 10], 1] = bar
+        truth = []
+        frameIndex = 0
+        self.startTime = time.perf_counter()
+        for peakOffset in peakOffsets:
+            peakHeight = bar + peakOffset
+            aboveBar = False
+            for repFrame in range(framesPerRep):
+                phase = repFrame / framesPerRep
+                noseHeight = hangHeight - (hangHeight - peakHeight) * (1 - np.cos(2 * np.pi * phase)) / 2
+                pose['keypointsXyn'][0, 0:3, 1] = noseHeight
+                pose['keypointsXyn'][0, [5, 6], 1] = noseHeight + 0.1
+                # Truth from the sampled heights, as seen by the counter
+                if noseHeight < bar - self.repDetector.upperBand and not aboveBar:
+                    aboveBar = True
+                    truth.append(frameIndex)
+                self.framesRead += 1
+                self.countPose(pose, frameIndex, frameIndex / fps)
+                self.framesProcessed += 1
+                frameIndex += 1
+        self.endTime = time.perf_counter()
+        return truth
+
+
+    def getMemory(self):
+        """
+        This function returns current and peak resident memory in MB, None if not available
+        """
+        currentMb, peakMb = None, None
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                currentMb = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+        except (OSError, ValueError, AttributeError):
+            pass
+        if resource is not None:
+            # Reported in kB on Linux
+            peakMb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+        return currentMb, peakMb
+
+
+    def compareTruth(self, truth, tolerance):
+        """
+        This function compares counted pullups with ground truth.
+        Ground truth is either a total count or a list of frame indices where pullups are done.
+        A counted pullup matches a true one if the frame indices differ at most tolerance frames.
+
+        truth: int or list of int
+            Ground truth
+        tolerance: int
+            Allowed difference in frames
+        """
+        if isinstance(truth, int):
+            return {'expected': truth, 'counted': len(self.pullupFrames), 'error': len(self.pullupFrames) - truth}
+        unmatched = list(truth)
+        matched = 0
+        for frameIndex in self.pullupFrames:
+            closest = min(unmatched, key=lambda trueIndex: abs(trueIndex - frameIndex), default=None)
+            if closest is not None and abs(closest - frameIndex) <= tolerance:
+                unmatched.remove(closest)
+                matched += 1
+        return {'expected': len(truth), 'counted': len(self.pullupFrames), 'error': len(self.pullupFrames) - len(truth),
+                'matched': matched, 'missed': len(unmatched), 'extra': len(self.pullupFrames) - matched}
+
+
+    def getReport(self, truth=None, tolerance=10):
+        """
+        This function returns the benchmark results as a dictionary
+        """
+        elapsed = (self.endTime - self.startTime) if self.startTime is not None and self.endTime is not None else 0.0
+        currentMb, peakMb = self.getMemory()
+        report = {
+            'framesRead': self.framesRead,
+            'framesProcessed': self.framesProcessed,
+            'seconds': elapsed,
+            'fps': self.framesProcessed / elapsed if elapsed > 0 else 0.0,
+            'memoryMb': currentMb,
+            'peakMemoryMb': peakMb,
+            'pullups': len(self.pullupFrames),
+            'pullupFrames': self.pullupFrames,
+            'stages': {},
+        }
+        for stageName, latencies in self.stageLatencies.items():
+            latencies = np.array(latencies)
+            report['stages'][stageName] = {
+                'count': int(len(latencies)),
+                'meanMs': float(latencies.mean()),
+                'p50Ms': float(np.percentile(latencies, 50)),
+                'p90Ms': float(np.percentile(latencies, 90)),
+                'p99Ms': float(np.percentile(latencies, 99)),
+                'maxMs': float(latencies.max()),
+            }
+        if truth is not None:
+            report['truth'] = self.compareTruth(truth, tolerance)
+        return report
+
+
+def readTruth(truth):
+    """
+    This function reads ground truth from an integer or a file.
+    The file contains either one integer with the total count or one frame index per line.
+    """
+    if truth is None:
+        return None
+    if not os.path.exists(truth):
+        return int(truth)
+    with open(truth, 'r') as f:
+        values = [int(line.split()[0]) for line in f if line.strip() and not line.startswith('#')]
+    if len(values) == 1:
+        return values[0]
+    return values
+
+
+def printReport(report):
+    """
+    This function prints a benchmark report
+    """
+    print('Frames read ' + str(report['framesRead']) + ', processed ' + str(report['framesProcessed']) + ' in ' + '{:.1f}'.format(report['seconds']) + ' s, ' + '{:.1f}'.format(report['fps']) + ' fps')
+    if report['memoryMb'] is not None:
+        print('Memory ' + '{:.0f}'.format(report['memoryMb']) + ' MB')
+    if report['peakMemoryMb'] is not None:
+        print('Peak memory ' + '{:.0f}'.format(report['peakMemoryMb']) + ' MB')
+    for stageName, stage in report['stages'].items():
+        print('  ' + stageName + ': p50 ' + '{:.2f}'.format(stage['p50Ms']) + ' ms, p90 ' + '{:.2f}'.format(stage['p90Ms']) + ' ms, p99 ' + '{:.2f}'.format(stage['p99Ms']) + ' ms, max ' + '{:.2f}'.format(stage['maxMs']) + ' ms')
+    print('Pullups counted ' + str(report['pullups']))
+    if 'truth' in report:
+        print('Ground truth ' + str(report['truth']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded video or keypoint txt files through the pullup counting pipeline')
+    parser.add_argument('--video', help='Video file to replay through inference and counting')
+    parser.add_argument('--labels', help='Folder with keypoint txt files to replay through counting only')
+    parser.add_argument('--truth', help='Ground truth, total count or file with a count or one frame index per line')
+    parser.add_argument('--tolerance', type=int, default=10, help='Allowed frame difference when matching pullups to ground truth')
+    parser.add_argument('--fps', type=float, default=25.0, help='Frame rate of the stream keypoint txt files were saved from')
+    parser.add_argument('--stride', type=int, default=1, help='Infer every stride frame of the video')
+    parser.add_argument('--noRoi', action='store_true', help='Infer full frames instead of region of interest')
+    parser.add_argument('--synthetic', action='store_true', help='Replay synthetic pullups peaking just above and below the bar, exit code 1 on a wrong count')
+    parser.add_argument('--json', help='Write report to this json file')
+    args = parser.parse_args()
+    assert args.video or args.labels or args.synthetic, 'Either --video, --labels or --synthetic must be given'
+
+    benchmark = benchmarkClass()
+    if args.synthetic:
+        # Peaks 0.5 to 2 % of the image height above the bar must be counted, a peak just below the bar must not
+        truth = benchmark.runSynthetic([-0.005, -0.01, 0.005, -0.015, -0.02], args.fps)
+    elif args.video:
+        benchmark.runVideo(args.video, args.stride, not args.noRoi)
+        truth = readTruth(args.truth)
+    else:
+        benchmark.runLabels(args.labels, args.fps)
+        truth = readTruth(args.truth)
+    report = benchmark.getReport(truth, args.tolerance)
+    printReport(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.synthetic and (report['truth']['missed'] > 0 or report['truth']['extra'] > 0):
+        raise SystemExit(1)
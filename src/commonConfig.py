@@ -3,7 +3,6 @@
 # Description: Configuration file for the data pipeline for pullup counter. 
 # *********************************************************************************
 import os
-import numpy as np
 
 class commonConfigClass():
     """
@@ -14,8 +13,17 @@ class commonConfigClass():
     def __init__ (self):
         """
         Init function
+        Settings are class attributes shared by all instances, so creating an instance in every module is cheap.
         """
         pass
+
+
+    def createFolders(self):
+        """
+        This function creates the data folder, called once by the entry script at startup.
+        Kept out of the class definition so importing modules has no side effects.
+        """
+        os.makedirs(os.path.join(self.base.scriptPath, 'data'), exist_ok=True)
     
     class baseConfig:
         """
@@ -48,9 +56,7 @@ class commonConfigClass():
     base.scriptPath = os.path.dirname(os.path.abspath(__file__))
     # Set file name and path for saving pullup counts
     base.pullupCountsFileName = 'pullupCounts.txt'
-    # Make sure folder exist in scriptPath for saving pullup counts
-    if not os.path.exists(os.path.join(base.scriptPath, 'data')):
-        os.makedirs(os.path.join(base.scriptPath, 'data'))
+    # The data folder in scriptPath is created by createFolders at startup
 
     # Set file name for saving time point of first pullup
     base.pullupTimeFirstFileName = 'pullupTimeFirst.txt'
@@ -64,26 +70,38 @@ class commonConfigClass():
     # Set file path for saving pullup counts
     # This folder path is mounted through the docker run command also
     base.pullupCountsFilePath = os.path.join(base.scriptPath, 'data', base.pullupCountsFileName) 
+    # Set file name and path for the consolidated pullup state (count and time stamps)
+    base.pullupStateFileName = 'pullupState.json'
+    base.pullupStateFilePath = os.path.join(base.scriptPath, 'data', base.pullupStateFileName)
     # Set folder name for saving stream
     base.streamSaveFolderName = 'pullupSave'
     # Set name of video produced by YOLOv8n pose estimation
     base.streamSaveFileName = 'video.avi'
     # Set file path for saving stream
     base.streamSaveFolderPath = os.path.join(base.scriptPath, 'data', base.streamSaveFolderName)
+    # Set folder path for exported models, in the mounted data folder so the export is kept between starts
+    base.modelCacheFolderPath = os.path.join(base.scriptPath, 'data', 'models')
+    # Set folder path for the binary store of pose results used for re-counting
+    base.keypointStoreFolderPath = os.path.join(base.scriptPath, 'data', 'keypointStore')
+    # Set file path for the list of streams in multi-stream mode, single stream mode is used if missing
+    base.pullupStreamsFilePath = os.path.join(base.scriptPath, 'data', 'pullupStreams.json')
+    # Set folder path for the counter files and pose store of each stream, one sub folder per stream name
+    base.pullupStreamsFolderPath = os.path.join(base.scriptPath, 'data', 'streams')
+    # Set file path for the activity state (active or idle) read by Home Assistant
+    base.activityStateFileName = 'pullupActivity.txt'
+    base.activityStateFilePath = os.path.join(base.scriptPath, 'data', base.activityStateFileName)
+    # Set file path for the periodic json dump of metrics
+    base.metricsFilePath = os.path.join(base.scriptPath, 'data', 'pullupMetrics.json')
+    # SQLite database with the history of every counted pullup, see repHistory.py
+    base.repHistoryFilePath = os.path.join(base.scriptPath, 'data', 'pullupHistory.sqlite')
     
 
     ### Data configuration ###
     # Set operations file path
     data.operationModeFilePath = os.path.join(base.scriptPath, 'data', 'pullupSoundsOperation.txt')
-    # Read the file with the operation mode status
-    with open(data.operationModeFilePath, 'r') as f:
-        # Read the status
-        HAOperationMode = f.read()
-        # Newline character included, use in
-        if 'normal' in HAOperationMode:
-            data.operationMode = 'normal'
-        if 'simulate' in HAOperationMode: # Simulate mode
-            data.operationMode = 'simulate'
+    # Operation mode, 'normal' or 'simulate' (simulate a pullup every second)
+    # The file is read once at startup by the control state, which keeps this value updated
+    data.operationMode = 'normal'
 
     # Get OS type so we can use it both on linux server without display and windows workstation with display
     base.osType = os.name
@@ -115,12 +133,170 @@ class commonConfigClass():
 
     # Set needed confidence for a pullup to be counted
     data.noseConfidenceThreshold = 0.5 
-    # Max video file size in bytes (1000 MB)
-    data.maxVideoFileSize = 1000000000
+    # Hysteresis band below the bar. Head must go below bar + band (down) before the next pullup is counted
+    data.repHysteresisBand = 0.02
+    # Distance above the bar the head must pass for a pullup (0 = head above the bar, as the original counter)
+    data.repUpperBand = 0.0
+    # Smoothing of head height, weight of the newest frame (1 = no smoothing)
+    data.repSmoothing = 0.6
+    # Minimum time in seconds between two counted pullups, avoids double counts
+    data.repMinSeconds = 0.6
+    # Number of frames of keypoints kept by the rep detector
+    data.repBufferSize = 64
+    # Only count if confident wrists are above the shoulders (hanging from the bar)
+    data.repRequireHanging = True
+    # Max total size in bytes of the annotated video segments, oldest segments are deleted first (1000 MB)
+    data.videoMaxBytes = 1000000000
+    # Length in seconds of each annotated video segment file
+    data.videoSegmentSeconds = 60
+    # Only record the annotated video around counted pullups
+    data.videoRepWindowOnly = False
+    # Seconds recorded before and after a counted pullup when only pullups are recorded
+    data.videoRepPreSeconds = 3.0
+    data.videoRepPostSeconds = 2.0
+    # Max number of annotated frames waiting for the encoder, newer frames are dropped when full
+    data.videoQueueSize = 32
+    # Longest gap in seconds between annotated frames filled by repeating the last frame, a longer gap (idle mode) starts a new segment
+    data.videoMaxGapSeconds = 5.0
     # Select YOLO model (nano or full)
     data.yoloModel = 'n' # n=nano, s=small, m=medium, l=large, x=full 
+    # Select inference backend, the model is exported once and cached in base.modelCacheFolderPath
+    data.inferenceBackend = 'pytorch' # pytorch, onnx or openvino
+    # Use INT8 quantized model (openvino backend only)
+    data.inferenceQuantize = False
+    # Calibration data set used for INT8 quantization
+    data.inferenceQuantizeData = 'coco8-pose.yaml'
+    # Number of dummy frames inferred at startup to measure backend latency
+    data.backendBenchmarkFrames = 5
+    # Number of inference worker processes, each holding its own model (0 = inference in the main process)
+    data.inferenceWorkers = 0
+    # Number of intra-op threads used by the model in each worker process
+    data.inferenceIntraOpThreads = 2
+    # Number of shared memory frame buffers per worker, frames are dropped when all are in use
+    data.inferenceSlotsPerWorker = 2
+    # Size in bytes of each shared memory frame buffer (full HD color frame)
+    data.inferenceSlotBytes = 1920 * 1080 * 3
+    # Time in seconds to wait for a result before it is given up and following results are released
+    data.inferenceResultTimeout = 10.0
     # Set theme for sound chime (not Sonos)
     data.soundTheme = 'mario'
+    # Max number of pullup events waiting for SONOS, chime and file updates in the background
+    data.eventQueueSize = 8
+    # Policy when the event queue is full: 'coalesce' merges into the newest waiting event, 'dropOldest' or 'dropNewest'
+    data.eventDropPolicy = 'coalesce'
+    # Interval in seconds for printing event latency metrics (0 = disabled)
+    data.eventMetricsInterval = 600
+    # Watch Home Assistant setting files with inotify if the inotify_simple package is installed
+    data.controlStateUseInotify = True
+    # Interval in seconds for polling Home Assistant setting files when inotify is not used
+    data.controlStatePollInterval = 0.5
+    # Interval in seconds for writing changed pullup state to file
+    data.persistenceFlushInterval = 1.0
+    # Force pullup state files to disk on every write (slower, survives power loss)
+    data.persistenceFsync = False
+    # Minimum time in seconds between inferences when the athlete is away from the bar (0.2 = 5 fps)
+    data.schedulerNormalInterval = 0.2
+    # Minimum time in seconds between inferences when the nose is close to the bar (0 = as fast as possible)
+    data.schedulerBoostInterval = 0.0
+    # Share of one inference slot the model may use at normal rate, keeps CPU headroom for decoding
+    data.schedulerCpuShare = 0.8
+    # Smoothing factor for the measured inference latency (0-1, higher follows changes faster)
+    data.schedulerLatencySmoothing = 0.1
+    # Distance in relative image height from the bar where inference rate is raised
+    data.schedulerBoostBand = 0.15
+    # Time in seconds the raised inference rate is kept after the nose was close to the bar
+    data.schedulerBoostDuration = 2.0
+    # Shortest and longest wait in seconds before reopening a failed stream (doubled for every failure)
+    data.captureReconnectMinSeconds = 1.0
+    data.captureReconnectMaxSeconds = 30.0
+    # Input size of the model for full frames (long side in pixels)
+    data.inferenceSize = 640
+    # Crop a region of interest around the athlete and the bar instead of inferring the full frame
+    data.roiEnabled = True
+    # Run inference on the full frame every this many inferences to find athletes outside the region
+    data.roiFullFrameInterval = 30
+    # Margin added around the last detected box, as share of box width and height
+    data.roiMargin = 0.3
+    # Minimum width and height of the region in pixels
+    data.roiMinSize = 256
+    # Use the full frame if the region covers more than this share of it
+    data.roiMaxAreaShare = 0.8
+    # Minimum box confidence for keeping the region, lower means the athlete is lost
+    data.roiBoxConfidenceThreshold = 0.3
+    # Follow detected persons across frames and count only the athlete under the bar, not spotters or passers-by
+    data.athleteTrackingEnabled = True
+    # Minimum box overlap (IoU) for a person to be the same as a tracked person in the previous frame
+    data.trackIouThreshold = 0.3
+    # Maximum box center movement, as share of the box diagonal, for matching a person without overlap
+    data.trackMaxCentroidDistance = 0.5
+    # Number of inferred frames a tracked person may be missing before the track is removed, the athlete lock is then released
+    data.trackMaxMissedFrames = 10
+    # Top of the box of the athlete must be above the bar plus this relative image height
+    data.trackBarMargin = 0.15
+    # Append pose results of every inferred frame to the keypoint store
+    data.keypointStoreEnabled = True
+    # Number of detected persons stored per frame
+    data.keypointStoreMaxPersons = 3
+    # Do not store frames where no person is detected
+    data.keypointStoreSkipEmpty = True
+    # Start a new segment file at this size in bytes (100 MB)
+    data.keypointStoreSegmentBytes = 100000000
+    # Delete oldest segments when the store is bigger than this in bytes (2000 MB)
+    data.keypointStoreMaxBytes = 2000000000
+    # Flush the segment file to disk every this many frames
+    data.keypointStoreFlushRecords = 50
+    # Only run pose inference when motion is seen near the bar, idle otherwise
+    data.motionGateEnabled = True
+    # Interval in seconds between motion checks
+    data.motionCheckInterval = 0.2
+    # Width in pixels of the downscaled frame used for motion checks
+    data.motionFrameWidth = 160
+    # Part of the image checked for motion, relative image height above and below the bar
+    data.motionBandAbove = 0.25
+    data.motionBandBelow = 0.5
+    # Gray level difference for a pixel to count as changed (0-255)
+    data.motionPixelThreshold = 25
+    # Share of changed pixels near the bar that starts pose inference
+    data.motionShareThreshold = 0.01
+    # Time in seconds without motion or detected athlete before going idle
+    data.motionQuietSeconds = 120
+    # Collect latency histograms and counters of the pipeline
+    data.metricsEnabled = True
+    # Upper bounds in milliseconds of the latency histogram buckets
+    data.metricsBucketsMs = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+    # Number of recent calls used for the rate (fps) of each stage
+    data.metricsRateWindow = 50
+    # Host and port of the local HTTP server serving /metrics (port 0 = disabled)
+    data.metricsHost = '0.0.0.0'
+    data.metricsPort = 9108
+    # Interval in seconds for writing metrics to base.metricsFilePath (0 = disabled)
+    data.metricsDumpInterval = 0
+    # Serve count, settings and pushed pullup events on a local HTTP API for Home Assistant
+    data.apiEnabled = True
+    # Host and port of the API server, only reachable from this machine by default. Use '0.0.0.0' together with data.apiToken to reach it from Home Assistant on another machine
+    data.apiHost = '127.0.0.1'
+    data.apiPort = 8765
+    # Shared token required on POST /api/settings, POST /api/reset and settings sent over WebSocket (None = not required)
+    data.apiToken = None
+    # Max size in bytes of a request body or WebSocket frame, larger requests are refused (64 KiB)
+    data.apiMaxBodyBytes = 65536
+    # Max number of messages waiting for a slow push client, oldest are dropped
+    data.apiClientQueueSize = 100
+    # Interval in seconds for keep alive messages on idle push connections
+    data.apiKeepAliveSeconds = 15
+    # Record every counted pullup with rep duration, rest time, peak head height and confidence in base.repHistoryFilePath
+    data.repHistoryEnabled = True
+    # Maximum number of pullups written in one transaction and maximum time in seconds a pullup waits before being written
+    data.repHistoryBatchSize = 50
+    data.repHistoryFlushInterval = 1.0
+    # Rest time in seconds after which the next pullup starts a new session
+    data.repHistorySessionGap = 300
+    # Max number of pullups waiting to be written, newer are dropped when full
+    data.repHistoryQueueSize = 1000
+    # Maximum number of stream frames sent to the model in one batched call in multi-stream mode
+    data.multiStreamMaxBatch = 4
+    # Time in seconds to wait for a new frame from any stream before polling again in multi-stream mode
+    data.multiStreamPollInterval = 0.005
 
     ### SONOS configuration ###
     # SONOS room to play sound in
@@ -129,8 +305,33 @@ class commonConfigClass():
     sonos.HASoundVolumeFilePath = os.path.join(base.scriptPath, 'data', 'pullupSoundsVolume.txt')    
     # Set default local location for sound files
     sonos.soundBasePath = os.path.join(base.scriptPath, 'sounds', 'military')
-    # Set directory for sound files on webserver
+    # Set directory for sound files on webserver, not used when the local sound server is enabled
     sonos.soundBasePathWeb = 'http://192.168.1.2/sounds'
+    # Serve the sound files from the counter itself instead of the webserver above
+    sonos.soundServerEnabled = True
+    # Folder served by the local sound server, must be the sounds folder as web adresses are built from the part after 'sounds'
+    sonos.soundServerFolderPath = os.path.join(base.scriptPath, 'sounds')
+    # URL path of the served folder
+    sonos.soundServerUrlPath = 'sounds'
+    # Host and port of the local sound server
+    sonos.soundServerHost = '0.0.0.0'
+    sonos.soundServerPort = 8766
+    # Host name or IP address SONOS uses to reach the counter (None = address of the interface towards soundServerProbeAddress)
+    sonos.soundServerAdvertiseHost = None
+    # IP address of a SONOS speaker or another host on the SONOS network, used to find the local interface, no packet is sent
+    # None uses the SONOS discovery multicast address, which selects the interface SONOS is discovered on
+    sonos.soundServerProbeAddress = None
+    # Total size in bytes of sound files held in memory by the local sound server
+    sonos.soundServerCacheBytes = 32 * 1024 * 1024
+    # Json file mapping pullup counts to milestone sound files, relative to sonos.soundBasePath, for example {"5": "5pappa.mp3", "100": "century.mp3"}
+    # Added to the files named like 5pappa.mp3 and overrides them
+    sonos.milestoneTableFilePath = os.path.join(base.scriptPath, 'data', 'pullupMilestones.json')
+    # Set file name of the sound played for the oora theme
+    sonos.ooraSoundFileName = 'oorah.mp3'
+    # Time in seconds a discovered SONOS speaker is reused before discovery is run again
+    sonos.speakerCacheTTL = 600
+    # Minimum time in seconds between checks for changes in the sound folder
+    sonos.soundCatalogCheckInterval = 30
     # Set file path for sound status
     sonos.HASoundStatusFilePath = os.path.join(base.scriptPath, 'data', 'pullupSounds.txt') # Determined in HA config
     # Set file path for sound theme
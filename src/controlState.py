@@ -0,0 +1,270 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Memory resident control state for the Home Assistant settings.
+# The txt files written by Home Assistant are watched on a background thread
+# so the frame loop never has to read them.
+# *********************************************************************************
+import os
+import threading
+import time
+# inotify is optional, fall back to polling of modification times if missing
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+# Load modules
+from commonConfig import commonConfigClass
+from statePersistence import writeFileAtomic
+conf = commonConfigClass()
+
+
+def parseSoundStatus(text):
+    """
+    This function parses the status of the Home Assistant pullup sound switch.
+    """
+    # Newline character included, use in
+    return 'on' in text
+
+
+def parseSoundTheme(text):
+    """
+    This function parses the theme of the Home Assistant pullup sound.
+    """
+    # Newline character included, use in
+    if 'oora' in text:
+        return 'oora'
+    if 'random' in text:
+        return 'random'
+    return text.strip()
+
+
+def parseSonosRoom(text):
+    """
+    This function parses the room of the Home Assistant Sonos selection
+    """
+    # Newline character included, use in
+    for room in ['Koket', 'Uterummet', 'Kontoret']:
+        if room in text:
+            return room
+    return text.strip()
+
+
+def parseSonosVolume(text):
+    """
+    This function parses the volume of the Home Assistant Sonos selection
+    """
+    volume = int(text)
+    # Should be equal to 10,20,30,40,50,60,70,80,90,100, assert this
+    assert volume in [10,20,30,40,50,60,70,80,90,100], 'Volume is not in the list [10,20,30,40,50,60,70,80,90,100]'
+    return volume
+
+
+def parseOperationMode(text):
+    """
+    This function parses the operation mode, 'normal' or 'simulate'
+    """
+    # Newline character included, use in
+    if 'simulate' in text:
+        return 'simulate'
+    if 'normal' in text:
+        return 'normal'
+    raise ValueError('Unknown operation mode ' + text.strip())
+
+
+def parsePullupCounts(text):
+    """
+    This function parses the pullup counter file, Home Assistant writes 0 to reset it
+    """
+    return int(text)
+
+
+def formatSetting(value):
+    """
+    This function formats a setting value as written to its file, switches are written as on or off
+    """
+    if isinstance(value, bool):
+        return 'on' if value else 'off'
+    return str(value)
+
+
+class controlStateClass:
+    """
+    Class describing all Home Assistant settings held in memory.
+    Values are refreshed from file on a background thread, using inotify if available
+    and otherwise polling of file modification times. Callbacks are called on changes.
+    """
+
+    def __init__ (self, settings=None):
+        """
+        Init function, reads all files once
+
+        settings: dict
+            Key and tuple (file path, parser, default value) for each setting, Home Assistant settings if not given
+        """
+        # Key, file path, parser and default value for each setting
+        self.settings = settings if settings is not None else {
+            'soundStatus': (conf.sonos.HASoundStatusFilePath, parseSoundStatus, False),
+            'soundTheme': (conf.sonos.HASoundThemeFilePath, parseSoundTheme, 'oora'),
+            'sonosRoom': (conf.sonos.HASoundRoomFilePath, parseSonosRoom, None),
+            'sonosVolume': (conf.sonos.HASoundVolumeFilePath, parseSonosVolume, 10),
+            'operationMode': (conf.data.operationModeFilePath, parseOperationMode, conf.data.operationMode),
+            'pullupCounts': (conf.base.pullupCountsFilePath, parsePullupCounts, None),
+        }
+        self.values = {}
+        self.fileStats = {}
+        self.callbacks = {}
+        self.running = False
+        self.thread = None
+        # Values are changed both by the watcher thread and by set
+        self.lock = threading.Lock()
+        for key in self.settings:
+            self.values[key] = self.settings[key][2]
+            self.callbacks[key] = []
+            self.reload(key)
+
+
+    def get(self, key):
+        """
+        This function returns the current value of a setting, no file access
+        """
+        return self.values[key]
+
+
+    def registerCallback(self, key, callback):
+        """
+        This function registers a function called as callback(key, oldValue, newValue) when a setting changes.
+        Callbacks are called from the watcher thread.
+        """
+        self.callbacks[key].append(callback)
+
+
+    def getFileStat(self, filePath):
+        """
+        This function returns modification time and size of a file, None if missing
+        """
+        try:
+            fileStat = os.stat(filePath)
+        except OSError:
+            return None
+        return (fileStat.st_mtime_ns, fileStat.st_size)
+
+
+    def reload(self, key):
+        """
+        This function reads and parses the file of a setting and calls callbacks if the value changed.
+        Missing or invalid files keep the previous value, which is the default until the file is written.
+        Only invalid files are reported, a missing file is normal until Home Assistant or the counter writes it.
+        """
+        filePath, parser, default = self.settings[key]
+        self.fileStats[key] = self.getFileStat(filePath)
+        if self.fileStats[key] is None:
+            return
+        try:
+            with open(filePath, 'r') as f:
+                newValue = parser(f.read())
+        except Exception as e:
+            print('Failed to read setting ' + key + ' from ' + filePath)
+            print(e)
+            return
+        self.setValue(key, newValue)
+
+
+    def validate(self, key, value):
+        """
+        This function returns the parsed value of a setting without changing anything.
+        Raises an exception for invalid values.
+        """
+        filePath, parser, default = self.settings[key]
+        return parser(formatSetting(value))
+
+
+    def set(self, key, value):
+        """
+        This function changes a setting directly, for example from the API server.
+        The value is validated by the parser and written to the setting file, so Home Assistant
+        integrations reading the files see the change. Raises an exception for invalid values.
+        """
+        filePath, parser, default = self.settings[key]
+        text = formatSetting(value)
+        newValue = parser(text)
+        writeFileAtomic(filePath, text)
+        # The watcher does not need to read back the file written here
+        self.fileStats[key] = self.getFileStat(filePath)
+        self.setValue(key, newValue)
+
+
+    def setValue(self, key, newValue):
+        """
+        This function stores a new value and calls the callbacks if it changed
+        """
+        with self.lock:
+            oldValue = self.values[key]
+            if newValue == oldValue:
+                return
+            self.values[key] = newValue
+        for callback in self.callbacks[key]:
+            try:
+                callback(key, oldValue, newValue)
+            except Exception as e:
+                print('Failed to run callback for setting ' + key)
+                print(e)
+
+
+    def start(self):
+        """
+        This function starts the background thread watching the files
+        """
+        if self.running:
+            return
+        self.running = True
+        if INotify is not None and conf.data.controlStateUseInotify:
+            target = self.watchInotify
+        else:
+            target = self.watchPoll
+        self.thread = threading.Thread(target=target, name='pullupControlState', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """
+        This function stops the background thread
+        """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(5.0)
+            self.thread = None
+
+
+    def watchPoll(self):
+        """
+        This function polls the modification time and size of all files and reloads changed ones
+        """
+        while self.running:
+            for key in self.settings:
+                if self.getFileStat(self.settings[key][0]) != self.fileStats[key]:
+                    self.reload(key)
+            time.sleep(conf.data.controlStatePollInterval)
+
+
+    def watchInotify(self):
+        """
+        This function waits for inotify events on the folders of all files and reloads changed ones
+        """
+        inotify = INotify()
+        watchFlags = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        # Map watch descriptor and file name to setting key
+        keysByFolder = {}
+        for key in self.settings:
+            folderPath, fileName = os.path.split(self.settings[key][0])
+            keysByFolder.setdefault(folderPath, {})[fileName] = key
+        keysByWatch = {}
+        for folderPath in keysByFolder:
+            keysByWatch[inotify.add_watch(folderPath, watchFlags)] = keysByFolder[folderPath]
+        try:
+            while self.running:
+                for event in inotify.read(timeout=1000):
+                    key = keysByWatch.get(event.wd, {}).get(event.name)
+                    if key is not None:
+                        self.reload(key)
+        finally:
+            inotify.close()
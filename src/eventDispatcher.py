@@ -0,0 +1,217 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Background dispatcher for side effects of counted pullups.
+# SONOS playback, chime and file updates are run on a worker thread so they
+# never stall the inference loop.
+# *********************************************************************************
+import threading
+import time
+from collections import deque
+# Load modules
+from commonConfig import commonConfigClass
+from metrics import metricsRegistry
+conf = commonConfigClass()
+
+
+class eventDispatcherClass:
+    """
+    Class describing a bounded event queue and a worker thread handling "pullup counted" events.
+    Each event is passed through a list of named stages and the latency of every stage is measured.
+    """
+
+    def __init__ (self, stages, maxQueueSize=None, dropPolicy=None, metricsInterval=None):
+        """
+        Init function
+
+        stages: list of tuples (stageName, function)
+            Functions called in order with the event dictionary as only argument
+        maxQueueSize: int
+            Maximum number of events waiting in the queue
+        dropPolicy: string
+            What to do when the queue is full, 'coalesce', 'dropOldest' or 'dropNewest'
+        metricsInterval: int
+            Interval in seconds for printing metrics from the worker, 0 disables printing
+        """
+        # Use configuration if not set
+        if maxQueueSize is None:
+            maxQueueSize = conf.data.eventQueueSize
+        if dropPolicy is None:
+            dropPolicy = conf.data.eventDropPolicy
+        if metricsInterval is None:
+            metricsInterval = conf.data.eventMetricsInterval
+        assert dropPolicy in ['coalesce', 'dropOldest', 'dropNewest'], 'Drop policy is not in the list [coalesce, dropOldest, dropNewest]'
+        assert maxQueueSize >= 1, 'Queue size must be at least 1'
+        self.stages = stages
+        self.maxQueueSize = maxQueueSize
+        self.dropPolicy = dropPolicy
+        self.metricsInterval = metricsInterval
+        # Queue and condition used for waking up the worker
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        # Init metrics, one entry per stage and one for time spent waiting in queue
+        self.counters = {'submitted': 0, 'processed': 0, 'dropped': 0, 'coalesced': 0}
+        self.stageMetrics = {}
+        for stageName in ['queueWait'] + [stage[0] for stage in stages]:
+            self.stageMetrics[stageName] = {'count': 0, 'errors': 0, 'totalMs': 0.0, 'maxMs': 0.0, 'lastMs': 0.0}
+        self.lastMetricsPrint = time.time()
+
+
+    def start(self):
+        """
+        This function starts the worker thread
+        """
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        # Daemon thread so a hanging SONOS call can never keep the container alive
+        self.thread = threading.Thread(target=self.worker, name='pullupEventDispatcher', daemon=True)
+        self.thread.start()
+
+
+    def stop(self, timeout=5.0):
+        """
+        This function stops the worker thread after the queue has been emptied
+
+        timeout: float
+            Maximum time in seconds to wait for the worker
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+
+    def mergeEvents(self, olderEvent, newerEvent):
+        """
+        This function merges a newer event into an older one waiting in the queue.
+        The newest count and last time stamp wins, a first time stamp is never lost unless the counter was reset between.
+        Creation time of the older event is kept so queue wait is measured honestly.
+        """
+        mergedEvent = dict(olderEvent)
+        mergedEvent.update(newerEvent)
+        if newerEvent.get('pullupTimeFirst') is None and newerEvent.get('resetGeneration') == olderEvent.get('resetGeneration'):
+            mergedEvent['pullupTimeFirst'] = olderEvent.get('pullupTimeFirst')
+        mergedEvent['createdTime'] = olderEvent['createdTime']
+        return mergedEvent
+
+
+    def submit(self, event):
+        """
+        This function puts an event on the queue without blocking.
+        Returns True if the event was queued or merged, False if it was dropped.
+
+        event: dict
+            Event information, 'createdTime' is added if missing
+        """
+        if 'createdTime' not in event:
+            event['createdTime'] = time.perf_counter()
+        with self.condition:
+            self.counters['submitted'] += 1
+            # Queue is full, apply the drop policy
+            if len(self.queue) >= self.maxQueueSize:
+                if self.dropPolicy == 'coalesce':
+                    # Only merge with the newest event of the same stream, counts of different streams are independent
+                    for queueIndex in range(len(self.queue) - 1, -1, -1):
+                        if self.queue[queueIndex].get('streamName') == event.get('streamName'):
+                            self.queue[queueIndex] = self.mergeEvents(self.queue[queueIndex], event)
+                            self.counters['coalesced'] += 1
+                            return True
+                    # No event of the same stream queued, make room as for dropOldest
+                    self.queue.popleft()
+                    self.counters['dropped'] += 1
+                if self.dropPolicy == 'dropOldest':
+                    self.queue.popleft()
+                    self.counters['dropped'] += 1
+                if self.dropPolicy == 'dropNewest':
+                    self.counters['dropped'] += 1
+                    return False
+            self.queue.append(event)
+            self.condition.notify()
+        return True
+
+
+    def recordStage(self, stageName, elapsedMs, failed=False):
+        """
+        This function updates the latency metrics of a stage
+        """
+        with self.condition:
+            metrics = self.stageMetrics[stageName]
+            metrics['count'] += 1
+            metrics['totalMs'] += elapsedMs
+            metrics['lastMs'] = elapsedMs
+            metrics['maxMs'] = max(metrics['maxMs'], elapsedMs)
+            if failed:
+                metrics['errors'] += 1
+        # Histograms in the shared registry, SONOS and file writes are stages here
+        metricsRegistry.observe('event.' + stageName, elapsedMs)
+        if failed:
+            metricsRegistry.increment('event.' + stageName + '.errors')
+
+
+    def processEvent(self, event):
+        """
+        This function runs all stages for one event and measures the latency of each.
+        A failing stage does not stop the following stages.
+        """
+        self.recordStage('queueWait', (time.perf_counter() - event['createdTime']) * 1000)
+        for stageName, stageFunction in self.stages:
+            stageStart = time.perf_counter()
+            failed = False
+            try:
+                stageFunction(event)
+            except Exception as e:
+                failed = True
+                print('Failed to run pullup event stage ' + stageName)
+                print(e)
+            self.recordStage(stageName, (time.perf_counter() - stageStart) * 1000, failed)
+        with self.condition:
+            self.counters['processed'] += 1
+
+
+    def worker(self):
+        """
+        This function is the worker loop, it runs until stopped and the queue is empty
+        """
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait(timeout=1.0)
+                if not self.queue:
+                    # Not running and nothing left to do
+                    return
+                event = self.queue.popleft()
+            self.processEvent(event)
+            # Print metrics with regular intervals
+            if self.metricsInterval > 0 and time.time() - self.lastMetricsPrint > self.metricsInterval:
+                self.lastMetricsPrint = time.time()
+                self.printMetrics()
+
+
+    def getMetrics(self):
+        """
+        This function returns a copy of the counters and per stage latency metrics
+        """
+        with self.condition:
+            metrics = dict(self.counters)
+            metrics['queueLength'] = len(self.queue)
+            metrics['stages'] = {}
+            for stageName, stageMetrics in self.stageMetrics.items():
+                stageCopy = dict(stageMetrics)
+                stageCopy['meanMs'] = stageCopy['totalMs'] / stageCopy['count'] if stageCopy['count'] > 0 else 0.0
+                metrics['stages'][stageName] = stageCopy
+            return metrics
+
+
+    def printMetrics(self):
+        """
+        This function prints the metrics of the dispatcher
+        """
+        metrics = self.getMetrics()
+        print('Pullup events submitted ' + str(metrics['submitted']) + ', processed ' + str(metrics['processed']) + ', dropped ' + str(metrics['dropped']) + ', coalesced ' + str(metrics['coalesced']))
+        for stageName, stageMetrics in metrics['stages'].items():
+            print('  ' + stageName + ': mean ' + '{:.1f}'.format(stageMetrics['meanMs']) + ' ms, max ' + '{:.1f}'.format(stageMetrics['maxMs']) + ' ms, errors ' + str(stageMetrics['errors']))
@@ -0,0 +1,172 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Threaded capture of the camera stream.
+# Frames are decoded on a separate thread into a small ring of preallocated
+# buffers and only the newest frame is handed to the inference loop.
+# The stream is reopened with backoff when it fails.
+# *********************************************************************************
+import threading
+import time
+import cv2
+# Load modules
+from commonConfig import commonConfigClass
+from metrics import metricsRegistry
+conf = commonConfigClass()
+
+
+class frameCaptureClass:
+    """
+    Class describing the capture thread and the latest frame buffer.
+    OpenCV releases the GIL while decoding, so decoding and inference run in parallel on separate cores.
+    """
+
+    def __init__ (self, source, live=True):
+        """
+        Init function
+
+        source: string or int
+            Stream URL, video file path or webcam index
+        live: bool
+            True for camera streams that are reopened when they fail.
+            False for video files where end of file stops the capture.
+        """
+        self.source = source
+        self.live = live
+        # Three buffers, one being written, one published and one held by the consumer
+        self.buffers = [None, None, None]
+        self.publishedSlot = None
+        self.publishedIndex = 0
+        self.publishedTime = 0.0
+        self.consumerSlot = None
+        self.condition = threading.Condition()
+        self.running = False
+        self.finished = False
+        self.thread = None
+        # Counters for decoded, dropped and reconnects
+        self.counters = {'decoded': 0, 'consumed': 0, 'dropped': 0, 'reconnects': 0, 'errors': 0}
+        self.consumedIndex = 0
+
+
+    def start(self):
+        """
+        This function starts the capture thread
+        """
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.worker, name='pullupFrameCapture', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """
+        This function stops the capture thread
+        """
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(5.0)
+            self.thread = None
+
+
+    def openCapture(self):
+        """
+        This function opens the source, returns None if it could not be opened
+        """
+        capture = cv2.VideoCapture(self.source)
+        if not capture.isOpened():
+            capture.release()
+            return None
+        # Keep the internal OpenCV buffer small, we want the newest frame
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return capture
+
+
+    def getWriteSlot(self):
+        """
+        This function returns a buffer slot that is neither published nor held by the consumer
+        """
+        with self.condition:
+            for slot in range(len(self.buffers)):
+                if slot != self.publishedSlot and slot != self.consumerSlot:
+                    return slot
+
+
+    def worker(self):
+        """
+        This function decodes frames until stopped, reopening live sources with backoff
+        """
+        backoff = conf.data.captureReconnectMinSeconds
+        capture = None
+        while self.running:
+            if capture is None:
+                capture = self.openCapture()
+                if capture is None:
+                    self.counters['errors'] += 1
+                    if not self.live:
+                        break
+                    print('Failed to open stream, retrying in ' + str(backoff) + ' s')
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, conf.data.captureReconnectMaxSeconds)
+                    continue
+            slot = self.getWriteSlot()
+            # Decode into the preallocated buffer, OpenCV allocates a new one if the size changed
+            decodeStart = time.perf_counter()
+            ok, frame = capture.read(self.buffers[slot])
+            metricsRegistry.observe('decode', (time.perf_counter() - decodeStart) * 1000)
+            if not ok:
+                capture.release()
+                capture = None
+                if not self.live:
+                    break
+                self.counters['reconnects'] += 1
+                print('Stream failed, reconnecting in ' + str(backoff) + ' s')
+                time.sleep(backoff)
+                backoff = min(backoff * 2, conf.data.captureReconnectMaxSeconds)
+                continue
+            backoff = conf.data.captureReconnectMinSeconds
+            with self.condition:
+                self.buffers[slot] = frame
+                # Frame published before but never taken by the consumer is dropped
+                if self.publishedIndex > self.consumedIndex:
+                    self.counters['dropped'] += 1
+                self.publishedSlot = slot
+                self.publishedIndex += 1
+                self.publishedTime = time.time()
+                self.counters['decoded'] += 1
+                self.condition.notify_all()
+        if capture is not None:
+            capture.release()
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+
+    def getLatest(self, timeout=1.0):
+        """
+        This function waits for a frame newer than the last one returned and returns it without copying.
+        The returned frame is valid until the next call. Returns (frame, frameIndex, frameTime),
+        frame is None on timeout or if the capture has finished.
+
+        timeout: float
+            Maximum time in seconds to wait for a new frame
+        """
+        with self.condition:
+            # The consumer is done with the previous frame when asking for a new one
+            self.consumerSlot = None
+            self.condition.wait_for(lambda: self.publishedIndex > self.consumedIndex or self.finished or not self.running, timeout)
+            if self.publishedIndex <= self.consumedIndex:
+                return None, self.consumedIndex, None
+            self.consumerSlot = self.publishedSlot
+            self.consumedIndex = self.publishedIndex
+            self.counters['consumed'] += 1
+            return self.buffers[self.consumerSlot], self.consumedIndex, self.publishedTime
+
+
+    def isFinished(self):
+        """
+        This function returns True if the capture has stopped and all frames are consumed
+        """
+        with self.condition:
+            return self.finished and self.publishedIndex <= self.consumedIndex
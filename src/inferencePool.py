@@ -0,0 +1,267 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Pool of inference worker processes for multi-core scaling.
+# Each worker process holds its own loaded pose model. Frames are handed over
+# through shared memory buffers and results are released in frame order so the
+# rep counter sees the same sequence as with inference in the main process.
+# *********************************************************************************
+import multiprocessing
+import os
+import queue
+import time
+from multiprocessing import shared_memory
+import numpy as np
+# Load modules
+from commonConfig import commonConfigClass
+from roiTracker import getFullFramePose
+conf = commonConfigClass()
+
+
+def inferenceWorker(workerIndex, memories, taskQueue, resultQueue, intraOpThreads, workerTasks):
+    """
+    This function runs in a worker process. It loads the pose model and infers frames from shared memory until stopped.
+
+    workerIndex: int
+        Index of the worker, used for printing
+    memories: list
+        Shared memory frame buffers, inherited from the main process
+    taskQueue: multiprocessing Queue
+        Tasks (sequence, slot, shape, offset, fullShape, imgsz), None stops the worker
+    resultQueue: multiprocessing Queue
+        Results ('result', sequence, slot, pose, latencySeconds, error, speed)
+    intraOpThreads: int
+        Number of threads used by the model
+    workerTasks: multiprocessing Array
+        Sequence of the task each worker has taken, written directly to shared memory so it is known if the worker dies
+    """
+    os.environ['OMP_NUM_THREADS'] = str(intraOpThreads)
+    try:
+        import torch
+        torch.set_num_threads(intraOpThreads)
+    except ImportError:
+        pass
+    from modelBackend import loadPoseModel, measureModelLatency
+    model, backend = loadPoseModel()
+    measureModelLatency(model, backend)
+    resultQueue.put(('ready', workerIndex, backend))
+    while True:
+        task = taskQueue.get()
+        if task is None:
+            break
+        sequence, slot, shape, offset, fullShape, imgsz = task
+        workerTasks[workerIndex] = sequence
+        # View of the frame in shared memory, no copy
+        region = np.ndarray(shape, dtype=np.uint8, buffer=memories[slot].buf)
+        inferenceStart = time.perf_counter()
+        try:
+            r = model(region, device="CPU", imgsz=imgsz, verbose=False)[0]
+            pose = getFullFramePose(r, offset, fullShape)
+            # Split of model time reported by YOLO, for the metrics of the main process
+            speed = dict(r.speed)
+            error = None
+        except Exception as e:
+            pose = None
+            speed = {}
+            error = str(e)
+        resultQueue.put(('result', sequence, slot, pose, time.perf_counter() - inferenceStart, error, speed))
+
+
+class inferencePoolClass:
+    """
+    Class describing the pool of inference worker processes.
+    Worker processes are forked, the pool must be started before other threads are started
+    since pullupCounter.py is a script that cannot be imported again by spawned processes.
+    """
+
+    def __init__ (self, numWorkers=None, intraOpThreads=None, slotsPerWorker=None, slotBytes=None):
+        """
+        Init function
+
+        numWorkers: int
+            Number of worker processes
+        intraOpThreads: int
+            Number of model threads in each worker
+        slotsPerWorker: int
+            Number of shared memory frame buffers per worker
+        slotBytes: int
+            Size of each frame buffer in bytes
+        """
+        # Use configuration if not set
+        self.numWorkers = conf.data.inferenceWorkers if numWorkers is None else numWorkers
+        self.intraOpThreads = conf.data.inferenceIntraOpThreads if intraOpThreads is None else intraOpThreads
+        slotsPerWorker = conf.data.inferenceSlotsPerWorker if slotsPerWorker is None else slotsPerWorker
+        self.slotBytes = conf.data.inferenceSlotBytes if slotBytes is None else slotBytes
+        assert self.numWorkers >= 1, 'Number of inference workers must be at least 1'
+        assert 'fork' in multiprocessing.get_all_start_methods(), 'Inference workers need the fork start method (not available on Windows)'
+        self.context = multiprocessing.get_context('fork')
+        self.memories = []
+        self.freeSlots = list(range(self.numWorkers * slotsPerWorker))
+        self.taskQueue = self.context.Queue()
+        self.resultQueue = self.context.Queue()
+        # Sequence of the task taken by each worker, -1 before the first task
+        self.workerTasks = self.context.Array('q', [-1] * self.numWorkers, lock=False)
+        self.workers = []
+        # Index of each worker process in workerTasks
+        self.workerIndices = {}
+        # Sequence number of the next submitted frame and of the next result released
+        self.nextSequence = 0
+        self.nextRelease = 0
+        # Frame information of submitted frames and finished results waiting for older ones
+        self.submitted = {}
+        self.finished = {}
+        # Shared memory buffer of every frame whose buffer is not returned yet, also for frames given up
+        self.pendingSlots = {}
+        self.counters = {'submitted': 0, 'released': 0, 'busy': 0, 'failed': 0, 'lost': 0, 'workersDied': 0}
+
+
+    def start(self):
+        """
+        This function creates the shared memory buffers, starts the workers and waits until their models are loaded
+        """
+        for slot in self.freeSlots:
+            self.memories.append(shared_memory.SharedMemory(create=True, size=self.slotBytes))
+        for workerIndex in range(self.numWorkers):
+            worker = self.context.Process(target=inferenceWorker, name='pullupInference' + str(workerIndex),
+                                          args=(workerIndex, self.memories, self.taskQueue, self.resultQueue, self.intraOpThreads, self.workerTasks), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+            self.workerIndices[worker] = workerIndex
+        for i in range(self.numWorkers):
+            message = self.resultQueue.get()
+            print('Inference worker ' + str(message[1]) + ' ready with backend ' + message[2])
+
+
+    def stop(self):
+        """
+        This function stops the workers and releases the shared memory buffers
+        """
+        for worker in self.workers:
+            self.taskQueue.put(None)
+        for worker in self.workers:
+            worker.join(5.0)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        for memory in self.memories:
+            memory.close()
+            memory.unlink()
+        self.memories = []
+
+
+    def submit(self, region, frameIndex, frameTime, offset, fullShape, imgsz):
+        """
+        This function copies a region to a free shared memory buffer and hands it to a worker.
+        Returns False if all buffers are in use, the frame is then dropped.
+
+        region: numpy array
+            Frame or region of interest to infer
+        frameIndex: int
+            Index of the frame in the stream
+        frameTime: float
+            Time the frame was decoded
+        offset: tuple
+            Pixel position (x, y) of the region in the full frame
+        fullShape: tuple
+            Shape of the full frame
+        imgsz: int
+            Inference size of the region
+        """
+        if len(self.freeSlots) == 0:
+            self.counters['busy'] += 1
+            return False
+        assert region.nbytes <= self.slotBytes, 'Frame is larger than the shared memory buffer, increase data.inferenceSlotBytes'
+        slot = self.freeSlots.pop()
+        np.copyto(np.ndarray(region.shape, dtype=np.uint8, buffer=self.memories[slot].buf), region)
+        sequence = self.nextSequence
+        self.nextSequence += 1
+        self.submitted[sequence] = {'frameIndex': frameIndex, 'frameTime': frameTime, 'offset': offset, 'fullShape': fullShape, 'slot': slot, 'submitTime': time.perf_counter()}
+        self.pendingSlots[sequence] = slot
+        self.taskQueue.put((sequence, slot, region.shape, offset, fullShape, imgsz))
+        self.counters['submitted'] += 1
+        return True
+
+
+    def getResults(self, timeout=0.0):
+        """
+        This function collects finished results and returns those that are next in frame order.
+        Each result is a dict with frameIndex, frameTime, offset, fullShape, pose, latency and speed, pose is None if inference failed.
+
+        timeout: float
+            Time in seconds to wait for the first result
+        """
+        try:
+            message = self.resultQueue.get(timeout=timeout) if timeout > 0 else self.resultQueue.get_nowait()
+            while True:
+                kind, sequence, slot, pose, latencySeconds, error, speed = message
+                # Buffer is returned once, also for a late result of a frame given up
+                if self.pendingSlots.pop(sequence, None) is not None:
+                    self.freeSlots.append(slot)
+                if sequence in self.submitted:
+                    result = self.submitted.pop(sequence)
+                    result.update({'pose': pose, 'latency': latencySeconds, 'speed': speed})
+                    self.finished[sequence] = result
+                if error is not None:
+                    self.counters['failed'] += 1
+                    print('Inference failed in worker')
+                    print(error)
+                message = self.resultQueue.get_nowait()
+        except queue.Empty:
+            pass
+        # Give up a result that takes too long, for example if a worker has died
+        oldest = self.submitted.get(self.nextRelease)
+        if oldest is not None and time.perf_counter() - oldest['submitTime'] > conf.data.inferenceResultTimeout:
+            print('No result for frame ' + str(oldest['frameIndex']) + ' from inference worker, skipping it')
+            self.submitted.pop(self.nextRelease)
+            self.counters['lost'] += 1
+            self.nextRelease += 1
+            self.checkWorkers()
+        # Release results in frame order, frames given up are skipped
+        results = []
+        while self.nextRelease < self.nextSequence and self.nextRelease not in self.submitted:
+            if self.nextRelease in self.finished:
+                results.append(self.finished.pop(self.nextRelease))
+                self.counters['released'] += 1
+            self.nextRelease += 1
+        return results
+
+
+    def checkWorkers(self):
+        """
+        This function removes dead workers after a result was given up and returns the buffer of the frame each one held.
+        A slow but living worker returns its buffer with its late result.
+        Workers are not forked again since other threads are running, see hasWorkers for the fallback.
+        """
+        deadWorkers = [worker for worker in self.workers if not worker.is_alive()]
+        if len(deadWorkers) == 0:
+            return
+        for worker in deadWorkers:
+            print('Inference worker ' + worker.name + ' has died with exit code ' + str(worker.exitcode))
+            self.workers.remove(worker)
+            self.counters['workersDied'] += 1
+            # Frame the worker had taken, its result was either sent before it died or never comes
+            sequence = self.workerTasks[self.workerIndices[worker]]
+            if sequence in self.pendingSlots:
+                self.freeSlots.append(self.pendingSlots.pop(sequence))
+                if self.submitted.pop(sequence, None) is not None:
+                    self.counters['lost'] += 1
+        self.numWorkers = len(self.workers)
+        if self.numWorkers == 0:
+            # Nobody will return the frames waiting for inference
+            for sequence in sorted(self.pendingSlots):
+                self.freeSlots.append(self.pendingSlots.pop(sequence))
+                if self.submitted.pop(sequence, None) is not None:
+                    self.counters['lost'] += 1
+
+
+    def hasWorkers(self):
+        """
+        This function returns False when all workers have died, inference must then be run in the main process
+        """
+        return len(self.workers) > 0
+
+
+    def isIdle(self):
+        """
+        This function returns True if no frames are waiting for inference or release
+        """
+        return len(self.submitted) == 0 and len(self.finished) == 0
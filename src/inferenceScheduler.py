@@ -0,0 +1,104 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Adaptive scheduler deciding which frames are sent to pose inference.
+# The inference rate follows the measured model latency and is raised when the
+# nose is close to the bar. Frames come from the threaded capture, always newest.
+# *********************************************************************************
+import time
+# Load modules
+from commonConfig import commonConfigClass
+conf = commonConfigClass()
+
+
+class inferenceSchedulerClass:
+    """
+    Class describing the inference rate scheduler.
+    The loop reports every new frame and every inference, the scheduler answers if a frame should be inferred.
+    """
+
+    def __init__ (self, barRelativeHight=None):
+        """
+        Init function
+
+        barRelativeHight: float
+            Relative height of the bar in the image, from config if not given
+        """
+        self.barRelativeHight = conf.data.barRelativeHight if barRelativeHight is None else barRelativeHight
+        # Exponential moving average of inference latency in seconds
+        self.latency = None
+        self.lastInferenceTime = 0.0
+        self.boostUntil = 0.0
+        # Counters for frames handled by the scheduler
+        self.counters = {'frames': 0, 'inferred': 0, 'skipped': 0}
+
+
+    def isBoosted(self, now=None):
+        """
+        This function returns True if the inference rate is temporarily raised
+        """
+        if now is None:
+            now = time.perf_counter()
+        return now < self.boostUntil
+
+
+    def getInterval(self, now=None):
+        """
+        This function returns the current target time in seconds between inferences.
+        Normal rate is limited by the configured interval and by the measured latency, keeping CPU headroom.
+        Raised rate runs inference as soon as the previous one has finished.
+        """
+        latency = self.latency if self.latency is not None else 0.0
+        if self.isBoosted(now):
+            return max(conf.data.schedulerBoostInterval, latency)
+        return max(conf.data.schedulerNormalInterval, latency / conf.data.schedulerCpuShare)
+
+
+    def shouldInfer(self):
+        """
+        This function decides if the newest frame should be sent to inference.
+        Frames are always the newest from the capture, so skipped frames are never used later.
+        """
+        self.counters['frames'] += 1
+        now = time.perf_counter()
+        if now - self.lastInferenceTime < self.getInterval(now):
+            self.counters['skipped'] += 1
+            return False
+        self.lastInferenceTime = now
+        return True
+
+
+    def reportInference(self, latencySeconds):
+        """
+        This function updates the measured inference latency
+
+        latencySeconds: float
+            Time spent in the model call including pre and post processing
+        """
+        self.counters['inferred'] += 1
+        if self.latency is None:
+            self.latency = latencySeconds
+        else:
+            self.latency = self.latency + conf.data.schedulerLatencySmoothing * (latencySeconds - self.latency)
+
+
+    def reportNose(self, noseRelativeHeight):
+        """
+        This function raises the inference rate for a while if the nose is close to the bar,
+        so the crossing of the bar is not missed.
+
+        noseRelativeHeight: float
+            Relative height of the nose in the image, 0 is the top
+        """
+        if abs(noseRelativeHeight - self.barRelativeHight) < conf.data.schedulerBoostBand:
+            self.boostUntil = time.perf_counter() + conf.data.schedulerBoostDuration
+
+
+    def getMetrics(self):
+        """
+        This function returns the frame counters and current latency and interval
+        """
+        metrics = dict(self.counters)
+        metrics['latencyMs'] = self.latency * 1000 if self.latency is not None else 0.0
+        metrics['intervalMs'] = self.getInterval() * 1000
+        metrics['boosted'] = self.isBoosted()
+        return metrics
@@ -0,0 +1,91 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Reading and writing of pose results in the YOLO save_txt format.
+# One txt file per frame named <video>_<frameIndex>.txt with one line per person:
+# class, box center x, y, width, height, x, y, confidence for each keypoint and
+# optionally box confidence, all relative to the full frame.
+# *********************************************************************************
+import os
+import re
+import numpy as np
+
+
+def writeKeypointTxt(filePath, pose, fullShape, saveConf=True):
+    """
+    This function writes pose results to a txt file in the same format as YOLO save_txt.
+
+    filePath: string
+        Path of the txt file
+    pose: dict
+        Full frame pose from getFullFramePose
+    fullShape: tuple
+        Shape (height, width) of the full frame
+    saveConf: bool
+        Add box confidence last on each line
+    """
+    fullHeight, fullWidth = fullShape[:2]
+    lines = []
+    for i in range(len(pose['boxes'])):
+        x1, y1, x2, y2 = pose['boxes'][i]
+        line = [0, (x1 + x2) / 2 / fullWidth, (y1 + y2) / 2 / fullHeight, (x2 - x1) / fullWidth, (y2 - y1) / fullHeight]
+        if i < len(pose['keypointsXyn']):
+            for j in range(pose['keypointsXyn'].shape[1]):
+                line += [pose['keypointsXyn'][i][j][0], pose['keypointsXyn'][i][j][1], pose['keypointsConf'][i][j]]
+        if saveConf:
+            line.append(pose['boxConf'][i])
+        lines.append(' '.join('%g' % value for value in line))
+    with open(filePath, 'a') as f:
+        f.writelines(line + '\n' for line in lines)
+
+
+def readKeypointTxt(filePath, numKeypoints=17):
+    """
+    This function reads a txt file written by YOLO save_txt or writeKeypointTxt into a pose dictionary.
+    Pixel coordinates are not known from the file, boxes and keypointsXy are relative to the full frame.
+    Returns pose dictionary, see getFullFramePose.
+
+    filePath: string
+        Path of the txt file
+    numKeypoints: int
+        Number of keypoints per person, 17 for COCO
+    """
+    lineLength = 5 + numKeypoints * 3
+    boxes, boxConf, keypointsXyn, keypointsConf = [], [], [], []
+    with open(filePath, 'r') as f:
+        for line in f:
+            values = line.split()
+            if len(values) < lineLength:
+                continue
+            values = np.array(values, dtype=np.float32)
+            xc, yc, w, h = values[1:5]
+            boxes.append([xc - w / 2, yc - h / 2, xc + w / 2, yc + h / 2])
+            # Box confidence is only saved with save_conf
+            boxConf.append(values[lineLength] if len(values) > lineLength else 1.0)
+            keypoints = values[5:lineLength].reshape(numKeypoints, 3)
+            keypointsXyn.append(keypoints[:, :2])
+            keypointsConf.append(keypoints[:, 2])
+    pose = {
+        'boxes': np.array(boxes, dtype=np.float32).reshape(-1, 4),
+        'boxConf': np.array(boxConf, dtype=np.float32),
+        'keypointsXyn': np.array(keypointsXyn, dtype=np.float32).reshape(-1, numKeypoints, 2),
+        'keypointsConf': np.array(keypointsConf, dtype=np.float32).reshape(-1, numKeypoints),
+    }
+    pose['keypointsXy'] = pose['keypointsXyn']
+    return pose
+
+
+def listKeypointTxtFiles(labelsFolderPath):
+    """
+    This function returns the txt files in a labels folder sorted by frame index.
+    Returns list of tuples (frameIndex, filePath).
+
+    labelsFolderPath: string
+        Folder with txt files named <video>_<frameIndex>.txt
+    """
+    keypointFiles = []
+    for fileName in os.listdir(labelsFolderPath):
+        frameMatch = re.match(r'^.*_(\d+)\.txt$', fileName)
+        if frameMatch:
+            keypointFiles.append((int(frameMatch.group(1)), os.path.join(labelsFolderPath, fileName)))
+    keypointFiles.sort()
+    return keypointFiles
@@ -0,0 +1,306 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Compact binary store of pose results and fast re-counting.
+# The live counter appends one fixed size record per inferred frame. Stored data
+# is read back as a NumPy memmap and counting is re-run for a grid of bar heights
+# and nose confidence thresholds in vectorized form, without running the model.
+# Usage:
+# python keypointStore.py --import data/pullupSave/labels
+# python keypointStore.py --bars 0.29:0.40:0.01 --confs 0.3:0.7:0.1 --truth 12
+# *********************************************************************************
+import argparse
+import os
+import re
+import time
+import numpy as np
+# Load modules
+from commonConfig import commonConfigClass
+conf = commonConfigClass()
+
+
+def getRecordDtype(maxPersons, numKeypoints=17):
+    """
+    This function returns the NumPy record type of one stored frame.
+    Coordinates are relative to the full frame and stored as float16 to keep the store small.
+
+    maxPersons: int
+        Number of detected persons stored per frame
+    numKeypoints: int
+        Number of keypoints per person, 17 for COCO
+    """
+    return np.dtype([
+        ('frameIndex', '<i8'),
+        ('timestamp', '<f8'),
+        ('numPersons', 'u1'),
+        ('boxes', '<f2', (maxPersons, 4)),
+        ('boxConf', '<f2', (maxPersons,)),
+        ('keypointsXyn', '<f2', (maxPersons, numKeypoints, 2)),
+        ('keypointsConf', '<f2', (maxPersons, numKeypoints)),
+    ])
+
+
+def listSegments(storeFolderPath):
+    """
+    This function returns the segment files of the store sorted by start time.
+    Returns list of tuples (filePath, maxPersons).
+    """
+    segments = []
+    if not os.path.exists(storeFolderPath):
+        return segments
+    for fileName in sorted(os.listdir(storeFolderPath)):
+        segmentMatch = re.match(r'^keypoints_\d{8}_\d{6}_\d+_p(\d+)\.bin$', fileName)
+        if segmentMatch:
+            segments.append((os.path.join(storeFolderPath, fileName), int(segmentMatch.group(1))))
+    return segments
+
+
+def loadRecords(storeFolderPath=None, timeFrom=None, timeTo=None):
+    """
+    This function returns all stored records as NumPy arrays of person 0, the person used by the counter.
+    Segments are opened as memmaps, only the needed fields are copied.
+    Returns dictionary with frameIndex, timestamp, noseRelativeHeight, noseConf (all shape (F,)).
+
+    storeFolderPath: string
+        Folder of the store, from config if not given
+    timeFrom, timeTo: float
+        Optional time range as seconds since epoch
+    """
+    if storeFolderPath is None:
+        storeFolderPath = conf.base.keypointStoreFolderPath
+    fields = {'frameIndex': [], 'timestamp': [], 'noseRelativeHeight': [], 'noseConf': []}
+    for filePath, maxPersons in listSegments(storeFolderPath):
+        recordDtype = getRecordDtype(maxPersons)
+        # A crash may leave a partial record last in the file, ignore it
+        numRecords = os.path.getsize(filePath) // recordDtype.itemsize
+        if numRecords == 0:
+            continue
+        records = np.memmap(filePath, dtype=recordDtype, mode='r', shape=(numRecords,))
+        keep = np.ones(numRecords, dtype=bool)
+        if timeFrom is not None:
+            keep &= records['timestamp'] >= timeFrom
+        if timeTo is not None:
+            keep &= records['timestamp'] <= timeTo
+        hasPerson = records['numPersons'] > 0
+        fields['frameIndex'].append(np.asarray(records['frameIndex'][keep]))
+        fields['timestamp'].append(np.asarray(records['timestamp'][keep]))
+        # Frames without person get no valid nose
+        fields['noseRelativeHeight'].append(np.where(hasPerson, records['keypointsXyn'][:, 0, 0, 1], np.nan)[keep].astype(np.float32))
+        fields['noseConf'].append(np.where(hasPerson, records['keypointsConf'][:, 0, 0], 0)[keep].astype(np.float32))
+        del records
+    for key in fields:
+        fields[key] = np.concatenate(fields[key]) if fields[key] else np.zeros((0,))
+    return fields
+
+
+def recountGrid(noseRelativeHeight, noseConf, bars, confs, band=0.0, upperBand=0.0):
+    """
+    This function counts pullups for every combination of bar height and nose confidence threshold.
+    Same hysteresis as repDetectorClass, without smoothing and minimum time between pullups:
+    among frames with a confident nose outside the band, a pullup is a frame above the bar minus upperBand
+    where the previous such frame was below the bar plus band.
+    Returns array of counts with shape (len(confs), len(bars)).
+
+    noseRelativeHeight: numpy array (F,)
+        Relative height of the nose for every frame
+    noseConf: numpy array (F,)
+        Confidence of the nose for every frame
+    bars: numpy array (B,)
+        Bar heights to try
+    confs: numpy array (C,)
+        Nose confidence thresholds to try
+    band: float
+        Hysteresis band below the bar, the nose must go below bar + band before the next pullup
+    upperBand: float
+        Distance above the bar the nose must pass for a pullup
+    """
+    bars = np.asarray(bars, dtype=np.float32)
+    confs = np.asarray(confs, dtype=np.float32)
+    counts = np.zeros((len(confs), len(bars)), dtype=np.int64)
+    numFrames = len(noseRelativeHeight)
+    if numFrames < 2:
+        return counts
+    frameNumbers = np.arange(numFrames)
+    for c, confThreshold in enumerate(confs):
+        valid = noseConf > confThreshold
+        # Label +1 below band, -1 above band, 0 inside band or no confident nose, shape (B, F)
+        below = noseRelativeHeight[None, :] > bars[:, None] + band
+        above = noseRelativeHeight[None, :] < bars[:, None] - upperBand
+        labels = np.where(valid[None, :], np.where(below, 1, np.where(above, -1, 0)), 0).astype(np.int8)
+        # Index of the last confident frame up to and including each frame, -1 if none
+        lastValid = np.maximum.accumulate(np.where(labels != 0, frameNumbers[None, :], -1), axis=1)
+        # Label of the previous confident frame before each frame
+        previousIndex = np.concatenate([np.full((len(bars), 1), -1), lastValid[:, :-1]], axis=1)
+        previousLabel = np.where(previousIndex >= 0, np.take_along_axis(labels, np.maximum(previousIndex, 0), axis=1), 0)
+        counts[c] = np.sum((labels == -1) & (previousLabel == 1), axis=1)
+    return counts
+
+
+def parseRange(text):
+    """
+    This function parses start:stop:step into an array, stop included, or a single value
+    """
+    values = [float(value) for value in text.split(':')]
+    if len(values) == 1:
+        return np.array(values)
+    start, stop, step = values
+    return np.round(np.arange(start, stop + step / 2, step), 6)
+
+
+class keypointStoreClass:
+    """
+    Class describing the writer of the store.
+    Records are appended to segment files, a new segment is started when the segment size is reached
+    and the oldest segments are deleted when the total size is above budget.
+    """
+
+    def __init__ (self, storeFolderPath=None, maxPersons=None):
+        """
+        Init function
+
+        storeFolderPath: string
+            Folder of the store, from config if not given
+        maxPersons: int
+            Number of detected persons stored per frame, from config if not given
+        """
+        if storeFolderPath is None:
+            storeFolderPath = conf.base.keypointStoreFolderPath
+        if maxPersons is None:
+            maxPersons = conf.data.keypointStoreMaxPersons
+        self.storeFolderPath = storeFolderPath
+        self.maxPersons = maxPersons
+        self.recordDtype = getRecordDtype(maxPersons)
+        # Single record reused for every append to avoid allocations
+        self.record = np.zeros(1, dtype=self.recordDtype)
+        self.file = None
+        self.segmentBytes = 0
+        self.appendsSinceFlush = 0
+        os.makedirs(self.storeFolderPath, exist_ok=True)
+
+
+    def openSegment(self):
+        """
+        This function starts a new segment file named by start time and persons per record
+        """
+        self.close()
+        now = time.time()
+        startString = time.strftime("%Y%m%d_%H%M%S", time.localtime(now)) + '_' + '%03d' % int((now % 1) * 1000)
+        filePath = os.path.join(self.storeFolderPath, 'keypoints_' + startString + '_p' + str(self.maxPersons) + '.bin')
+        self.file = open(filePath, 'ab')
+        self.segmentBytes = 0
+        self.deleteOldSegments()
+
+
+    def deleteOldSegments(self):
+        """
+        This function deletes the oldest segments while the store is above its size budget
+        """
+        segments = listSegments(self.storeFolderPath)
+        totalBytes = sum(os.path.getsize(filePath) for filePath, maxPersons in segments)
+        # Never delete the segment being written, it is the newest
+        for filePath, maxPersons in segments[:-1]:
+            if totalBytes <= conf.data.keypointStoreMaxBytes:
+                break
+            totalBytes -= os.path.getsize(filePath)
+            os.remove(filePath)
+
+
+    def append(self, frameIndex, pose, fullShape, timestamp=None):
+        """
+        This function appends the pose of one frame to the store
+
+        frameIndex: int
+            Index of the frame in the stream
+        pose: dict
+            Full frame pose from getFullFramePose
+        fullShape: tuple
+            Shape (height, width) of the full frame, used to store boxes relative to the frame
+        timestamp: float
+            Time of the frame as seconds since epoch, now if not given
+        """
+        numPersons = min(len(pose['keypointsXyn']), self.maxPersons)
+        if numPersons == 0 and conf.data.keypointStoreSkipEmpty:
+            return
+        if self.file is None or self.segmentBytes >= conf.data.keypointStoreSegmentBytes:
+            self.openSegment()
+        fullHeight, fullWidth = fullShape[:2]
+        record = self.record[0]
+        record['frameIndex'] = frameIndex
+        record['timestamp'] = time.time() if timestamp is None else timestamp
+        record['numPersons'] = numPersons
+        # Clear persons from previous record before filling in this one
+        record['boxes'] = 0
+        record['boxConf'] = 0
+        record['keypointsXyn'] = 0
+        record['keypointsConf'] = 0
+        if numPersons > 0:
+            record['boxes'][:numPersons] = pose['boxes'][:numPersons] / np.array([fullWidth, fullHeight, fullWidth, fullHeight], dtype=np.float32)
+            record['boxConf'][:numPersons] = pose['boxConf'][:numPersons]
+            record['keypointsXyn'][:numPersons] = pose['keypointsXyn'][:numPersons]
+            record['keypointsConf'][:numPersons] = pose['keypointsConf'][:numPersons]
+        self.file.write(self.record.tobytes())
+        self.segmentBytes += self.recordDtype.itemsize
+        # Buffered writes, flush with regular intervals so readers see new data
+        self.appendsSinceFlush += 1
+        if self.appendsSinceFlush >= conf.data.keypointStoreFlushRecords:
+            self.file.flush()
+            self.appendsSinceFlush = 0
+
+
+    def close(self):
+        """
+        This function closes the current segment file
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def importKeypointTxt(labelsFolderPath, storeFolderPath=None):
+    """
+    This function imports keypoint txt files saved by YOLO or the live counter into the store.
+    File modification time is used as frame time. Returns number of imported frames.
+    """
+    from keypointFiles import readKeypointTxt, listKeypointTxtFiles
+    keypointStore = keypointStoreClass(storeFolderPath)
+    numImported = 0
+    for frameIndex, filePath in listKeypointTxtFiles(labelsFolderPath):
+        pose = readKeypointTxt(filePath)
+        # Coordinates in txt files are already relative, use unit frame shape
+        keypointStore.append(frameIndex, pose, (1, 1), os.path.getmtime(filePath))
+        numImported += 1
+    keypointStore.close()
+    return numImported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Re-count pullups from stored pose results for a grid of parameters')
+    parser.add_argument('--store', help='Store folder, from config if not given')
+    parser.add_argument('--import', dest='importFolder', help='Import keypoint txt files from this folder into the store first')
+    parser.add_argument('--bars', default=str(conf.data.barRelativeHight), help='Bar heights, value or start:stop:step')
+    parser.add_argument('--confs', default=str(conf.data.noseConfidenceThreshold), help='Nose confidence thresholds, value or start:stop:step')
+    parser.add_argument('--band', type=float, default=conf.data.repHysteresisBand, help='Hysteresis band below the bar')
+    parser.add_argument('--upperBand', type=float, default=conf.data.repUpperBand, help='Distance above the bar the nose must pass')
+    parser.add_argument('--from', dest='timeFrom', help='Only frames from this time, YYYY-mm-dd HH:MM:SS')
+    parser.add_argument('--to', dest='timeTo', help='Only frames up to this time, YYYY-mm-dd HH:MM:SS')
+    parser.add_argument('--truth', type=int, help='True number of pullups, the closest parameters are printed')
+    args = parser.parse_args()
+
+    if args.importFolder:
+        print('Imported ' + str(importKeypointTxt(args.importFolder, args.store)) + ' frames')
+    timeFrom = time.mktime(time.strptime(args.timeFrom, "%Y-%m-%d %H:%M:%S")) if args.timeFrom else None
+    timeTo = time.mktime(time.strptime(args.timeTo, "%Y-%m-%d %H:%M:%S")) if args.timeTo else None
+    loadStart = time.perf_counter()
+    records = loadRecords(args.store, timeFrom, timeTo)
+    print('Loaded ' + str(len(records['frameIndex'])) + ' frames in ' + '{:.2f}'.format(time.perf_counter() - loadStart) + ' s')
+    bars = parseRange(args.bars)
+    confs = parseRange(args.confs)
+    countStart = time.perf_counter()
+    counts = recountGrid(records['noseRelativeHeight'], records['noseConf'], bars, confs, args.band, args.upperBand)
+    print('Counted ' + str(counts.size) + ' parameter combinations in ' + '{:.2f}'.format(time.perf_counter() - countStart) + ' s')
+    # Print table with confidence thresholds as rows and bar heights as columns
+    print('conf \\ bar ' + ' '.join('%6.3f' % bar for bar in bars))
+    for c, confThreshold in enumerate(confs):
+        print('%10.2f ' % confThreshold + ' '.join('%6d' % count for count in counts[c]))
+    if args.truth is not None:
+        c, b = np.unravel_index(np.argmin(np.abs(counts - args.truth)), counts.shape)
+        print('Closest to ' + str(args.truth) + ' pullups: bar ' + str(bars[b]) + ', confidence ' + str(confs[c]) + ' gives ' + str(counts[c, b]))
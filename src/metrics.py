@@ -0,0 +1,327 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Latency histograms and counters for the counting pipeline.
+# Stages report their latency to the shared registry, counters of the capture,
+# scheduler and other parts are collected when metrics are read. Metrics are
+# served in Prometheus text format on a local HTTP /metrics endpoint and can be
+# dumped to a json file in data/ with regular intervals.
+# *********************************************************************************
+import bisect
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+# Load modules
+from commonConfig import commonConfigClass
+from statePersistence import writeFileAtomic
+conf = commonConfigClass()
+
+
+class metricsRegistryClass:
+    """
+    Class describing the latency histograms and counter collectors.
+    When disabled every call returns directly so the overhead in the frame loop is negligible.
+    """
+
+    def __init__ (self, enabled=None, bucketsMs=None):
+        """
+        Init function
+
+        enabled: bool
+            Collect metrics, from config if not given
+        bucketsMs: list
+            Upper bounds in milliseconds of the histogram buckets, from config if not given
+        """
+        self.enabled = conf.data.metricsEnabled if enabled is None else enabled
+        self.bucketsMs = sorted(conf.data.metricsBucketsMs if bucketsMs is None else bucketsMs)
+        self.lock = threading.Lock()
+        # Histogram per stage with bucket counts, sum, count, max and recent observation times for the rate
+        self.histograms = {}
+        self.counters = {}
+        # Functions returning a dict of numbers, called when metrics are read
+        self.collectors = {}
+        self.startTime = time.time()
+
+
+    def observe(self, stageName, elapsedMs):
+        """
+        This function adds the latency of one call of a stage to its histogram
+
+        stageName: string
+            Name of the stage, for example decode or inference
+        elapsedMs: float
+            Latency in milliseconds
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(stageName)
+            if histogram is None:
+                histogram = {'buckets': [0] * (len(self.bucketsMs) + 1), 'sum': 0.0, 'count': 0, 'max': 0.0, 'times': deque(maxlen=conf.data.metricsRateWindow)}
+                self.histograms[stageName] = histogram
+            histogram['buckets'][bisect.bisect_left(self.bucketsMs, elapsedMs)] += 1
+            histogram['sum'] += elapsedMs
+            histogram['count'] += 1
+            histogram['max'] = max(histogram['max'], elapsedMs)
+            histogram['times'].append(time.perf_counter())
+
+
+    def increment(self, counterName, value=1):
+        """
+        This function adds to a counter
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[counterName] = self.counters.get(counterName, 0) + value
+
+
+    def registerCollector(self, collectorName, function):
+        """
+        This function registers a function returning a dict of numbers, for example the counters of the capture.
+        Nested dicts are flattened with the keys joined by a dot.
+        """
+        with self.lock:
+            self.collectors[collectorName] = function
+
+
+    def unregisterCollector(self, collectorName):
+        """
+        This function removes a collector
+        """
+        with self.lock:
+            self.collectors.pop(collectorName, None)
+
+
+    def getRate(self, times):
+        """
+        This function returns calls per second from the recent observation times of a stage
+        """
+        if len(times) < 2 or times[-1] <= times[0]:
+            return 0.0
+        return (len(times) - 1) / (times[-1] - times[0])
+
+
+    def flatten(self, values, prefix=''):
+        """
+        This function flattens nested dicts of numbers, bools are converted to 0 or 1 and other values are skipped
+        """
+        flatValues = {}
+        for key, value in values.items():
+            key = prefix + str(key)
+            if isinstance(value, dict):
+                flatValues.update(self.flatten(value, key + '.'))
+            elif isinstance(value, (bool, int, float)):
+                flatValues[key] = float(value)
+        return flatValues
+
+
+    def getSnapshot(self):
+        """
+        This function returns all metrics as a dictionary
+        """
+        with self.lock:
+            collectors = dict(self.collectors)
+            snapshot = {'uptimeSeconds': time.time() - self.startTime, 'counters': dict(self.counters), 'stages': {}, 'collectors': {}}
+            for stageName, histogram in self.histograms.items():
+                snapshot['stages'][stageName] = {
+                    'count': histogram['count'],
+                    'sumMs': histogram['sum'],
+                    'meanMs': histogram['sum'] / histogram['count'] if histogram['count'] > 0 else 0.0,
+                    'maxMs': histogram['max'],
+                    'ratePerSecond': self.getRate(histogram['times']),
+                    'buckets': list(histogram['buckets']),
+                }
+        # Collectors are called without the lock, they take their own locks
+        for collectorName, function in collectors.items():
+            try:
+                snapshot['collectors'][collectorName] = self.flatten(function())
+            except Exception as e:
+                print('Failed to collect metrics from ' + collectorName)
+                print(e)
+        return snapshot
+
+
+    def getPrometheusText(self):
+        """
+        This function returns all metrics in Prometheus text format
+        """
+        snapshot = self.getSnapshot()
+        lines = ['# TYPE pullup_uptime_seconds gauge', 'pullup_uptime_seconds ' + str(snapshot['uptimeSeconds'])]
+        lines.append('# TYPE pullup_stage_latency_ms histogram')
+        for stageName, stage in snapshot['stages'].items():
+            cumulative = 0
+            for upperBound, bucketCount in zip(self.bucketsMs + ['+Inf'], stage['buckets']):
+                cumulative += bucketCount
+                lines.append('pullup_stage_latency_ms_bucket{stage="' + stageName + '",le="' + str(upperBound) + '"} ' + str(cumulative))
+            lines.append('pullup_stage_latency_ms_sum{stage="' + stageName + '"} ' + str(stage['sumMs']))
+            lines.append('pullup_stage_latency_ms_count{stage="' + stageName + '"} ' + str(stage['count']))
+        lines.append('# TYPE pullup_stage_rate_per_second gauge')
+        for stageName, stage in snapshot['stages'].items():
+            lines.append('pullup_stage_rate_per_second{stage="' + stageName + '"} ' + str(stage['ratePerSecond']))
+        lines.append('# TYPE pullup_events_total counter')
+        for counterName, value in snapshot['counters'].items():
+            lines.append('pullup_events_total{event="' + counterName + '"} ' + str(value))
+        lines.append('# TYPE pullup_component gauge')
+        for collectorName, values in snapshot['collectors'].items():
+            for key, value in values.items():
+                lines.append('pullup_component{component="' + collectorName + '",key="' + key + '"} ' + str(value))
+        return '\n'.join(lines) + '\n'
+
+
+# Registry shared by all modules
+metricsRegistry = metricsRegistryClass()
+
+
+class startupTimerClass:
+    """
+    Class describing the timing of the startup phases, logged and kept in the metrics registry
+    """
+
+    def __init__ (self):
+        """
+        Init function, the startup is timed from here
+        """
+        self.startTime = time.perf_counter()
+        self.lastTime = self.startTime
+        self.phases = []
+        self.firstRepLogged = False
+
+
+    def mark(self, phaseName):
+        """
+        This function logs the time of a finished startup phase
+
+        phaseName: string
+            Name of the phase that has just finished
+        """
+        now = time.perf_counter()
+        elapsedMs = (now - self.lastTime) * 1000
+        self.lastTime = now
+        self.phases.append((phaseName, elapsedMs))
+        metricsRegistry.observe('startup.' + phaseName, elapsedMs)
+        print('Startup ' + phaseName + ' took ' + '{:.0f}'.format(elapsedMs) + ' ms, ' + '{:.1f}'.format(now - self.startTime) + ' s since start')
+
+
+    def markFirstRep(self):
+        """
+        This function logs the time from start to the first counted pullup, only once
+        """
+        if self.firstRepLogged:
+            return
+        self.firstRepLogged = True
+        seconds = time.perf_counter() - self.startTime
+        metricsRegistry.observe('startup.firstRep', seconds * 1000)
+        print('First pullup counted ' + '{:.1f}'.format(seconds) + ' s after start')
+
+
+class metricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Class describing the HTTP handler serving /metrics (Prometheus text) and /metrics.json
+    """
+
+    def do_GET(self):
+        """
+        This function answers a GET request
+        """
+        if self.path == '/metrics':
+            body = metricsRegistry.getPrometheusText().encode('utf-8')
+            contentType = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(metricsRegistry.getSnapshot()).encode('utf-8')
+            contentType = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        """
+        This function silences the log line printed for every request
+        """
+        return
+
+
+class metricsExporterClass:
+    """
+    Class describing the HTTP server and the periodic json dump of the metrics registry
+    """
+
+    def __init__ (self, port=None, dumpInterval=None):
+        """
+        Init function
+
+        port: int
+            Port of the HTTP server, 0 disables the server
+        dumpInterval: float
+            Interval in seconds for writing the metrics to json file, 0 disables the dump
+        """
+        self.port = conf.data.metricsPort if port is None else port
+        self.dumpInterval = conf.data.metricsDumpInterval if dumpInterval is None else dumpInterval
+        self.server = None
+        self.serverThread = None
+        self.dumpThread = None
+        self.stopEvent = threading.Event()
+
+
+    def start(self):
+        """
+        This function starts the HTTP server and the dump thread if enabled
+        """
+        if not metricsRegistry.enabled:
+            return
+        if self.port > 0:
+            try:
+                self.server = ThreadingHTTPServer((conf.data.metricsHost, self.port), metricsRequestHandler)
+                self.server.daemon_threads = True
+                self.serverThread = threading.Thread(target=self.server.serve_forever, name='pullupMetricsServer', daemon=True)
+                self.serverThread.start()
+                print('Metrics served on http://' + conf.data.metricsHost + ':' + str(self.port) + '/metrics')
+            except OSError as e:
+                print('Failed to start metrics server')
+                print(e)
+                self.server = None
+        if self.dumpInterval > 0:
+            self.stopEvent.clear()
+            self.dumpThread = threading.Thread(target=self.worker, name='pullupMetricsDump', daemon=True)
+            self.dumpThread.start()
+
+
+    def stop(self):
+        """
+        This function stops the HTTP server and writes a last dump
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.dumpThread is not None:
+            self.stopEvent.set()
+            self.dumpThread.join(5.0)
+            self.dumpThread = None
+            self.dump()
+
+
+    def dump(self):
+        """
+        This function writes the metrics to the json file in data/
+        """
+        try:
+            writeFileAtomic(conf.base.metricsFilePath, json.dumps(metricsRegistry.getSnapshot()))
+        except Exception as e:
+            print('Failed to write metrics to file')
+            print(e)
+
+
+    def worker(self):
+        """
+        This function dumps the metrics with regular intervals until stopped
+        """
+        while not self.stopEvent.wait(self.dumpInterval):
+            self.dump()
@@ -0,0 +1,163 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Selection of inference backend for the pose model.
+# The PyTorch weights can be exported once to ONNX or OpenVINO (optionally INT8)
+# and the exported model is cached on disk for following starts.
+# *********************************************************************************
+import os
+import shutil
+import threading
+import time
+import numpy as np
+# Load modules
+from commonConfig import commonConfigClass
+conf = commonConfigClass()
+
+
+def getModelArtifactPath(weightsName, backend, quantize):
+    """
+    This function returns the path of the cached exported model for a backend.
+
+    weightsName: string
+        Name of the PyTorch weights, for example yolov8n-pose.pt
+    backend: string
+        'onnx' or 'openvino'
+    quantize: bool
+        INT8 quantized model (OpenVINO only)
+    """
+    modelName = os.path.splitext(weightsName)[0]
+    # Input size is part of the name, an export is only valid for the size it was made for
+    modelName = modelName + '_' + str(conf.data.inferenceSize)
+    if backend == 'onnx':
+        return os.path.join(conf.base.modelCacheFolderPath, modelName + '.onnx')
+    if quantize:
+        return os.path.join(conf.base.modelCacheFolderPath, modelName + '_int8_openvino_model')
+    return os.path.join(conf.base.modelCacheFolderPath, modelName + '_openvino_model')
+
+
+def exportModel(weightsName, backend, quantize, artifactPath):
+    """
+    This function exports the PyTorch weights to a backend and moves the result to the model cache.
+    Dynamic input size is used so cropped regions of interest can be inferred.
+    """
+    from ultralytics import YOLO
+    print('Exporting ' + weightsName + ' to ' + backend + ', this is only done once')
+    os.makedirs(conf.base.modelCacheFolderPath, exist_ok=True)
+    model = YOLO(weightsName)
+    if backend == 'openvino' and quantize:
+        # INT8 quantization needs a small calibration data set
+        exportedPath = model.export(format='openvino', imgsz=conf.data.inferenceSize, dynamic=True, int8=True, data=conf.data.inferenceQuantizeData)
+    else:
+        exportedPath = model.export(format=backend, imgsz=conf.data.inferenceSize, dynamic=True)
+    # Export is written next to the weights, move it to the cache folder that is kept between starts
+    if os.path.exists(artifactPath):
+        if os.path.isdir(artifactPath):
+            shutil.rmtree(artifactPath)
+        else:
+            os.remove(artifactPath)
+    shutil.move(str(exportedPath), artifactPath)
+    return artifactPath
+
+
+def loadPoseModel():
+    """
+    This function loads the pose model for the configured backend, exporting it first if it is not cached.
+    Falls back to the PyTorch weights if export or loading of the backend fails.
+    Returns tuple (model, backend).
+    """
+    # ultralytics is slow to import, it is imported here so it can be done on the model loader thread
+    from ultralytics import YOLO
+    weightsName = 'yolov8' + conf.data.yoloModel + '-pose.pt'
+    backend = conf.data.inferenceBackend
+    assert backend in ['pytorch', 'onnx', 'openvino'], 'Inference backend is not in the list [pytorch, onnx, openvino]'
+    if backend == 'pytorch':
+        return YOLO(weightsName), backend
+    quantize = conf.data.inferenceQuantize and backend == 'openvino'
+    if conf.data.inferenceQuantize and not quantize:
+        print('INT8 quantization is only supported for the openvino backend, using float model')
+    artifactPath = getModelArtifactPath(weightsName, backend, quantize)
+    try:
+        if not os.path.exists(artifactPath):
+            exportModel(weightsName, backend, quantize, artifactPath)
+        else:
+            print('Using cached ' + backend + ' model ' + artifactPath)
+        return YOLO(artifactPath, task='pose'), backend
+    except Exception as e:
+        print('Failed to use ' + backend + ' backend, using pytorch')
+        print(e)
+        return YOLO(weightsName), 'pytorch'
+
+
+def measureModelLatency(model, backend, frameShape=(480, 640, 3)):
+    """
+    This function runs inference on a dummy frame and prints the latency of the backend.
+    The first inferences also warm up the model. Returns mean latency in milliseconds.
+
+    model: ultralytics YOLO
+        Loaded pose model
+    backend: string
+        Name of the backend, used for printing
+    frameShape: tuple
+        Shape of the dummy frame (height, width, channels)
+    """
+    dummyFrame = np.zeros(frameShape, dtype=np.uint8)
+    latencies = []
+    for i in range(conf.data.backendBenchmarkFrames):
+        inferenceStart = time.perf_counter()
+        model(dummyFrame, device="CPU", imgsz=conf.data.inferenceSize, verbose=False)
+        latencies.append((time.perf_counter() - inferenceStart) * 1000)
+    if not latencies:
+        return 0.0
+    # First inference includes setup of the backend and is reported separately
+    meanLatency = float(np.mean(latencies[1:])) if len(latencies) > 1 else latencies[0]
+    print('Backend ' + backend + ': first inference ' + '{:.1f}'.format(latencies[0]) + ' ms, mean ' + '{:.1f}'.format(meanLatency) + ' ms')
+    return meanLatency
+
+
+class modelLoaderClass:
+    """
+    Class describing loading and warm up of the pose model on a background thread.
+    Model loading overlaps with connecting to the stream and loading state at startup.
+    """
+
+    def __init__ (self):
+        """
+        Init function
+        """
+        self.model = None
+        self.backend = None
+        self.error = None
+        self.thread = None
+
+
+    def start(self):
+        """
+        This function starts loading the model
+        """
+        self.thread = threading.Thread(target=self.worker, name='pullupModelLoader', daemon=True)
+        self.thread.start()
+
+
+    def worker(self):
+        """
+        This function loads the model and runs warm up inferences on a dummy frame
+        """
+        try:
+            model, backend = loadPoseModel()
+            measureModelLatency(model, backend)
+            self.model, self.backend = model, backend
+        except Exception as e:
+            self.error = e
+
+
+    def get(self):
+        """
+        This function waits until the model is loaded and warmed up. Returns tuple (model, backend).
+        Raises the exception from loading if it failed.
+        """
+        if self.thread is None:
+            self.start()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.model, self.backend
@@ -0,0 +1,140 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Motion gated idle mode in front of the pose model.
+# While idle a downscaled frame difference near the bar is checked instead of
+# running pose inference. Inference starts when motion is found and stops after
+# a quiet period without motion or detected athlete. The state is written to a
+# txt file for Home Assistant.
+# *********************************************************************************
+import time
+import cv2
+# Load modules
+from commonConfig import commonConfigClass
+from statePersistence import writeFileAtomic
+conf = commonConfigClass()
+
+
+class motionGateClass:
+    """
+    Class describing the idle and active state of the counter.
+    """
+
+    def __init__ (self, barRelativeHight=None, stateFilePath=None):
+        """
+        Init function
+
+        barRelativeHight: float
+            Relative height of the bar in the image, from config if not given
+        stateFilePath: string
+            File the state is written to for Home Assistant, from config if not given
+        """
+        self.barRelativeHight = conf.data.barRelativeHight if barRelativeHight is None else barRelativeHight
+        self.stateFilePath = conf.base.activityStateFilePath if stateFilePath is None else stateFilePath
+        # Start active so an athlete already at the bar is counted
+        self.state = 'active'
+        self.lastActivityTime = time.time()
+        self.lastCheckTime = 0.0
+        # Downscaled gray frame of the previous motion check
+        self.previousSmall = None
+        self.counters = {'checks': 0, 'activations': 0, 'idleFrames': 0}
+        self.writeState()
+
+
+    def writeState(self):
+        """
+        This function writes the state to file for Home Assistant
+        """
+        try:
+            writeFileAtomic(self.stateFilePath, self.state)
+        except Exception as e:
+            print('Failed to write activity state to file')
+            print(e)
+
+
+    def setState(self, state):
+        """
+        This function changes the state and writes it to file
+        """
+        if state == self.state:
+            return
+        print('Pullup counter is ' + state)
+        self.state = state
+        if state == 'active':
+            self.counters['activations'] += 1
+        self.writeState()
+
+
+    def getMotionShare(self, frame):
+        """
+        This function returns the share of changed pixels near the bar since the previous check.
+        The frame is downscaled and blurred first so the check costs very little CPU.
+
+        frame: numpy array
+            Full frame
+        """
+        fullHeight, fullWidth = frame.shape[:2]
+        smallWidth = conf.data.motionFrameWidth
+        smallHeight = max(1, int(fullHeight * smallWidth / fullWidth))
+        small = cv2.resize(frame, (smallWidth, smallHeight), interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        small = cv2.GaussianBlur(small, (5, 5), 0)
+        previousSmall = self.previousSmall
+        self.previousSmall = small
+        if previousSmall is None or previousSmall.shape != small.shape:
+            return 0.0
+        # Rows from above the bar down to where the athlete stands below it
+        rowFrom = max(0, int((self.barRelativeHight - conf.data.motionBandAbove) * smallHeight))
+        rowTo = min(smallHeight, int((self.barRelativeHight + conf.data.motionBandBelow) * smallHeight))
+        if rowTo <= rowFrom:
+            return 0.0
+        difference = cv2.absdiff(small[rowFrom:rowTo], previousSmall[rowFrom:rowTo])
+        changed = cv2.countNonZero(cv2.threshold(difference, conf.data.motionPixelThreshold, 255, cv2.THRESH_BINARY)[1])
+        return changed / float(difference.size)
+
+
+    def update(self, frame, frameTime=None):
+        """
+        This function checks for motion and returns True if the frame should go on to pose inference.
+        Motion is checked at most every data.motionCheckInterval seconds.
+
+        frame: numpy array
+            Full frame
+        frameTime: float
+            Time the frame was decoded, current time if not given
+        """
+        if not conf.data.motionGateEnabled:
+            return True
+        if frameTime is None:
+            frameTime = time.time()
+        if frameTime - self.lastCheckTime >= conf.data.motionCheckInterval:
+            self.lastCheckTime = frameTime
+            self.counters['checks'] += 1
+            if self.getMotionShare(frame) >= conf.data.motionShareThreshold:
+                self.lastActivityTime = frameTime
+                self.setState('active')
+        if self.state == 'active' and frameTime - self.lastActivityTime > conf.data.motionQuietSeconds:
+            self.setState('idle')
+        if self.state == 'idle':
+            self.counters['idleFrames'] += 1
+            return False
+        return True
+
+
+    def reportPose(self, pose, frameTime=None):
+        """
+        This function keeps the counter active while an athlete is detected
+
+        pose: dict
+            Full frame pose from getFullFramePose
+        frameTime: float
+            Time the frame was decoded, current time if not given
+        """
+        if len(pose['boxes']) > 0 and pose['boxConf'][0] >= conf.data.roiBoxConfidenceThreshold:
+            self.lastActivityTime = time.time() if frameTime is None else frameTime
+
+
+    def isActive(self):
+        """
+        This function returns True if pose inference is running
+        """
+        return self.state == 'active'
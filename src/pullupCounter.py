@@ -10,21 +10,83 @@
 # See https://docs.ultralytics.com/modes/predict/#keypoints
 # https://alimustoofaa.medium.com/yolov8-pose-estimation-and-pose-keypoint-classification-using-neural-net-pytorch-98469b924525
 # *********************************************************************************
-from ultralytics import YOLO
 import time 
 import os 
 import shutil
+import sys
 # Load modules
 from commonConfig import commonConfigClass
 from supportMethods import supportMethodsClass
+from inferenceScheduler import inferenceSchedulerClass
+from frameCapture import frameCaptureClass
+from modelBackend import modelLoaderClass
+from repCounter import repDetectorClass
+from keypointStore import keypointStoreClass
+from roiTracker import roiTrackerClass, getFullFramePose, getInferenceSize
+from multiStream import loadStreamConfigs, runMultiStream
+from inferencePool import inferencePoolClass
+from motionGate import motionGateClass
+from athleteTracker import athleteTrackerClass
+from metrics import metricsRegistry, metricsExporterClass, startupTimerClass
+# Time each startup phase and the time to the first counted pullup
+startupTimer = startupTimerClass()
+startupTimer.mark('imports')
 # Init needed class instances
 conf = commonConfigClass()          # Init config class
+conf.createFolders()                # Create data folders, not done when the config is imported
 supportMethods = supportMethodsClass()       # Functions for reading an processing data 
+startupTimer.mark('config')
+
+
+### Multi-stream mode ###
+# Several cameras and bars counted in one process with a shared model, see multiStream.py
+# Annotated video is not saved in this mode, pose results are kept in the keypoint store of each stream
+streamConfigs = loadStreamConfigs()
+if streamConfigs is not None:
+    print('Counting pullups on ' + str(len(streamConfigs)) + ' streams from ' + conf.base.pullupStreamsFilePath)
+    supportMethods.startEventDispatcher()
+    supportMethods.startControlState()
+    supportMethods.startApiServer()
+    supportMethods.startSoundServer()
+    supportMethods.startRepHistory()
+    supportMethods.startWarmUp()
+    model, backend = modelLoaderClass().get()
+    startupTimer.mark('model')
+    metricsExporter = metricsExporterClass()
+    metricsExporter.start()
+    runMultiStream(streamConfigs, model, supportMethods)
+    metricsExporter.stop()
+    supportMethods.stopEventDispatcher()
+    supportMethods.stopApiServer()
+    supportMethods.stopSoundServer()
+    supportMethods.stopRepHistory()
+    sys.exit(0)
+
+
+### Inference worker processes ###
+# Each worker holds its own model, frames are handed over in shared memory
+# Workers are forked and must therefore be started before any other thread
+inferencePool = None
+if conf.data.inferenceWorkers > 0:
+    inferencePool = inferencePoolClass()
+    inferencePool.start()
+    startupTimer.mark('inferenceWorkers')
+
+# Load a pretrained YOLOv8n pose model (n=nano version, around 100 ms inference time on CPU with 4 cores for a i5-6200U CPU @ 2.30GHz, 480x640 image)
+# Exported to ONNX or OpenVINO if selected in config, report latency of the backend
+# Loaded and warmed up on a background thread while the state is loaded and the stream is connected
+# Not needed in the main process when the inference workers hold the models
+modelLoader = None
+if inferencePool is None:
+    modelLoader = modelLoaderClass()
+    modelLoader.start()
 
 
 ### Init needed values ###
-# Init the pullup counter
-pullupCounts = 0
+# Load logged pullup count, from the state record or the legacy count file
+# The state is written atomically in the background from now on
+pullupCounts = supportMethods.loadPullupState()
+print('Pullup count from existing file is ' + str(pullupCounts))
 # Reset the time points for first pullup
 pullupTimeFirst = 'Reset'
 pullupTimeLast = 'Reset'
@@ -37,29 +99,12 @@ beenUp = False
 
 
 ### Main ###
-# Create file for storing pullup counts 
-# Create new pullup count file if it does not exist
-if not os.path.exists(conf.base.pullupCountsFilePath):
-    with open(conf.base.pullupCountsFilePath, 'w') as f:
-        f.write('0')
-else:
-    # Read logged pullup count from existing file
-    with open(conf.base.pullupCountsFilePath, 'r') as f:
-        pullupCounts = int(f.read())
-        print('Pullup count from existing file is ' + str(pullupCounts))
-
-# Check if video stream save folder exist
-# It is created automatically by YOLOv8n pose estimation
-# and should therefore be deleted before starting the script
-if os.path.exists(conf.base.streamSaveFolderPath):
-    print('Stream save folder existed as ' + conf.base.streamSaveFolderPath)
-    # Remove it
-    shutil.rmtree(conf.base.streamSaveFolderPath)
-    print('Stream save folder was deleted')
-    print(' ')
-else: 
-    print(conf.base.streamSaveFolderPath + ' does not exist')
-    print('Will be created by YOLOv8n pose estimation later')
+# Video segments of earlier runs are kept within the disk budget by the recorder
+# Keypoint txt files are named by frame index and are therefore deleted before starting the script
+labelsFolderPath = os.path.join(conf.base.streamSaveFolderPath, 'labels')
+if os.path.exists(labelsFolderPath):
+    shutil.rmtree(labelsFolderPath)
+    print('Keypoint txt files of earlier run were deleted from ' + labelsFolderPath)
     print(' ')
 
 # Determine video source
@@ -71,42 +116,160 @@ if (conf.data.videoSource == 'stream'):
 else:
     source = '0'
 
-# Load a pretrained YOLOv8n pose model (n=nano version, around 100 ms inference time on CPU with 4 cores for a i5-6200U CPU @ 2.30GHz, 480x640 image)
-model = YOLO('yolov8' + conf.data.yoloModel + '-pose.pt')
-# Run inference on the source
-results = model(source, stream=True, show=conf.data.showStream, save=conf.data.saveStream, device="CPU", show_labels=True, show_conf=True, show_boxes=True, project=os.path.join(conf.base.scriptPath, 'data'), name=conf.base.streamSaveFolderName, save_conf=conf.data.saveConf, save_txt=conf.data.saveTxt) #generator of Results objects
+# Start background handling of SONOS, chime and file updates so they never stall the frame loop
+supportMethods.startEventDispatcher()
+# Start watching Home Assistant settings, operation mode changes take effect without restart
+supportMethods.startControlState()
+# Serve count and settings and push pullup events to Home Assistant, the txt files are still written
+apiServer = supportMethods.startApiServer()
+# Serve the sound files to SONOS from memory instead of an external webserver
+supportMethods.startSoundServer()
+# Record every pullup for daily and weekly totals, sessions and rest times
+supportMethods.startRepHistory()
+# Build the sound catalog, load the first sound and find the SONOS speaker in the background
+supportMethods.startWarmUp()
+startupTimer.mark('services')
 
-# Check if nose is above or below bar and add to pullup counter
-for r in results:
+# Decode the source on its own thread, reopened with backoff if it fails
+# Webcam is opened by index, stream by URL
+capture = frameCaptureClass(0 if source == '0' else source.strip(), live=True)
+capture.start()
+startupTimer.mark('captureStart')
+# Scheduler adapting inference rate to model latency
+scheduler = inferenceSchedulerClass()
+# Region of interest around the athlete to reduce inference cost
+roiTracker = roiTrackerClass()
+# Binary store of pose results, see keypointStore.py for re-counting
+keypointStore = keypointStoreClass() if conf.data.keypointStoreEnabled else None
+# Stateful pullup detector with smoothing and hysteresis
+repDetector = repDetectorClass()
+# Lock onto the athlete under the bar so other persons in the frame are not counted
+athleteTracker = athleteTrackerClass()
+# Idle mode without pose inference when there is no motion near the bar
+motionGate = motionGateClass()
+# Counters of each part collected when metrics are read, served on /metrics and dumped to data/
+metricsRegistry.registerCollector('capture', lambda: capture.counters)
+metricsRegistry.registerCollector('scheduler', scheduler.getMetrics)
+metricsRegistry.registerCollector('roi', lambda: roiTracker.counters)
+metricsRegistry.registerCollector('motionGate', lambda: motionGate.counters)
+metricsRegistry.registerCollector('athleteTracker', lambda: athleteTracker.counters)
+if inferencePool is not None:
+    metricsRegistry.registerCollector('inferencePool', lambda: inferencePool.counters)
+metricsExporter = metricsExporterClass()
+metricsExporter.start()
+if apiServer is not None:
+    apiServer.registerStateProvider('activity', lambda: motionGate.state)
+# Wait for the model loaded in the background, the stream has been connecting meanwhile
+if modelLoader is not None:
+    model, backend = modelLoader.get()
+    startupTimer.mark('model')
 
-    # For debugging and checking update interval
+# Check if nose is above or below bar and add to pullup counter
+while True:
+    # Wait for the newest decoded frame, older frames are dropped by the capture
+    # Wait shortly when inference workers are used so their results are collected without delay
+    frame, frameIndex, frameTime = capture.getLatest(1.0 if inferencePool is None else 0.01)
+    # Results of inferred frames, in frame order
+    results = inferencePool.getResults() if inferencePool is not None else []
+    if inferencePool is not None and not inferencePool.hasWorkers():
+        # All inference workers have died, infer in this process from now on
+        print('No inference workers left, running inference in the main process')
+        print('Frames handled by inference workers: ' + str(inferencePool.counters))
+        metricsRegistry.increment('inferencePoolFallback')
+        metricsRegistry.unregisterCollector('inferencePool')
+        inferencePool.stop()
+        inferencePool = None
+        model, backend = modelLoaderClass().get()
+    if frame is None and len(results) == 0:
+        if capture.isFinished() and (inferencePool is None or inferencePool.isIdle()):
+            print('No more frames from source')
+            break
+        continue
+    # For debugging and checking update interval, once per loop so idle mode and inference rate do not change it
     if conf.data.operationMode == 'simulate':
-        # Simulate a pullup every second
+        # Simulate a pullup every 2 seconds
         time.sleep(2)
         pullupCounts, beenUp, beenDown = supportMethods.pullupCounterAdd(pullupCounts, True, True)
+    if frame is not None:
+        wasActive = motionGate.isActive()
+        inferFrame = motionGate.update(frame, frameTime)
+        if inferFrame and not wasActive:
+            # Athlete must start below the bar and is searched for in the full frame after idle
+            repDetector.reset()
+            roiTracker.lastBox = None
+            athleteTracker.reset()
+    if frame is not None and inferFrame and scheduler.shouldInfer():
+        # Run inference on the newest frame, cropped around the athlete and bar if found before
+        inferenceStart = time.perf_counter()
+        region, offset = roiTracker.getCrop(frame)
+        if inferencePool is not None:
+            # Frame is copied to shared memory, dropped if all workers are busy
+            inferencePool.submit(region, frameIndex, frameTime, offset, frame.shape, getInferenceSize(region))
+        else:
+            r = model(region, device="CPU", imgsz=getInferenceSize(region), verbose=False)[0]
+            # Map keypoints back to full frame coordinates
+            pose = getFullFramePose(r, offset, frame.shape)
+            results.append({'frameIndex': frameIndex, 'frameTime': frameTime, 'offset': offset, 'fullShape': frame.shape,
+                            'pose': pose, 'latency': time.perf_counter() - inferenceStart, 'speed': r.speed, 'r': r, 'frame': frame})
+
+    for result in results:
+        # Workers run in parallel, the scheduler sees the latency per frame of the pool
+        scheduler.reportInference(result['latency'] if inferencePool is None else result['latency'] / inferencePool.numWorkers)
+        # Rate of the inference stage is the model fps
+        metricsRegistry.observe('inference', result['latency'] * 1000)
+        for speedName, speedMs in result.get('speed', {}).items():
+            if speedMs is not None:
+                metricsRegistry.observe('model.' + speedName, speedMs)
+        pose = result['pose']
+        if pose is None:
+            continue
+        # Athlete first, the region of interest, keypoint store and counter use the first person
+        pose = athleteTracker.update(pose, result['fullShape'])
+        # Follow the athlete and stay active while detected
+        roiTracker.update(pose)
+        motionGate.reportPose(pose, result['frameTime'])
+        # Save annotated video, show stream and save keypoints as configured
+        stageStart = time.perf_counter()
+        supportMethods.saveAnnotatedFrame(result.get('r'), result['frameIndex'], pose, result.get('frame'), result['offset'], result['fullShape'], result['frameTime'])
+        metricsRegistry.observe('annotate', (time.perf_counter() - stageStart) * 1000)
+        # Keep pose results for re-counting with other thresholds without running the model
+        if keypointStore is not None:
+            stageStart = time.perf_counter()
+            keypointStore.append(result['frameIndex'], pose, result['fullShape'], result['frameTime'])
+            metricsRegistry.observe('keypointStore', (time.perf_counter() - stageStart) * 1000)
+
+        # Main object detection block
+        # Check if head passes the bar from below, see repCounter for the logic
+        stageStart = time.perf_counter()
+        repEvent = repDetector.update(pose, result['frameTime'], result['frameIndex'])
+        metricsRegistry.observe('repDetection', (time.perf_counter() - stageStart) * 1000)
+        if repDetector.headRelativeHeight is not None:
+            # Raise inference rate when the head is close to the bar
+            scheduler.reportNose(repDetector.headRelativeHeight)
+        if repEvent is not None:
+            print('Pullup done, highest relative head position was ' + '{:.3f}'.format(repEvent['peakHeight']))
+            # Keep the video around the pullup if only pullups are recorded
+            supportMethods.markVideoRep(repEvent['timestamp'])
+            # Add to the pullup counter
+            pullupCounts, beenUp, beenDown = supportMethods.pullupCounterAdd(pullupCounts, True, True, repEvent)
+            startupTimer.markFirstRep()
 
-    # Video file for saving size should not be too big, make sure it is deleted with regular intervals.    
-    supportMethods.deleteVideoWhenNeeded(os.path.join(conf.base.streamSaveFolderPath, conf.base.streamSaveFileName))
-
-    # Main object detection block
-    # Nose is object 0 in the COCO list of keypoints
-    # Get the confidence of the nose and relative coordinates in the image
-    # Wrap in try/except to avoid error when no keypoints are detected
-    try: 
-        noseConf = r.keypoints.conf[0][0].numpy()
-        relCoord = r.keypoints.xyn[0][0].numpy()
-        # Check if nose is detected (confidence above 0.5)
-        if (noseConf > conf.data.noseConfidenceThreshold):
-            # Check if pullup is above set relative threshold
-            if (relCoord[1] >= conf.data.barRelativeHight):
-                # Set flag
-                beenDown = True    
-            # If nose is above bar (coorinate starts at top left corner of image and goes down and right)
-            if (relCoord[1] < conf.data.barRelativeHight):
-                print('Relative coordinates of nose above bar is ' + str(relCoord[1]))
-                beenUp = True            
-                # Add to the pullup counter and reset flags back to False
-                pullupCounts, beenUp, beenDown  = supportMethods.pullupCounterAdd(pullupCounts, beenUp, beenDown)
-
-    except:
-        pass    
+# Stream has ended, let remaining pullup events finish and write the final state
+capture.stop()
+metricsExporter.stop()
+supportMethods.closeVideoRecorder()
+if keypointStore is not None:
+    keypointStore.close()
+print('Frames handled by capture: ' + str(capture.counters))
+print('Frames handled by scheduler: ' + str(scheduler.getMetrics()))
+print('Regions of interest: ' + str(roiTracker.counters))
+print('Motion gate: ' + str(motionGate.counters))
+print('Athlete tracker: ' + str(athleteTracker.counters))
+if inferencePool is not None:
+    print('Frames handled by inference workers: ' + str(inferencePool.counters))
+    inferencePool.stop()
+supportMethods.stopEventDispatcher()
+supportMethods.stopApiServer()
+supportMethods.stopPullupState()
+supportMethods.stopSoundServer()
+supportMethods.stopRepHistory()
@@ -0,0 +1,166 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Counting logic deciding when a pullup is done from pose results.
+# Shared by the live counter and the offline benchmark.
+# *********************************************************************************
+import numpy as np
+# Load modules
+from commonConfig import commonConfigClass
+conf = commonConfigClass()
+
+# COCO keypoint indices used by the detector
+keypointIndices = {'nose': 0, 'leftEye': 1, 'rightEye': 2, 'leftShoulder': 5, 'rightShoulder': 6, 'leftWrist': 9, 'rightWrist': 10}
+
+
+class repDetectorClass:
+    """
+    Class describing a stateful pullup detector with smoothing and hysteresis.
+    Head height is taken from the nose, or the eyes if the nose is not confident, of the first detected person,
+    which is the tracked athlete when athlete tracking is enabled (see athleteTracker.py).
+    A pullup is counted when the raw head height passes above the bar (minus an optional upper band) after both the
+    raw and the smoothed head height have been below the bar plus the hysteresis band. Smoothing is only used for
+    re-arming and for the scheduler, so a pullup barely over the bar is not flattened below the threshold.
+    Recent keypoints are kept in a preallocated ring buffer.
+    """
+
+    def __init__ (self, barRelativeHight=None, band=None, confidenceThreshold=None, smoothing=None, minRepSeconds=None, upperBand=None):
+        """
+        Init function, values from config if not given
+
+        barRelativeHight: float
+            Relative height of the bar in the image, 0 is the top
+        band: float
+            Hysteresis band below the bar, the head must go below bar + band before the next pullup
+        confidenceThreshold: float
+            Needed confidence of the head keypoint
+        smoothing: float
+            Weight of the newest head height in the moving average, 1 means no smoothing
+        minRepSeconds: float
+            Minimum time between two counted pullups
+        upperBand: float
+            Distance above the bar the head must pass for a pullup, 0 counts as soon as the head is above the bar
+        """
+        self.barRelativeHight = conf.data.barRelativeHight if barRelativeHight is None else barRelativeHight
+        self.band = conf.data.repHysteresisBand if band is None else band
+        self.upperBand = conf.data.repUpperBand if upperBand is None else upperBand
+        self.confidenceThreshold = conf.data.noseConfidenceThreshold if confidenceThreshold is None else confidenceThreshold
+        self.smoothing = conf.data.repSmoothing if smoothing is None else smoothing
+        self.minRepSeconds = conf.data.repMinSeconds if minRepSeconds is None else minRepSeconds
+        # Preallocated buffers, no allocations per frame
+        self.indices = np.array(list(keypointIndices.values()), dtype=np.int64)
+        self.bufferSize = conf.data.repBufferSize
+        self.keypointBuffer = np.zeros((self.bufferSize, len(self.indices), 3), dtype=np.float32)
+        self.timeBuffer = np.zeros(self.bufferSize, dtype=np.float64)
+        self.headConfBuffer = np.zeros(self.bufferSize, dtype=np.float32)
+        self.bufferPosition = 0
+        self.bufferCount = 0
+        self.reset()
+
+
+    def reset(self):
+        """
+        This function resets the state, the athlete must be below the bar before the next pullup
+        """
+        self.state = 'unknown'
+        self.headRelativeHeight = None
+        self.lastRepTime = None
+        self.downTime = None
+        self.downBufferCount = 0
+        self.peakHeight = None
+
+
+    def getHead(self, slot):
+        """
+        This function returns head height and confidence from keypoints in the ring buffer.
+        Nose is used if confident, otherwise the mean of confident eyes. Returns (None, 0) if not found.
+        """
+        keypoints = self.keypointBuffer[slot]
+        if keypoints[0, 2] > self.confidenceThreshold:
+            return float(keypoints[0, 1]), float(keypoints[0, 2])
+        eyesConfident = keypoints[1:3, 2] > self.confidenceThreshold
+        if eyesConfident.any():
+            return float(keypoints[1:3, 1][eyesConfident].mean()), float(keypoints[1:3, 2][eyesConfident].mean())
+        return None, 0.0
+
+
+    def isHanging(self, slot):
+        """
+        This function checks that confident wrists are above the shoulders, as when hanging from the bar.
+        Returns True if the wrists or shoulders are not confident, so missing keypoints never block a pullup.
+        """
+        keypoints = self.keypointBuffer[slot]
+        shoulders = keypoints[3:5]
+        wrists = keypoints[5:7]
+        shouldersConfident = shoulders[:, 2] > self.confidenceThreshold
+        wristsConfident = wrists[:, 2] > self.confidenceThreshold
+        if not shouldersConfident.any() or not wristsConfident.any():
+            return True
+        return wrists[:, 1][wristsConfident].mean() < shoulders[:, 1][shouldersConfident].mean()
+
+
+    def update(self, pose, timestamp, frameIndex=None):
+        """
+        This function adds the pose of a frame and returns a pullup event if a pullup was done, otherwise None.
+        Event is a dictionary with timestamp, frameIndex, repDuration (seconds from going below the bar),
+        peakHeight (highest head position, relative) and confidence (mean head confidence during the pullup).
+
+        pose: dict
+            Full frame pose from getFullFramePose
+        timestamp: float
+            Time of the frame in seconds
+        frameIndex: int
+            Index of the frame in the stream
+        """
+        if len(pose['keypointsXyn']) == 0:
+            return None
+        # Copy keypoints of the first person into the ring buffer
+        slot = self.bufferPosition
+        np.take(pose['keypointsXyn'][0], self.indices, axis=0, out=self.keypointBuffer[slot, :, :2])
+        np.take(pose['keypointsConf'][0], self.indices, axis=0, out=self.keypointBuffer[slot, :, 2])
+        self.timeBuffer[slot] = timestamp
+        self.bufferPosition = (slot + 1) % self.bufferSize
+        self.bufferCount += 1
+        headHeight, headConf = self.getHead(slot)
+        self.headConfBuffer[slot] = headConf
+        if headHeight is None:
+            # No usable head, the scheduler must not be boosted by a stale height
+            self.headRelativeHeight = None
+            return None
+        # Exponential smoothing of the head height
+        if self.headRelativeHeight is None:
+            self.headRelativeHeight = headHeight
+        else:
+            self.headRelativeHeight += self.smoothing * (headHeight - self.headRelativeHeight)
+        height = self.headRelativeHeight
+
+        # Raw and smoothed head below the lower band edge (coordinates start at top left corner of image) re-arms the detector.
+        # The smoothed height lags after a fast pull, alone it could re-arm while the head is still over the bar.
+        if headHeight > self.barRelativeHight + self.band and height > self.barRelativeHight + self.band and self.state != 'down':
+            self.state = 'down'
+            self.downTime = timestamp
+            self.downBufferCount = self.bufferCount
+            self.peakHeight = headHeight
+            return None
+        if self.state == 'down':
+            self.peakHeight = min(self.peakHeight, headHeight)
+        # Raw head above the bar after having been below, a pullup is done.
+        # Checked before the smoothed height, which lags behind and would flatten a short peak.
+        if headHeight < self.barRelativeHight - self.upperBand and self.state == 'down':
+            self.state = 'up'
+            # Crossing is discarded if too close to last pullup or not hanging from the bar
+            if self.lastRepTime is not None and timestamp - self.lastRepTime < self.minRepSeconds:
+                return None
+            if conf.data.repRequireHanging and not self.isHanging(slot):
+                return None
+            self.lastRepTime = timestamp
+            # Mean head confidence over frames since going below the bar, limited to the ring buffer
+            numFrames = int(min(self.bufferCount - self.downBufferCount + 1, self.bufferSize))
+            repSlots = (slot - np.arange(numFrames)) % self.bufferSize
+            return {
+                'timestamp': timestamp,
+                'frameIndex': frameIndex,
+                'repDuration': timestamp - self.downTime,
+                'peakHeight': self.peakHeight,
+                'confidence': float(self.headConfBuffer[repSlots].mean()),
+            }
+        return None
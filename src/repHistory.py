@@ -0,0 +1,308 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: History of every counted pullup in an SQLite database.
+# Pullups are appended by a batched background writer so the frame loop never
+# waits for disk. Pullups are grouped into sessions (sets) split by a rest gap,
+# and daily and weekly totals, sessions and rest times can be queried.
+# The database is used in WAL mode so queries do not block the writer.
+# Usage:
+# python repHistory.py --days 7
+# python repHistory.py --weeks 8 --stream bar1
+# python repHistory.py --sessions 20
+# *********************************************************************************
+import argparse
+import os
+import queue
+import sqlite3
+import threading
+import time
+# Load modules
+from commonConfig import commonConfigClass
+conf = commonConfigClass()
+
+# Tables and indexes, day is the local date of the pullup as YYYY-MM-DD so it can be indexed
+schemaStatements = [
+    'CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, stream TEXT NOT NULL, startTime REAL NOT NULL, endTime REAL NOT NULL, reps INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS reps (id INTEGER PRIMARY KEY, sessionId INTEGER NOT NULL REFERENCES sessions(id), stream TEXT NOT NULL, '
+    'timestamp REAL NOT NULL, day TEXT NOT NULL, pullupCounts INTEGER, repDuration REAL, restSeconds REAL, peakHeight REAL, confidence REAL)',
+    'CREATE INDEX IF NOT EXISTS repsDay ON reps (day, stream)',
+    'CREATE INDEX IF NOT EXISTS repsTimestamp ON reps (timestamp)',
+    'CREATE INDEX IF NOT EXISTS repsSession ON reps (sessionId)',
+    'CREATE INDEX IF NOT EXISTS sessionsStart ON sessions (startTime)',
+]
+
+
+def connectDatabase(databaseFilePath):
+    """
+    This function opens the database in WAL mode and creates the tables if needed.
+    WAL lets queries read while the writer appends, synchronous NORMAL only syncs at checkpoints.
+    """
+    connection = sqlite3.connect(databaseFilePath, timeout=10.0)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    with connection:
+        for statement in schemaStatements:
+            connection.execute(statement)
+    return connection
+
+
+class repHistoryClass:
+    """
+    Class describing the pullup history.
+    Pullups are put on a queue without blocking and written in batches, one transaction per batch.
+    """
+
+    def __init__ (self, databaseFilePath=None, batchSize=None, flushInterval=None, sessionGapSeconds=None):
+        """
+        Init function
+
+        databaseFilePath: string
+            SQLite database file, from config if not given
+        batchSize: int
+            Maximum number of pullups written in one transaction
+        flushInterval: float
+            Maximum time in seconds a pullup waits before it is written
+        sessionGapSeconds: float
+            Rest time in seconds after which the next pullup starts a new session
+        """
+        self.databaseFilePath = conf.base.repHistoryFilePath if databaseFilePath is None else databaseFilePath
+        self.batchSize = conf.data.repHistoryBatchSize if batchSize is None else batchSize
+        self.flushInterval = conf.data.repHistoryFlushInterval if flushInterval is None else flushInterval
+        self.sessionGapSeconds = conf.data.repHistorySessionGap if sessionGapSeconds is None else sessionGapSeconds
+        self.queue = queue.Queue(maxsize=conf.data.repHistoryQueueSize)
+        self.thread = None
+        self.running = False
+        # Current session per stream, tuple (session id, time of last pullup, reps), only used by the writer thread
+        self.sessions = {}
+        self.counters = {'appended': 0, 'written': 0, 'dropped': 0, 'batches': 0, 'errors': 0}
+
+
+    def start(self):
+        """
+        This function opens the database and starts the writer thread
+        """
+        if self.running:
+            return
+        os.makedirs(os.path.dirname(self.databaseFilePath), exist_ok=True)
+        # Check the database can be opened before the frame loop starts
+        connectDatabase(self.databaseFilePath).close()
+        self.running = True
+        self.thread = threading.Thread(target=self.worker, name='pullupRepHistory', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """
+        This function writes the remaining pullups and stops the writer thread
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.queue.put(None)
+        self.thread.join(10.0)
+        self.thread = None
+
+
+    def append(self, event):
+        """
+        This function puts a counted pullup on the write queue without blocking
+
+        event: dict
+            Pullup event from pullupCounterAdd with pullupCounts, optional repEvent and streamName
+        """
+        repEvent = event.get('repEvent') or {}
+        rep = {
+            'stream': event.get('streamName') or '',
+            'timestamp': repEvent.get('timestamp', time.time()),
+            'pullupCounts': event.get('pullupCounts'),
+            'repDuration': repEvent.get('repDuration'),
+            'peakHeight': repEvent.get('peakHeight'),
+            'confidence': repEvent.get('confidence'),
+        }
+        try:
+            self.queue.put_nowait(rep)
+            self.counters['appended'] += 1
+        except queue.Full:
+            self.counters['dropped'] += 1
+
+
+    def loadSessions(self, connection):
+        """
+        This function loads the newest session of every stream so pullups after a restart continue it
+        """
+        rows = connection.execute('SELECT id, stream, endTime, reps FROM sessions WHERE id IN (SELECT MAX(id) FROM sessions GROUP BY stream)')
+        for row in rows:
+            self.sessions[row['stream']] = (row['id'], row['endTime'], row['reps'])
+
+
+    def writeBatch(self, connection, batch):
+        """
+        This function writes a batch of pullups in one transaction and splits them into sessions
+        """
+        with connection:
+            for rep in batch:
+                session = self.sessions.get(rep['stream'])
+                restSeconds = None
+                if session is None or rep['timestamp'] - session[1] > self.sessionGapSeconds:
+                    cursor = connection.execute('INSERT INTO sessions (stream, startTime, endTime, reps) VALUES (?, ?, ?, 0)',
+                                                (rep['stream'], rep['timestamp'], rep['timestamp']))
+                    session = (cursor.lastrowid, rep['timestamp'], 0)
+                else:
+                    restSeconds = rep['timestamp'] - session[1]
+                session = (session[0], rep['timestamp'], session[2] + 1)
+                self.sessions[rep['stream']] = session
+                day = time.strftime('%Y-%m-%d', time.localtime(rep['timestamp']))
+                connection.execute('INSERT INTO reps (sessionId, stream, timestamp, day, pullupCounts, repDuration, restSeconds, peakHeight, confidence) '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (session[0], rep['stream'], rep['timestamp'], day, rep['pullupCounts'], rep['repDuration'], restSeconds, rep['peakHeight'], rep['confidence']))
+                connection.execute('UPDATE sessions SET endTime = ?, reps = ? WHERE id = ?', (session[1], session[2], session[0]))
+        self.counters['written'] += len(batch)
+        self.counters['batches'] += 1
+
+
+    def worker(self):
+        """
+        This function collects pullups from the queue and writes them in batches until stopped
+        """
+        connection = connectDatabase(self.databaseFilePath)
+        self.loadSessions(connection)
+        stopping = False
+        while not stopping:
+            rep = self.queue.get()
+            if rep is None:
+                break
+            batch = [rep]
+            # Wait a little for more pullups so they share one transaction
+            deadline = time.monotonic() + self.flushInterval
+            while len(batch) < self.batchSize:
+                try:
+                    rep = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if rep is None:
+                    stopping = True
+                    break
+                batch.append(rep)
+            try:
+                self.writeBatch(connection, batch)
+            except sqlite3.Error as e:
+                self.counters['errors'] += 1
+                print('Failed to write pullup history')
+                print(e)
+        connection.close()
+
+
+def getDailyTotals(days=7, stream=None, databaseFilePath=None):
+    """
+    This function returns pullups, sessions and mean rep duration and rest per day for the last days, newest first
+
+    days: int
+        Number of days including today
+    stream: string
+        Only pullups of this stream, all streams if not given
+    databaseFilePath: string
+        SQLite database file, from config if not given
+    """
+    dayFrom = time.strftime('%Y-%m-%d', time.localtime(time.time() - (days - 1) * 86400))
+    return queryTotals('day', dayFrom, stream, databaseFilePath)
+
+
+def getWeeklyTotals(weeks=4, stream=None, databaseFilePath=None):
+    """
+    This function returns pullups, sessions and mean rep duration and rest per week (year-week, Monday first) for the last weeks, newest first
+    """
+    # Monday of the first week
+    now = time.localtime()
+    dayFrom = time.strftime('%Y-%m-%d', time.localtime(time.time() - (now.tm_wday + 7 * (weeks - 1)) * 86400))
+    return queryTotals("strftime('%Y-%W', day)", dayFrom, stream, databaseFilePath)
+
+
+def queryTotals(periodExpression, dayFrom, stream=None, databaseFilePath=None):
+    """
+    This function returns the totals grouped by a period of the day column from dayFrom. The day index limits the rows read.
+    """
+    query = ('SELECT ' + periodExpression + ' AS period, COUNT(*) AS reps, COUNT(DISTINCT sessionId) AS sessions, '
+             'AVG(repDuration) AS meanRepDuration, AVG(restSeconds) AS meanRestSeconds, MIN(peakHeight) AS bestPeakHeight '
+             'FROM reps WHERE day >= ?')
+    parameters = [dayFrom]
+    if stream is not None:
+        query += ' AND stream = ?'
+        parameters.append(stream)
+    query += ' GROUP BY period ORDER BY period DESC'
+    return runQuery(query, parameters, databaseFilePath)
+
+
+def getSessions(limit=20, stream=None, databaseFilePath=None):
+    """
+    This function returns the newest sessions with number of pullups, length, mean rep duration and mean rest time
+    """
+    query = ('SELECT sessions.id, sessions.stream, sessions.startTime, sessions.endTime, sessions.reps, '
+             'sessions.endTime - sessions.startTime AS seconds, AVG(reps.repDuration) AS meanRepDuration, AVG(reps.restSeconds) AS meanRestSeconds '
+             'FROM sessions JOIN reps ON reps.sessionId = sessions.id')
+    parameters = []
+    if stream is not None:
+        query += ' WHERE sessions.stream = ?'
+        parameters.append(stream)
+    query += ' GROUP BY sessions.id ORDER BY sessions.startTime DESC LIMIT ?'
+    parameters.append(limit)
+    return runQuery(query, parameters, databaseFilePath)
+
+
+def getSessionReps(sessionId, databaseFilePath=None):
+    """
+    This function returns the pullups of a session in time order, for rep cadence and rest times
+    """
+    query = 'SELECT timestamp, pullupCounts, repDuration, restSeconds, peakHeight, confidence FROM reps WHERE sessionId = ? ORDER BY timestamp'
+    return runQuery(query, [sessionId], databaseFilePath)
+
+
+def runQuery(query, parameters, databaseFilePath=None):
+    """
+    This function runs a read query on its own connection and returns the rows as dictionaries.
+    Returns an empty list if there is no history yet.
+    """
+    if databaseFilePath is None:
+        databaseFilePath = conf.base.repHistoryFilePath
+    if not os.path.exists(databaseFilePath):
+        return []
+    connection = connectDatabase(databaseFilePath)
+    try:
+        return [dict(row) for row in connection.execute(query, parameters)]
+    finally:
+        connection.close()
+
+
+def printRows(title, rows):
+    """
+    This function prints query rows as a table
+    """
+    print(title)
+    if not rows:
+        print('  No pullups')
+        return
+    keys = list(rows[0].keys())
+    print('  ' + '  '.join('{:>16}'.format(key) for key in keys))
+    for row in rows:
+        values = []
+        for key in keys:
+            value = row[key]
+            if isinstance(value, float) and key.endswith('Time'):
+                value = time.strftime('%Y-%m-%d %H:%M', time.localtime(value))
+            elif isinstance(value, float):
+                value = '{:.2f}'.format(value)
+            values.append('{:>16}'.format(str(value)))
+        print('  ' + '  '.join(values))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show daily and weekly pullup totals and sessions from the pullup history')
+    parser.add_argument('--database', help='History database, from config if not given')
+    parser.add_argument('--stream', help='Only pullups of this stream in multi-stream mode')
+    parser.add_argument('--days', type=int, default=7, help='Number of days of daily totals')
+    parser.add_argument('--weeks', type=int, default=4, help='Number of weeks of weekly totals')
+    parser.add_argument('--sessions', type=int, default=10, help='Number of newest sessions')
+    args = parser.parse_args()
+    printRows('Pullups per day', getDailyTotals(args.days, args.stream, args.database))
+    printRows('Pullups per week', getWeeklyTotals(args.weeks, args.stream, args.database))
+    printRows('Sessions', getSessions(args.sessions, args.stream, args.database))
@@ -0,0 +1,151 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Region of interest tracking around the athlete.
+# The box of the previous detection is used to crop a smaller region for the
+# next inference. Keypoints are mapped back to full frame coordinates.
+# *********************************************************************************
+import math
+import numpy as np
+# Load modules
+from commonConfig import commonConfigClass
+conf = commonConfigClass()
+
+
+def getFullFramePose(r, offset=(0, 0), fullShape=None):
+    """
+    This function returns the pose results of a (possibly cropped) frame in full frame coordinates.
+    Relative coordinates are relative to the full frame, so the bar comparison on xyn stays correct.
+
+    r: ultralytics Results
+        Pose estimation result of the frame or crop
+    offset: tuple
+        Pixel position (x, y) of the upper left corner of the crop in the full frame
+    fullShape: tuple
+        Shape (height, width) of the full frame, shape of the result image if not given
+
+    Returns dictionary with numpy arrays:
+    boxes (N, 4) xyxy pixels, boxConf (N,), keypointsXy (N, 17, 2) pixels,
+    keypointsXyn (N, 17, 2) relative, keypointsConf (N, 17)
+    """
+    if fullShape is None:
+        fullShape = r.orig_shape
+    fullHeight, fullWidth = fullShape[:2]
+    offsetArray = np.array(offset, dtype=np.float32)
+    scaleArray = np.array([fullWidth, fullHeight], dtype=np.float32)
+    # Empty arrays if nothing is detected
+    pose = {
+        'boxes': np.zeros((0, 4), dtype=np.float32),
+        'boxConf': np.zeros((0,), dtype=np.float32),
+        'keypointsXy': np.zeros((0, 17, 2), dtype=np.float32),
+        'keypointsXyn': np.zeros((0, 17, 2), dtype=np.float32),
+        'keypointsConf': np.zeros((0, 17), dtype=np.float32),
+    }
+    if r.boxes is not None and len(r.boxes) > 0:
+        pose['boxes'] = r.boxes.xyxy.cpu().numpy() + np.tile(offsetArray, 2)
+        pose['boxConf'] = r.boxes.conf.cpu().numpy()
+    if r.keypoints is not None and len(r.keypoints) > 0:
+        pose['keypointsXy'] = r.keypoints.xy.cpu().numpy() + offsetArray
+        pose['keypointsXyn'] = pose['keypointsXy'] / scaleArray
+        if r.keypoints.conf is not None:
+            pose['keypointsConf'] = r.keypoints.conf.cpu().numpy()
+        else:
+            pose['keypointsConf'] = np.ones(pose['keypointsXy'].shape[:2], dtype=np.float32)
+    return pose
+
+
+def getInferenceSize(region):
+    """
+    This function returns the model input size for a region.
+    YOLO resizes the long side of the input to this size, so a small crop must also get a
+    small input size to reduce inference time. Rounded up to the model stride of 32.
+
+    region: numpy array
+        Image to infer (height, width, channels)
+    """
+    longSide = max(region.shape[:2])
+    return int(min(conf.data.inferenceSize, math.ceil(longSide / 32) * 32))
+
+
+class roiTrackerClass:
+    """
+    Class describing the region of interest tracker.
+    Crops around the last detected athlete and the bar, falls back to full frame
+    periodically and when the athlete is lost.
+    """
+
+    def __init__ (self, barRelativeHight=None):
+        """
+        Init function
+
+        barRelativeHight: float
+            Relative height of the bar in the image, from config if not given
+        """
+        self.barRelativeHight = conf.data.barRelativeHight if barRelativeHight is None else barRelativeHight
+        # Last detected box (x1, y1, x2, y2) in full frame pixels, None if lost
+        self.lastBox = None
+        self.framesSinceFull = 0
+        # Counters for crops and full frames
+        self.counters = {'crop': 0, 'full': 0, 'lost': 0}
+
+
+    def getCrop(self, frame):
+        """
+        This function returns the region to infer for a frame.
+        Returns tuple (region, offset) where offset is the pixel position (x, y) of the region in the frame.
+
+        frame: numpy array
+            Full frame (height, width, channels)
+        """
+        fullHeight, fullWidth = frame.shape[:2]
+        # Use full frame if disabled, lost or at regular intervals to find new athletes
+        if not conf.data.roiEnabled or self.lastBox is None or self.framesSinceFull >= conf.data.roiFullFrameInterval:
+            self.framesSinceFull = 0
+            self.counters['full'] += 1
+            return frame, (0, 0)
+        x1, y1, x2, y2 = self.lastBox
+        marginX = (x2 - x1) * conf.data.roiMargin
+        marginY = (y2 - y1) * conf.data.roiMargin
+        # The bar must always be inside the region so crossing it can be detected
+        barY = self.barRelativeHight * fullHeight
+        x1 = x1 - marginX
+        x2 = x2 + marginX
+        y1 = min(y1 - marginY, barY - marginY)
+        y2 = max(y2 + marginY, barY + marginY)
+        # Enforce a minimum size, the model needs some context around the athlete
+        minSize = conf.data.roiMinSize
+        if x2 - x1 < minSize:
+            centerX = (x1 + x2) / 2
+            x1, x2 = centerX - minSize / 2, centerX + minSize / 2
+        if y2 - y1 < minSize:
+            centerY = (y1 + y2) / 2
+            y1, y2 = centerY - minSize / 2, centerY + minSize / 2
+        # Clip to frame
+        x1 = int(max(0, x1))
+        y1 = int(max(0, y1))
+        x2 = int(min(fullWidth, x2))
+        y2 = int(min(fullHeight, y2))
+        # Cropping is not worth it if the region is almost the full frame
+        if (x2 - x1) * (y2 - y1) > conf.data.roiMaxAreaShare * fullWidth * fullHeight:
+            self.framesSinceFull = 0
+            self.counters['full'] += 1
+            return frame, (0, 0)
+        self.framesSinceFull += 1
+        self.counters['crop'] += 1
+        # Slicing gives a view of the frame, no copy is made
+        return frame[y1:y2, x1:x2], (x1, y1)
+
+
+    def update(self, pose):
+        """
+        This function stores the box of the athlete for the next crop.
+        The same detection as used by the counter (index 0) is followed.
+
+        pose: dict
+            Full frame pose from getFullFramePose
+        """
+        if len(pose['boxes']) == 0 or pose['boxConf'][0] < conf.data.roiBoxConfidenceThreshold:
+            if self.lastBox is not None:
+                self.counters['lost'] += 1
+            self.lastBox = None
+            return
+        self.lastBox = tuple(float(value) for value in pose['boxes'][0])
@@ -0,0 +1,615 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Load and soak test of the counting pipeline.
+# A synthetic athlete doing sets of pullups (optionally with passers-by) is fed
+# to the tracker, counter, keypoint store, history and event dispatcher for hours,
+# or a recorded video is served by a local stand-in for the camera and run through
+# the model. SONOS is replaced by a mock speaker fetching the sounds from the local
+# sound server. Memory, open files, threads and stage latencies are sampled and the
+# run fails if they grow or if the count is wrong. All files are written to a work
+# folder, the files of the live counter in data/ are not touched.
+# Usage:
+# python soakTest.py --hours 4
+# python soakTest.py --hours 24 --fast --passersBy
+# python soakTest.py --video data/pullupSave/video_20240101_120000.avi --truth 12 --hours 2
+# *********************************************************************************
+import argparse
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+# Load modules
+from commonConfig import commonConfigClass
+from supportMethods import supportMethodsClass
+from repCounter import repDetectorClass
+from roiTracker import roiTrackerClass, getFullFramePose, getInferenceSize
+from athleteTracker import athleteTrackerClass
+from keypointStore import keypointStoreClass
+from repHistory import runQuery
+from metrics import metricsRegistry
+conf = commonConfigClass()
+
+# Frame size of the synthetic poses in pixels (height, width)
+syntheticShape = (480, 640, 3)
+
+
+def redirectDataFolder(workFolderPath):
+    """
+    This function points every file and folder of the counter in data/ to the work folder.
+    The model cache is kept so exported models are not exported again.
+
+    workFolderPath: string
+        Folder replacing data/
+    """
+    dataFolderPath = os.path.join(conf.base.scriptPath, 'data')
+    for config in [conf.base, conf.data, conf.sonos]:
+        for key, value in list(vars(config).items()):
+            if key != 'modelCacheFolderPath' and isinstance(value, str) and value.startswith(dataFolderPath):
+                setattr(config, key, workFolderPath + value[len(dataFolderPath):])
+
+
+def getFreePort():
+    """
+    This function returns a free local port
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probeSocket:
+        probeSocket.bind(('127.0.0.1', 0))
+        return probeSocket.getsockname()[1]
+
+
+class syntheticAthleteClass:
+    """
+    Class describing a synthetic athlete doing sets of pullups under the bar, with optional passers-by.
+    Poses are generated in the format of getFullFramePose, the number of pullups done is known.
+    """
+
+    def __init__ (self, repSeconds, repsPerSet, restSeconds, passersBy=False, noise=0.003, seed=0):
+        """
+        Init function
+
+        repSeconds: float
+            Time of one pullup from hanging to chin over bar and back
+        repsPerSet: int
+            Pullups in every set
+        restSeconds: float
+            Rest between sets, standing below the bar
+        passersBy: bool
+            Let a person walk through the image every now and then and a spotter stand next to the bar
+        noise: float
+            Standard deviation of the keypoint noise, relative to image size
+        seed: int
+            Seed of the random generator, runs are repeatable
+        """
+        self.repSeconds = repSeconds
+        self.repsPerSet = repsPerSet
+        self.restSeconds = restSeconds
+        self.passersBy = passersBy
+        self.noise = noise
+        self.random = np.random.default_rng(seed)
+        self.bar = conf.data.barRelativeHight
+        # Head position when hanging and at the top of a pullup, relative to image height
+        self.headDown = self.bar + 0.12
+        self.headUp = self.bar - 0.08
+        self.setSeconds = repsPerSet * repSeconds
+        self.pullupsDone = 0
+
+
+    def getPerson(self, centerX, headY, hanging):
+        """
+        This function returns box and keypoints (relative) of a person with the head at headY
+        """
+        keypoints = np.zeros((17, 2), dtype=np.float32)
+        keypoints[:, 0] = centerX
+        keypoints[0] = (centerX, headY)
+        keypoints[1:5] = [(centerX - 0.01, headY - 0.01), (centerX + 0.01, headY - 0.01), (centerX - 0.02, headY), (centerX + 0.02, headY)]
+        keypoints[5:7] = [(centerX - 0.05, headY + 0.08), (centerX + 0.05, headY + 0.08)]
+        if hanging:
+            # Hands on the bar
+            keypoints[7:11] = [(centerX - 0.06, (headY + self.bar) / 2), (centerX + 0.06, (headY + self.bar) / 2), (centerX - 0.07, self.bar - 0.02), (centerX + 0.07, self.bar - 0.02)]
+        else:
+            keypoints[7:11] = [(centerX - 0.06, headY + 0.18), (centerX + 0.06, headY + 0.18), (centerX - 0.07, headY + 0.28), (centerX + 0.07, headY + 0.28)]
+        keypoints[11:13] = [(centerX - 0.04, headY + 0.3), (centerX + 0.04, headY + 0.3)]
+        keypoints[13:15] = [(centerX - 0.04, headY + 0.45), (centerX + 0.04, headY + 0.45)]
+        keypoints[15:17] = [(centerX - 0.04, headY + 0.6), (centerX + 0.04, headY + 0.6)]
+        keypoints += self.random.normal(0.0, self.noise, keypoints.shape).astype(np.float32)
+        keypoints = np.clip(keypoints, 0.0, 1.0)
+        box = np.array([keypoints[:, 0].min() - 0.02, keypoints[:, 1].min() - 0.05, keypoints[:, 0].max() + 0.02, keypoints[:, 1].max() + 0.02], dtype=np.float32)
+        return np.clip(box, 0.0, 1.0), keypoints
+
+
+    def isResting(self, seconds):
+        """
+        This function returns True if the athlete is standing below the bar between sets at a time since start
+        """
+        return seconds % (self.restSeconds + self.setSeconds) < self.restSeconds
+
+
+    def getPose(self, seconds):
+        """
+        This function returns the pose at a time since start and updates the number of pullups done.
+        A cycle is a set of pullups followed by rest, the cycle starts with rest so the athlete starts below the bar.
+
+        seconds: float
+            Time since start of the run
+        """
+        cycleNumber, cycleTime = divmod(seconds, self.restSeconds + self.setSeconds)
+        persons = []
+        if self.isResting(seconds):
+            # Standing below the bar between sets
+            persons.append(self.getPerson(0.5, self.headDown + 0.1, False))
+        else:
+            repNumber, repTime = divmod(cycleTime - self.restSeconds, self.repSeconds)
+            # Head goes up to the bar and down again in one smooth movement
+            headY = self.headDown - (self.headDown - self.headUp) * (1 - np.cos(2 * np.pi * repTime / self.repSeconds)) / 2
+            persons.append(self.getPerson(0.5, headY, True))
+            # Pullup is done when the top is passed
+            totalRepNumber = int(cycleNumber) * self.repsPerSet + int(repNumber) + (1 if repTime >= self.repSeconds / 2 else 0)
+            self.pullupsDone = max(self.pullupsDone, totalRepNumber)
+        if self.passersBy:
+            # Spotter standing next to the bar
+            persons.append(self.getPerson(0.25, self.bar + 0.25, False))
+            # Person walking through the image for 6 seconds every 40 seconds
+            walkTime = seconds % 40.0
+            if walkTime < 6.0:
+                persons.append(self.getPerson(0.05 + 0.9 * walkTime / 6.0, self.bar + 0.27, False))
+        # Detections come in random order as from the model
+        order = self.random.permutation(len(persons))
+        fullHeight, fullWidth = syntheticShape[:2]
+        scale = np.array([fullWidth, fullHeight], dtype=np.float32)
+        boxes = np.array([persons[index][0] for index in order], dtype=np.float32) * np.tile(scale, 2)
+        keypointsXyn = np.array([persons[index][1] for index in order], dtype=np.float32)
+        return {
+            'boxes': boxes,
+            'boxConf': np.full(len(persons), 0.9, dtype=np.float32),
+            'keypointsXy': keypointsXyn * scale,
+            'keypointsXyn': keypointsXyn,
+            'keypointsConf': np.full((len(persons), 17), 0.9, dtype=np.float32),
+        }
+
+
+class mockSonosSpeakerClass:
+    """
+    Class describing a stand-in for a SOCO device.
+    Playing fetches the sound file from its web adress like a real speaker, so the sound server is tested too.
+    """
+
+    def __init__ (self):
+        """
+        Init function
+        """
+        self.mute = False
+        self.volume = 0
+        self.counters = {'plays': 0, 'errors': 0, 'bytes': 0}
+        self.fetchLatencies = []
+
+
+    def play_uri(self, uri):
+        """
+        This function fetches the sound file, raises an exception if it can not be fetched
+        """
+        fetchStart = time.perf_counter()
+        try:
+            with urllib.request.urlopen(uri, timeout=5.0) as response:
+                self.counters['bytes'] += len(response.read())
+        except Exception:
+            self.counters['errors'] += 1
+            raise
+        self.fetchLatencies.append((time.perf_counter() - fetchStart) * 1000)
+        metricsRegistry.observe('soak.soundFetch', self.fetchLatencies[-1])
+        self.counters['plays'] += 1
+
+
+class cameraStandInHandler(BaseHTTPRequestHandler):
+    """
+    Class describing the HTTP handler of the camera stand-in, serving the video as MJPEG stream.
+    The video is looped and served in real time at its frame rate, until the stand-in is asked to stop at the end of a loop.
+    """
+
+    def do_GET(self):
+        """
+        This function streams the frames until the client disconnects
+        """
+        import cv2
+        standIn = self.server.standIn
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+        self.end_headers()
+        capture = cv2.VideoCapture(standIn.videoFilePath)
+        nextFrameTime = time.perf_counter()
+        try:
+            while standIn.running and not standIn.finished:
+                ok, frame = capture.read()
+                if not ok:
+                    # Start the video again, the expected count grows with every loop
+                    standIn.loops += 1
+                    if standIn.stopAtLoopEnd:
+                        # Run is over, every pullup served is part of a complete loop
+                        standIn.finished = True
+                        break
+                    capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    continue
+                ok, jpeg = cv2.imencode('.jpg', frame)
+                self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg.tobytes() + b'\r\n')
+                standIn.framesServed += 1
+                nextFrameTime += 1.0 / standIn.fps
+                time.sleep(max(0.0, nextFrameTime - time.perf_counter()))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            capture.release()
+
+
+    def log_message(self, format, *args):
+        """
+        This function silences the log line printed for every request
+        """
+        return
+
+
+class cameraStandInClass:
+    """
+    Class describing a local stand-in for the camera, streaming a recorded video in a loop
+    """
+
+    def __init__ (self, videoFilePath):
+        """
+        Init function
+
+        videoFilePath: string
+            Recorded video of pullups
+        """
+        import cv2
+        self.videoFilePath = videoFilePath
+        capture = cv2.VideoCapture(videoFilePath)
+        assert capture.isOpened(), 'The video file could not be opened'
+        self.fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        capture.release()
+        self.loops = 0
+        self.framesServed = 0
+        # Set to stop serving at the end of the current loop, finished is set when that loop has been served
+        self.stopAtLoopEnd = False
+        self.finished = False
+        self.running = False
+        self.server = None
+
+
+    def start(self):
+        """
+        This function starts serving the stream, returns the stream URL
+        """
+        self.running = True
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), cameraStandInHandler)
+        self.server.daemon_threads = True
+        self.server.standIn = self
+        threading.Thread(target=self.server.serve_forever, name='soakCameraStandIn', daemon=True).start()
+        return 'http://127.0.0.1:' + str(self.server.server_address[1]) + '/stream.mjpg'
+
+
+    def stop(self):
+        """
+        This function stops serving the stream
+        """
+        self.running = False
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class soakTestClass:
+    """
+    Class describing a soak run, the pipeline under test and the samples of resource use and latency
+    """
+
+    def __init__ (self, args):
+        """
+        Init function
+
+        args: argparse Namespace
+            Command line arguments
+        """
+        self.args = args
+        self.supportMethods = supportMethodsClass()
+        self.athleteTracker = athleteTrackerClass()
+        self.roiTracker = roiTrackerClass()
+        self.repDetector = repDetectorClass()
+        self.keypointStore = keypointStoreClass() if conf.data.keypointStoreEnabled else None
+        self.speaker = mockSonosSpeakerClass()
+        self.pullupCounts = 0
+        self.framesProcessed = 0
+        self.samples = []
+        self.lastStages = {}
+
+
+    def start(self):
+        """
+        This function starts the background parts of the counter with SONOS replaced by the mock speaker
+        """
+        self.supportMethods.loadPullupState()
+        self.supportMethods.startEventDispatcher()
+        self.supportMethods.startControlState()
+        self.supportMethods.startApiServer()
+        self.supportMethods.startSoundServer()
+        self.supportMethods.startRepHistory()
+        # Settings as written by Home Assistant, random sounds are played on the mock speaker
+        conf.data.playSonos = True
+        conf.data.playSound = False
+        for key, value in [('soundStatus', True), ('soundTheme', 'random'), ('sonosRoom', 'Soak'), ('sonosVolume', 10)]:
+            self.supportMethods.controlState.set(key, value)
+        self.supportMethods.speakerCache.speakers['Soak'] = (self.speaker, time.time())
+        self.supportMethods.speakerCache.ttl = float('inf')
+
+
+    def stop(self):
+        """
+        This function lets remaining pullup events finish and stops the background parts
+        """
+        if self.keypointStore is not None:
+            self.keypointStore.close()
+        self.supportMethods.closeVideoRecorder()
+        self.supportMethods.stopEventDispatcher()
+        self.supportMethods.stopApiServer()
+        self.supportMethods.stopPullupState()
+        self.supportMethods.stopSoundServer()
+        self.supportMethods.stopRepHistory()
+        self.supportMethods.controlState.stop()
+
+
+    def timeStage(self, stageName, function, *arguments):
+        """
+        This function runs a stage of the pipeline and records its latency
+        """
+        stageStart = time.perf_counter()
+        value = function(*arguments)
+        metricsRegistry.observe(stageName, (time.perf_counter() - stageStart) * 1000)
+        return value
+
+
+    def countPose(self, pose, frameIndex, frameTime, fullShape):
+        """
+        This function runs a pose through the same steps as the live counter
+        """
+        pose = self.timeStage('tracking', self.athleteTracker.update, pose, fullShape)
+        self.timeStage('roiUpdate', self.roiTracker.update, pose)
+        if self.keypointStore is not None:
+            self.timeStage('keypointStore', self.keypointStore.append, frameIndex, pose, fullShape, frameTime)
+        repEvent = self.timeStage('repDetection', self.repDetector.update, pose, frameTime, frameIndex)
+        if repEvent is not None:
+            self.pullupCounts, beenUp, beenDown = self.timeStage('pullupCounterAdd', self.supportMethods.pullupCounterAdd, self.pullupCounts, True, True, repEvent)
+        self.framesProcessed += 1
+
+
+    def getResources(self):
+        """
+        This function returns resident memory in MB, open file descriptors and threads of the process
+        """
+        resources = {'threads': threading.active_count()}
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                resources['memoryMb'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+            resources['openFiles'] = len(os.listdir('/proc/self/fd'))
+        except (OSError, ValueError, AttributeError):
+            # Not Linux, memory and open files are not checked
+            pass
+        return resources
+
+
+    def sample(self, runSeconds):
+        """
+        This function stores resource use and the mean latency of every stage since the previous sample
+        """
+        snapshot = metricsRegistry.getSnapshot()
+        stages = {}
+        for stageName, stage in snapshot['stages'].items():
+            lastCount, lastSum = self.lastStages.get(stageName, (0, 0.0))
+            if stage['count'] > lastCount:
+                stages[stageName] = (stage['sumMs'] - lastSum) / (stage['count'] - lastCount)
+            self.lastStages[stageName] = (stage['count'], stage['sumMs'])
+        sample = dict(self.getResources(), seconds=runSeconds, frames=self.framesProcessed, pullupCounts=self.pullupCounts, stages=stages)
+        # The API must keep answering during the run
+        if self.supportMethods.apiServer is not None:
+            try:
+                with urllib.request.urlopen('http://127.0.0.1:' + str(conf.data.apiPort) + '/api/state', timeout=5.0) as response:
+                    sample['apiCount'] = json.loads(response.read())['pullupCounts']
+            except Exception as e:
+                sample['apiError'] = str(e)
+        self.samples.append(sample)
+        print('Soak ' + '{:.0f}'.format(runSeconds) + ' s: ' + str(self.framesProcessed) + ' frames, ' + str(self.pullupCounts) + ' pullups, '
+              + '{:.1f}'.format(sample.get('memoryMb', 0.0)) + ' MB, ' + str(sample.get('openFiles')) + ' files, ' + str(sample['threads']) + ' threads')
+
+
+    def runSynthetic(self):
+        """
+        This function feeds synthetic poses at the configured frame rate for the configured time.
+        Returns the number of pullups done by the synthetic athlete.
+        """
+        athlete = syntheticAthleteClass(self.args.repSeconds, self.args.repsPerSet, self.args.restSeconds, self.args.passersBy)
+        startTime = time.time()
+        wallStart = time.perf_counter()
+        nextSample = 0.0
+        frameIndex = 0
+        while True:
+            runSeconds = frameIndex / self.args.fps
+            # The run ends between sets so every pullup started is also finished
+            if runSeconds >= self.args.seconds and athlete.isResting(runSeconds):
+                break
+            if not self.args.fast:
+                # Real time, frames are fed at the frame rate of a camera
+                time.sleep(max(0.0, wallStart + runSeconds - time.perf_counter()))
+            pose = self.timeStage('synthesis', athlete.getPose, runSeconds)
+            frameIndex += 1
+            self.countPose(pose, frameIndex, startTime + runSeconds, syntheticShape)
+            if runSeconds >= nextSample:
+                self.sample(runSeconds)
+                nextSample += self.args.sampleInterval
+        self.sample(runSeconds)
+        return athlete.pullupsDone
+
+
+    def runVideo(self):
+        """
+        This function streams a recorded video in a loop from the camera stand-in through capture, model and counter.
+        Returns the expected number of pullups from the ground truth count and the number of loops.
+        The run ends at the end of the loop playing when the time is up, so only complete loops are counted.
+        """
+        from frameCapture import frameCaptureClass
+        from modelBackend import modelLoaderClass
+        from motionGate import motionGateClass
+        model, backend = modelLoaderClass().get()
+        motionGate = motionGateClass()
+        standIn = cameraStandInClass(self.args.video)
+        capture = frameCaptureClass(standIn.start(), live=True)
+        capture.start()
+        wallStart = time.perf_counter()
+        nextSample = 0.0
+        try:
+            while True:
+                runSeconds = time.perf_counter() - wallStart
+                if runSeconds >= self.args.seconds:
+                    standIn.stopAtLoopEnd = True
+                if runSeconds >= nextSample:
+                    self.sample(runSeconds)
+                    nextSample += self.args.sampleInterval
+                frame, frameIndex, frameTime = capture.getLatest(1.0)
+                if frame is None and standIn.finished:
+                    # Last loop served and its last frame handled
+                    break
+                if frame is None or not motionGate.update(frame, frameTime):
+                    continue
+                region, offset = self.roiTracker.getCrop(frame)
+                r = self.timeStage('inference', lambda: model(region, device="CPU", imgsz=getInferenceSize(region), verbose=False)[0])
+                pose = getFullFramePose(r, offset, frame.shape)
+                motionGate.reportPose(pose, frameTime)
+                self.timeStage('annotate', self.supportMethods.saveAnnotatedFrame, r, frameIndex, pose, frame, offset, frame.shape, frameTime)
+                self.countPose(pose, frameIndex, frameTime, frame.shape)
+        finally:
+            capture.stop()
+            standIn.stop()
+        self.sample(time.perf_counter() - wallStart)
+        print('Camera stand-in served ' + str(standIn.framesServed) + ' frames in ' + str(standIn.loops) + ' complete loops, capture: ' + str(capture.counters))
+        return self.args.truth * standIn.loops
+
+
+    def getFailures(self, expected):
+        """
+        This function checks the samples and counts against the limits and returns a list of failures, empty if passed
+        """
+        failures = []
+        # Resource use is compared with the first sample after warm up, model and caches are loaded by then
+        baseline = next((sample for sample in self.samples if sample['seconds'] >= self.args.warmupSeconds), self.samples[0])
+        last = self.samples[-1]
+        for key, limit in [('memoryMb', self.args.maxMemoryGrowthMb), ('openFiles', self.args.maxFileGrowth), ('threads', self.args.maxThreadGrowth)]:
+            if key in baseline and key in last and last[key] - baseline[key] > limit:
+                failures.append(key + ' grew from ' + '{:.1f}'.format(baseline[key]) + ' to ' + '{:.1f}'.format(last[key]) + ', limit is ' + str(limit))
+        # Mean latency of the last samples compared with the first samples after warm up
+        laterSamples = [sample for sample in self.samples if sample['seconds'] >= baseline['seconds']]
+        windowSize = max(1, len(laterSamples) // 4)
+        for stageName in metricsRegistry.getSnapshot()['stages']:
+            firstLatencies = [sample['stages'][stageName] for sample in laterSamples[:windowSize] if stageName in sample['stages']]
+            lastLatencies = [sample['stages'][stageName] for sample in laterSamples[-windowSize:] if stageName in sample['stages']]
+            if len(firstLatencies) == 0 or len(lastLatencies) == 0 or len(laterSamples) < 2 * windowSize:
+                continue
+            firstMs, lastMs = float(np.mean(firstLatencies)), float(np.mean(lastLatencies))
+            # Stages below a millisecond are not checked, the ratio is only noise there
+            if lastMs > self.args.minDriftMs and lastMs > firstMs * self.args.maxLatencyDrift:
+                failures.append('Latency of ' + stageName + ' drifted from ' + '{:.2f}'.format(firstMs) + ' to ' + '{:.2f}'.format(lastMs) + ' ms')
+        # Counter, persisted state, history, API and SONOS must agree
+        if abs(self.pullupCounts - expected) > self.args.countTolerance:
+            failures.append('Counted ' + str(self.pullupCounts) + ' pullups, expected ' + str(expected))
+        persistedCounts = self.supportMethods.statePersistence.load()['pullupCounts']
+        if persistedCounts != self.pullupCounts:
+            failures.append('Persisted count is ' + str(persistedCounts) + ', counted ' + str(self.pullupCounts))
+        historyRows = runQuery('SELECT COUNT(*) AS reps FROM reps', [])
+        if conf.data.repHistoryEnabled and (len(historyRows) == 0 or historyRows[0]['reps'] != self.pullupCounts):
+            failures.append('History has ' + str(historyRows[0]['reps'] if historyRows else 0) + ' pullups, counted ' + str(self.pullupCounts))
+        apiErrors = [sample['apiError'] for sample in self.samples if 'apiError' in sample]
+        if apiErrors:
+            failures.append('API failed ' + str(len(apiErrors)) + ' times, first error: ' + apiErrors[0])
+        if self.speaker.counters['errors'] > 0:
+            failures.append('Mock SONOS failed to fetch ' + str(self.speaker.counters['errors']) + ' sounds')
+        if self.pullupCounts > 0 and self.speaker.counters['plays'] == 0:
+            failures.append('No sound was played on the mock SONOS')
+        return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Soak test of the counting pipeline with a synthetic athlete or a looped recorded video')
+    parser.add_argument('--hours', type=float, default=0.0, help='Length of the run in hours')
+    parser.add_argument('--minutes', type=float, default=0.0, help='Length of the run in minutes, added to hours')
+    parser.add_argument('--fps', type=float, default=10.0, help='Frame rate of the synthetic poses')
+    parser.add_argument('--fast', action='store_true', help='Feed synthetic poses as fast as possible, time of the run is synthetic time')
+    parser.add_argument('--passersBy', action='store_true', help='Add a spotter and a person walking through the image')
+    parser.add_argument('--repSeconds', type=float, default=3.0, help='Time of one synthetic pullup')
+    parser.add_argument('--repsPerSet', type=int, default=8, help='Synthetic pullups per set')
+    parser.add_argument('--restSeconds', type=float, default=60.0, help='Rest between synthetic sets')
+    parser.add_argument('--video', help='Recorded video served by the camera stand-in and run through the model instead of synthetic poses')
+    parser.add_argument('--truth', type=int, default=0, help='Pullups in one loop of the video')
+    parser.add_argument('--sampleInterval', type=float, default=60.0, help='Time in seconds between samples of resource use and latency')
+    parser.add_argument('--warmupSeconds', type=float, default=120.0, help='Resource use is compared with the first sample after this time')
+    parser.add_argument('--maxMemoryGrowthMb', type=float, default=50.0, help='Allowed growth of resident memory after warm up')
+    parser.add_argument('--maxFileGrowth', type=int, default=5, help='Allowed growth of open file descriptors after warm up')
+    parser.add_argument('--maxThreadGrowth', type=int, default=2, help='Allowed growth of threads after warm up')
+    parser.add_argument('--maxLatencyDrift', type=float, default=2.0, help='Allowed ratio of mean stage latency at the end to after warm up')
+    parser.add_argument('--minDriftMs', type=float, default=1.0, help='Stages faster than this at the end are not checked for drift')
+    parser.add_argument('--countTolerance', type=int, default=0, help='Allowed difference between counted and expected pullups')
+    parser.add_argument('--workFolder', help='Folder replacing data/ during the run, a temporary folder is used and deleted if not given')
+    parser.add_argument('--json', help='Write the report to this json file')
+    args = parser.parse_args()
+    args.seconds = args.hours * 3600 + args.minutes * 60
+    if args.seconds <= 0:
+        args.seconds = 600.0
+    if args.video is not None and args.truth <= 0:
+        parser.error('--truth is needed with --video')
+
+    # Counter files, history, keypoint store and video are written to the work folder
+    workFolderPath = args.workFolder if args.workFolder is not None else tempfile.mkdtemp(prefix='pullupSoak_')
+    redirectDataFolder(workFolderPath)
+    os.makedirs(workFolderPath, exist_ok=True)
+    # Latency drift is checked from the metrics registry
+    metricsRegistry.enabled = True
+    # Every part gets its own free port so a live counter on the same host is not disturbed
+    conf.data.apiHost = '127.0.0.1'
+    conf.data.apiPort = getFreePort()
+    conf.sonos.soundServerHost = '127.0.0.1'
+    conf.sonos.soundServerPort = 0
+    conf.sonos.soundServerAdvertiseHost = '127.0.0.1'
+    conf.data.operationMode = 'normal'
+    print('Soak test for ' + '{:.0f}'.format(args.seconds) + ' s, files written to ' + workFolderPath)
+
+    soakTest = soakTestClass(args)
+    soakTest.start()
+    wallStart = time.perf_counter()
+    try:
+        expected = soakTest.runVideo() if args.video is not None else soakTest.runSynthetic()
+    finally:
+        soakTest.stop()
+    failures = soakTest.getFailures(expected)
+    report = {
+        'passed': len(failures) == 0,
+        'failures': failures,
+        'expected': expected,
+        'counted': soakTest.pullupCounts,
+        'frames': soakTest.framesProcessed,
+        'wallSeconds': time.perf_counter() - wallStart,
+        'speaker': soakTest.speaker.counters,
+        'tracker': soakTest.athleteTracker.counters,
+        'samples': soakTest.samples,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.workFolder is None:
+        shutil.rmtree(workFolderPath, ignore_errors=True)
+    print('Counted ' + str(soakTest.pullupCounts) + ' of ' + str(expected) + ' pullups in ' + str(soakTest.framesProcessed) + ' frames')
+    if failures:
+        print('Soak test FAILED')
+        for failure in failures:
+            print('  ' + failure)
+        raise SystemExit(1)
+    print('Soak test passed')
@@ -0,0 +1,303 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Cache layer for SONOS speakers and the sound file catalog.
+# Avoids SONOS discovery and globbing of the sound folder for every counted pullup.
+# *********************************************************************************
+import json
+import os
+import re
+import random
+import threading
+import time
+# Load modules
+from commonConfig import commonConfigClass
+conf = commonConfigClass()
+
+
+class speakerCacheClass:
+    """
+    Class describing a cache of resolved SOCO devices per room.
+    Devices are rediscovered when the time to live has passed or when playing fails.
+    """
+
+    def __init__ (self, ttl=None):
+        """
+        Init function
+
+        ttl: float
+            Time in seconds a resolved speaker is trusted before discovery is run again
+        """
+        if ttl is None:
+            ttl = conf.sonos.speakerCacheTTL
+        self.ttl = ttl
+        # Dictionary with room as key and tuple (speaker, time of discovery) as value
+        self.speakers = {}
+        self.lock = threading.Lock()
+
+
+    def getSpeaker(self, room):
+        """
+        This function returns the SOCO device for a room, using discovery only if needed
+
+        room: string
+            SONOS room name
+        """
+        with self.lock:
+            cached = self.speakers.get(room)
+            if cached is not None and time.time() - cached[1] < self.ttl:
+                return cached[0]
+        # Discovery is slow, run it outside the lock
+        # soco is imported at first use so startup does not wait for it
+        from soco.discovery import by_name
+        speaker = by_name(room)
+        if speaker is None:
+            raise RuntimeError('SONOS speaker for room ' + str(room) + ' was not found')
+        with self.lock:
+            self.speakers[room] = (speaker, time.time())
+        return speaker
+
+
+    def invalidate(self, room):
+        """
+        This function removes a room from the cache so it is discovered again next time
+        """
+        with self.lock:
+            self.speakers.pop(room, None)
+
+
+    def play(self, room, soundFilePath, volume):
+        """
+        This function plays a sound URI on the speaker in a room.
+        If the cached speaker fails it is rediscovered and playing is tried once more.
+
+        room: string
+            SONOS room name
+        soundFilePath: string
+            Web adress of the sound file
+        volume: int
+            Volume to play on
+        """
+        for attempt in range(2):
+            speaker = self.getSpeaker(room)
+            try:
+                # Set the mute status and volume
+                speaker.mute = False
+                speaker.volume = volume
+                speaker.play_uri(soundFilePath)
+                return
+            except Exception as e:
+                # Speaker may have changed IP address or been restarted, rediscover it
+                self.invalidate(room)
+                if attempt == 1:
+                    raise e
+                print('Failed to play on cached SONOS speaker in ' + str(room) + ', reconnecting')
+
+
+class soundCatalogClass:
+    """
+    Class describing an index of the sound files available for SONOS.
+    Holds a pool of random sounds and a map of milestone sounds (for example 5pappa.mp3 for 5 pullups).
+    Milestones can also be listed in the milestone table file for any pullup count.
+    The index is rebuilt only when the modification time of the sound folders or the milestone table has changed.
+    """
+
+    def __init__ (self, soundBasePathLocal=None, soundBasePathWeb=None, checkInterval=None, milestoneTableFilePath=None):
+        """
+        Init function
+
+        soundBasePathLocal: string, the path to the folder containing the sound files on local disk
+        soundBasePathWeb: string, the webadress to the folder containing the sound files on the webserver
+        checkInterval: float, minimum time in seconds between checks of the folder modification times
+        milestoneTableFilePath: string, json file mapping pullup counts to sound files
+        """
+        if soundBasePathLocal is None:
+            soundBasePathLocal = conf.sonos.soundBasePath
+        if soundBasePathWeb is None:
+            soundBasePathWeb = conf.sonos.soundBasePathWeb
+        if checkInterval is None:
+            checkInterval = conf.sonos.soundCatalogCheckInterval
+        if milestoneTableFilePath is None:
+            milestoneTableFilePath = conf.sonos.milestoneTableFilePath
+        self.soundBasePathLocal = soundBasePathLocal
+        self.soundBasePathWeb = soundBasePathWeb
+        self.checkInterval = checkInterval
+        self.milestoneTableFilePath = milestoneTableFilePath
+        self.lock = threading.Lock()
+        # Index content
+        self.randomPool = []
+        self.milestones = {}
+        self.ooraSoundUrl = None
+        self.folderMtimes = {}
+        self.lastCheck = 0
+        # Sound chosen in advance for the next pullup, tuple (pullup count, theme, web adress)
+        self.nextSound = None
+        # Index is built at first use or by warm up in the background, not at startup
+
+
+    def toWebPath(self, soundFilePathLocal):
+        """
+        This function converts a local sound file path to the webadress of the file.
+        SOCO can only play from a webadress and not directly from a local path.
+        """
+        # Separate the path and get only the part after 'sounds'
+        soundFilePathGeneral = soundFilePathLocal.split('sounds')[1]
+        # Add the webadress to the file path and make sure all backslashes are replaced with forward slashes
+        soundFilePathWeb = self.soundBasePathWeb + soundFilePathGeneral
+        return soundFilePathWeb.replace('\\', '/')
+
+
+    def setWebBase(self, soundBasePathWeb):
+        """
+        This function changes the webadress of the sound folder, for example to the local sound server.
+        The index is rebuilt at next use.
+        """
+        with self.lock:
+            self.soundBasePathWeb = soundBasePathWeb
+            self.folderMtimes = {}
+            self.lastCheck = 0
+            self.nextSound = None
+
+
+    def getFolderMtimes(self):
+        """
+        This function returns the modification time of the sound folder and all its subfolders.
+        Adding, removing or renaming a file changes the modification time of its folder.
+        """
+        folderMtimes = {}
+        for folderPath, folderNames, fileNames in os.walk(self.soundBasePathLocal):
+            folderMtimes[folderPath] = os.stat(folderPath).st_mtime
+        if os.path.exists(self.milestoneTableFilePath):
+            folderMtimes[self.milestoneTableFilePath] = os.stat(self.milestoneTableFilePath).st_mtime
+        return folderMtimes
+
+
+    def loadMilestoneTable(self):
+        """
+        This function returns the milestone sounds from the milestone table file.
+        Returns a dictionary with pullup count as key and webadress as value, empty if there is no table.
+        """
+        if not os.path.exists(self.milestoneTableFilePath):
+            return {}
+        try:
+            with open(self.milestoneTableFilePath, 'r') as f:
+                milestoneTable = json.load(f)
+            milestoneTable = {int(pullupCounts): fileName for pullupCounts, fileName in milestoneTable.items()}
+        except (ValueError, AttributeError) as e:
+            print('Failed to read milestone table ' + self.milestoneTableFilePath)
+            print(e)
+            return {}
+        milestones = {}
+        for pullupCounts, fileName in milestoneTable.items():
+            soundFilePathLocal = os.path.join(self.soundBasePathLocal, fileName)
+            if not os.path.isfile(soundFilePathLocal):
+                print('Milestone sound ' + str(fileName) + ' for ' + str(pullupCounts) + ' pullups was not found')
+                continue
+            milestones[pullupCounts] = self.toWebPath(soundFilePathLocal)
+        return milestones
+
+
+    def build(self):
+        """
+        This function builds the index of random and milestone sounds.
+        For best compatibility, use mp3 files with SONOS.
+        """
+        randomPool = []
+        milestones = {}
+        ooraSoundUrl = None
+        folderMtimes = {}
+        for folderPath, folderNames, fileNames in os.walk(self.soundBasePathLocal):
+            folderMtimes[folderPath] = os.stat(folderPath).st_mtime
+            for fileName in sorted(fileNames):
+                if not fileName.endswith('.mp3'):
+                    continue
+                soundFilePathWeb = self.toWebPath(os.path.join(folderPath, fileName))
+                # Files named like 5pappa.mp3 are only used for pullup counts
+                milestoneMatch = re.match(r'^(\d+)pappa\.mp3$', fileName)
+                if milestoneMatch:
+                    milestones[int(milestoneMatch.group(1))] = soundFilePathWeb
+                    continue
+                if 'pappa' in fileName:
+                    continue
+                if fileName == conf.sonos.ooraSoundFileName:
+                    ooraSoundUrl = soundFilePathWeb
+                randomPool.append(soundFilePathWeb)
+        if os.path.exists(self.milestoneTableFilePath):
+            folderMtimes[self.milestoneTableFilePath] = os.stat(self.milestoneTableFilePath).st_mtime
+        milestones.update(self.loadMilestoneTable())
+        with self.lock:
+            self.randomPool = randomPool
+            self.milestones = milestones
+            self.ooraSoundUrl = ooraSoundUrl
+            self.folderMtimes = folderMtimes
+            self.lastCheck = time.time()
+            self.nextSound = None
+        print('Sound catalog built with ' + str(len(randomPool)) + ' random sounds and ' + str(len(milestones)) + ' milestone sounds')
+
+
+    def refreshIfChanged(self):
+        """
+        This function rebuilds the index if any sound folder has been modified.
+        Folders are checked at most once every checkInterval seconds.
+        """
+        if time.time() - self.lastCheck < self.checkInterval:
+            return
+        self.lastCheck = time.time()
+        try:
+            folderMtimes = self.getFolderMtimes()
+        except OSError as e:
+            print('Failed to check sound folder')
+            print(e)
+            return
+        if folderMtimes != self.folderMtimes:
+            print('Sound folder has changed, building sound catalog')
+            self.build()
+
+
+    def chooseSoundUrl(self, pullupCounts, theme):
+        """
+        This function chooses the sound for a pullup count. Called with the lock held.
+        """
+        if pullupCounts in self.milestones:
+            return self.milestones[pullupCounts]
+        if theme == 'random' and self.randomPool:
+            return random.choice(self.randomPool)
+        if theme == 'oora':
+            return self.ooraSoundUrl
+        return None
+
+
+    def getSoundUrl(self, pullupCounts, theme):
+        """
+        This function returns the webadress of the sound to play for a pullup count.
+        Milestone sounds override the theme. Returns None if there is nothing to play.
+        The sound chosen in advance by prepareNextSound is used if it was chosen for this count and theme.
+
+        pullupCounts: int
+            The pullup counter
+        theme: string
+            Sound theme from Home Assistant, 'random' or 'oora'
+        """
+        self.refreshIfChanged()
+        with self.lock:
+            if self.nextSound is not None and self.nextSound[:2] == (pullupCounts, theme):
+                soundUrl = self.nextSound[2]
+                self.nextSound = None
+                return soundUrl
+            return self.chooseSoundUrl(pullupCounts, theme)
+
+
+    def prepareNextSound(self, pullupCounts, theme):
+        """
+        This function chooses the sound of the next likely pullup in advance so it can be loaded before it is played.
+        Returns the webadress, None if there is nothing to play.
+
+        pullupCounts: int
+            The pullup count expected next
+        theme: string
+            Sound theme from Home Assistant, 'random' or 'oora'
+        """
+        self.refreshIfChanged()
+        with self.lock:
+            soundUrl = self.chooseSoundUrl(pullupCounts, theme)
+            self.nextSound = (pullupCounts, theme, soundUrl)
+        return soundUrl
@@ -0,0 +1,291 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Local HTTP file server for the SONOS sound files.
+# Serves the sounds folder so SONOS fetches the mp3 files from the counter itself
+# instead of an external web server. Connections are kept alive and the small mp3
+# files are held in memory, the next sound to play can be loaded in advance.
+# *********************************************************************************
+import os
+import socket
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+# Load modules
+from commonConfig import commonConfigClass
+conf = commonConfigClass()
+
+# Content types of the sound files SONOS can play
+contentTypes = {'.mp3': 'audio/mpeg', '.wav': 'audio/wav', '.flac': 'audio/flac', '.ogg': 'audio/ogg', '.m4a': 'audio/mp4'}
+# Multicast address of SONOS discovery (SSDP), the route to it is the route to the SONOS network
+sonosDiscoveryAddress = '239.255.255.250'
+
+
+def getLocalAddress(probeAddress=None):
+    """
+    This function returns the IP address of the network interface used to reach the SONOS network.
+    No packet is sent, the UDP socket is only connected to select the interface.
+
+    probeAddress: string
+        Address of a SONOS speaker or another host on the SONOS network, from config if not given.
+        The SONOS discovery multicast address is used if neither is set.
+    """
+    if probeAddress is None:
+        probeAddress = conf.sonos.soundServerProbeAddress
+    if probeAddress is None:
+        probeAddress = sonosDiscoveryAddress
+    probeSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probeSocket.connect((probeAddress, 1900))
+        return probeSocket.getsockname()[0]
+    except OSError:
+        print('No network interface towards ' + probeAddress + ', set sonos.soundServerAdvertiseHost so SONOS can reach the sound server')
+        return '127.0.0.1'
+    finally:
+        probeSocket.close()
+
+
+class soundFileCacheClass:
+    """
+    Class describing an in-memory cache of sound files.
+    A file is read again when its modification time or size has changed on disk.
+    The least recently used files are evicted when the cache is full.
+    """
+
+    def __init__ (self, folderPath, maxBytes=None):
+        """
+        Init function
+
+        folderPath: string
+            Folder served, files outside it are never read
+        maxBytes: int
+            Total size in bytes of cached files, files larger than this are served from disk
+        """
+        self.folderPath = os.path.realpath(folderPath)
+        self.maxBytes = conf.sonos.soundServerCacheBytes if maxBytes is None else maxBytes
+        self.lock = threading.Lock()
+        # File path as key and tuple (modification time, size, content) as value, least recently used first
+        self.files = OrderedDict()
+        self.totalBytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evicted': 0, 'uncached': 0}
+
+
+    def getFilePath(self, relativePath):
+        """
+        This function returns the local file path of a path relative to the served folder.
+        Returns None if the path is outside the folder or is not a file.
+        """
+        filePath = os.path.realpath(os.path.join(self.folderPath, relativePath.lstrip('/')))
+        if not filePath.startswith(self.folderPath + os.sep) or not os.path.isfile(filePath):
+            return None
+        return filePath
+
+
+    def get(self, relativePath):
+        """
+        This function returns the content of a file relative to the served folder, None if not found
+
+        relativePath: string
+            Path of the file relative to the served folder, for example military/5pappa.mp3
+        """
+        filePath = self.getFilePath(relativePath)
+        if filePath is None:
+            return None
+        fileStat = os.stat(filePath)
+        with self.lock:
+            cached = self.files.get(filePath)
+            if cached is not None and cached[0] == fileStat.st_mtime and cached[1] == fileStat.st_size:
+                self.files.move_to_end(filePath)
+                self.counters['hits'] += 1
+                return cached[2]
+        with open(filePath, 'rb') as f:
+            content = f.read()
+        with self.lock:
+            cached = self.files.pop(filePath, None)
+            if cached is not None:
+                self.totalBytes -= cached[1]
+            if len(content) > self.maxBytes:
+                self.counters['uncached'] += 1
+                return content
+            # Make room by evicting the least recently used files
+            while self.totalBytes + len(content) > self.maxBytes:
+                evictedPath, evicted = self.files.popitem(last=False)
+                self.totalBytes -= evicted[1]
+                self.counters['evicted'] += 1
+            self.files[filePath] = (fileStat.st_mtime, len(content), content)
+            self.totalBytes += len(content)
+            self.counters['misses'] += 1
+        return content
+
+
+class soundRequestHandler(BaseHTTPRequestHandler):
+    """
+    Class describing the HTTP handler serving the sound files under /sounds/.
+    HTTP/1.1 keeps the connection of the speaker open between pullups.
+    Single byte ranges are supported as SONOS may ask for them.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """
+        This function answers a GET request
+        """
+        self.sendFile(True)
+
+
+    def do_HEAD(self):
+        """
+        This function answers a HEAD request
+        """
+        self.sendFile(False)
+
+
+    def sendFile(self, sendBody):
+        """
+        This function sends a sound file from the cache
+        """
+        path = unquote(urlparse(self.path).path)
+        prefix = '/' + conf.sonos.soundServerUrlPath + '/'
+        content = self.server.fileCache.get(path[len(prefix):]) if path.startswith(prefix) else None
+        if content is None:
+            self.send_error(404)
+            return
+        start, end = 0, len(content) - 1
+        rangeHeader = self.headers.get('Range')
+        status = 200
+        if rangeHeader is not None and rangeHeader.startswith('bytes=') and ',' not in rangeHeader:
+            rangeStart, rangeEnd = rangeHeader[len('bytes='):].split('-', 1)
+            try:
+                if rangeStart == '':
+                    # Suffix range, the last bytes of the file
+                    start = max(0, len(content) - int(rangeEnd))
+                else:
+                    start = int(rangeStart)
+                    end = min(end, int(rangeEnd)) if rangeEnd != '' else end
+            except ValueError:
+                start, end = 0, len(content) - 1
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */' + str(len(content)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', contentTypes.get(os.path.splitext(path)[1].lower(), 'application/octet-stream'))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(end) + '/' + str(len(content)))
+        self.end_headers()
+        if sendBody:
+            self.wfile.write(content[start:end + 1])
+        # Requests are handled on one thread each
+        with self.server.countersLock:
+            self.server.counters['requests'] += 1
+
+
+    def log_message(self, format, *args):
+        """
+        This function silences the log line printed for every request
+        """
+        return
+
+
+class soundServerClass:
+    """
+    Class describing the local sound file server
+    """
+
+    def __init__ (self, folderPath=None, host=None, port=None, advertiseHost=None):
+        """
+        Init function
+
+        folderPath: string
+            Folder with the sound files, served under /sounds/
+        host: string
+            Host to listen on, from config if not given
+        port: int
+            Port to listen on, from config if not given
+        advertiseHost: string
+            Host name or IP address SONOS uses to reach the server, found from the network interface if not given
+        """
+        self.folderPath = conf.sonos.soundServerFolderPath if folderPath is None else folderPath
+        self.host = conf.sonos.soundServerHost if host is None else host
+        self.port = conf.sonos.soundServerPort if port is None else port
+        self.advertiseHost = conf.sonos.soundServerAdvertiseHost if advertiseHost is None else advertiseHost
+        self.fileCache = soundFileCacheClass(self.folderPath)
+        self.server = None
+        self.thread = None
+
+
+    def start(self):
+        """
+        This function starts the server on a daemon thread. Returns True if started.
+        """
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), soundRequestHandler)
+        except OSError as e:
+            print('Failed to start sound server')
+            print(e)
+            self.server = None
+            return False
+        self.server.daemon_threads = True
+        self.server.fileCache = self.fileCache
+        self.server.counters = {'requests': 0}
+        self.server.countersLock = threading.Lock()
+        # Port 0 selects a free port
+        self.port = self.server.server_address[1]
+        if self.advertiseHost is None:
+            self.advertiseHost = getLocalAddress()
+        self.thread = threading.Thread(target=self.server.serve_forever, name='pullupSoundServer', daemon=True)
+        self.thread.start()
+        print('Sound files served on ' + self.getBaseUrl())
+        return True
+
+
+    def stop(self):
+        """
+        This function stops the server
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            self.thread = None
+
+
+    def getBaseUrl(self):
+        """
+        This function returns the web adress of the sound folder, used instead of sonos.soundBasePathWeb
+        """
+        return 'http://' + self.advertiseHost + ':' + str(self.port) + '/' + conf.sonos.soundServerUrlPath
+
+
+    def preload(self, soundUrl):
+        """
+        This function reads a sound file into the cache so it is served from memory when SONOS asks for it
+
+        soundUrl: string
+            Web adress of the sound file from the sound catalog
+        """
+        baseUrl = self.getBaseUrl()
+        if soundUrl is None or not soundUrl.startswith(baseUrl + '/'):
+            return
+        try:
+            self.fileCache.get(unquote(soundUrl[len(baseUrl) + 1:]))
+        except OSError as e:
+            print('Failed to preload sound file')
+            print(e)
+
+
+    def getMetrics(self):
+        """
+        This function returns the counters of the server and the file cache
+        """
+        metrics = dict(self.fileCache.counters, cachedBytes=self.fileCache.totalBytes)
+        if self.server is not None:
+            with self.server.countersLock:
+                metrics['requests'] = self.server.counters['requests']
+        return metrics
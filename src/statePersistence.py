@@ -0,0 +1,296 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Atomic and batched persistence of pullup counter and time stamps.
+# One consolidated state record is written together with the legacy txt files
+# read by Home Assistant. Home Assistant resets the counter by writing 0 to the
+# legacy counter file. The reset is detected here, from the modification time and
+# size of the file compared with the last write, so it is never overwritten.
+# *********************************************************************************
+import os
+import json
+import tempfile
+import threading
+import time
+# Load modules
+from commonConfig import commonConfigClass
+conf = commonConfigClass()
+
+
+def writeFileAtomic(filePath, text, fsync=False):
+    """
+    This function writes text to a file by writing a temporary file and renaming it.
+    A concurrent reader sees either the old or the new content, never a truncated file.
+
+    filePath: string
+        Path of the file to write
+    text: string
+        Content to write
+    fsync: bool
+        Force content to disk before the rename
+    """
+    folderPath = os.path.dirname(filePath)
+    # Temporary file must be in the same folder for the rename to be atomic
+    fileDescriptor, tempFilePath = tempfile.mkstemp(dir=folderPath, prefix='.' + os.path.basename(filePath), suffix='.tmp')
+    try:
+        with os.fdopen(fileDescriptor, 'w') as f:
+            f.write(text)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        # Keep file readable for Home Assistant, mkstemp creates it with mode 600
+        os.chmod(tempFilePath, 0o644)
+        os.replace(tempFilePath, filePath)
+    except Exception:
+        if os.path.exists(tempFilePath):
+            os.remove(tempFilePath)
+        raise
+
+
+class statePersistenceClass:
+    """
+    Class describing the persisted pullup state.
+    Updates are kept in memory and written on a short flush interval by a background thread.
+    """
+
+    def __init__ (self, flushInterval=None, fsync=None, dataFolderPath=None):
+        """
+        Init function
+
+        flushInterval: float
+            Time in seconds between writes of changed state
+        fsync: bool
+            Force written files to disk
+        dataFolderPath: string
+            Folder for the state files, the files set in config are used if not given
+        """
+        if flushInterval is None:
+            flushInterval = conf.data.persistenceFlushInterval
+        if fsync is None:
+            fsync = conf.data.persistenceFsync
+        self.flushInterval = flushInterval
+        self.fsync = fsync
+        # State held in memory and last values written to the legacy files
+        self.state = {'pullupCounts': 0, 'pullupTimeFirst': 'Reset', 'pullupTimeLast': 'Reset'}
+        self.legacyWritten = {}
+        # Modification time and size of the legacy counter file after it was last written or read here
+        self.legacyCountsStat = None
+        # Increased at every reset, updates from pullups counted before the reset are dropped
+        self.resetGeneration = 0
+        # State record and legacy file path for each value, kept in sync for existing integrations
+        if dataFolderPath is None:
+            self.stateFilePath = conf.base.pullupStateFilePath
+            self.legacyFilePaths = {
+                'pullupCounts': conf.base.pullupCountsFilePath,
+                'pullupTimeFirst': conf.base.pullupTimeFirstFilePath,
+                'pullupTimeLast': conf.base.pullupTimeLastFilePath,
+            }
+        else:
+            os.makedirs(dataFolderPath, exist_ok=True)
+            self.stateFilePath = os.path.join(dataFolderPath, conf.base.pullupStateFileName)
+            self.legacyFilePaths = {
+                'pullupCounts': os.path.join(dataFolderPath, conf.base.pullupCountsFileName),
+                'pullupTimeFirst': os.path.join(dataFolderPath, conf.base.pullupTimeFirstFileName),
+                'pullupTimeLast': os.path.join(dataFolderPath, conf.base.pullupTimeLastFileName),
+            }
+        self.dirty = False
+        self.lock = threading.Lock()
+        # Held while the legacy counter file is written or checked for an external reset
+        self.fileLock = threading.Lock()
+        self.flushEvent = threading.Event()
+        self.running = False
+        self.thread = None
+
+
+    def getFileStat(self, filePath):
+        """
+        This function returns modification time and size of a file, None if missing
+        """
+        try:
+            fileStat = os.stat(filePath)
+        except OSError:
+            return None
+        return (fileStat.st_mtime_ns, fileStat.st_size)
+
+
+    def readLegacyFile(self, key):
+        """
+        This function reads a legacy file, returns None if missing or invalid
+        """
+        try:
+            with open(self.legacyFilePaths[key], 'r') as f:
+                text = f.read().strip()
+            if key == 'pullupCounts':
+                return int(text)
+            return text
+        except (OSError, ValueError):
+            return None
+
+
+    def load(self):
+        """
+        This function loads the state record, falling back to the legacy files if it is missing or invalid.
+        Returns a copy of the loaded state.
+        """
+        loaded = None
+        try:
+            with open(self.stateFilePath, 'r') as f:
+                loaded = json.load(f)
+            loaded['pullupCounts'] = int(loaded['pullupCounts'])
+        except (OSError, ValueError, KeyError, TypeError):
+            loaded = None
+        if loaded is None:
+            loaded = {}
+            for key in self.legacyFilePaths:
+                value = self.readLegacyFile(key)
+                if value is not None:
+                    loaded[key] = value
+        # Home Assistant resets the counter through the legacy file, it wins over the state record
+        with self.fileLock:
+            self.legacyCountsStat = self.getFileStat(self.legacyFilePaths['pullupCounts'])
+            legacyCounts = self.readLegacyFile('pullupCounts')
+        if legacyCounts == 0:
+            loaded['pullupCounts'] = 0
+        with self.lock:
+            for key in self.state:
+                if key in loaded:
+                    self.state[key] = loaded[key]
+            self.dirty = True
+            return dict(self.state)
+
+
+    def get(self):
+        """
+        This function returns a copy of the state held in memory
+        """
+        with self.lock:
+            return dict(self.state)
+
+
+    def update(self, resetGeneration=None, **values):
+        """
+        This function updates values in memory. They are written at the next flush.
+        If the background thread is not started the values are written directly.
+        Returns False if the values were dropped.
+
+        resetGeneration: int
+            Reset generation the values were counted in, values from before the last reset are dropped
+        """
+        with self.lock:
+            if resetGeneration is not None and resetGeneration != self.resetGeneration:
+                return False
+            self.state.update(values)
+            self.dirty = True
+        if not self.running:
+            self.flush()
+        return True
+
+
+    def reset(self):
+        """
+        This function resets the pullup counter. Updates of pullups counted before are dropped.
+        Returns the new reset generation.
+        """
+        with self.lock:
+            self.state['pullupCounts'] = 0
+            self.resetGeneration += 1
+            self.dirty = True
+            resetGeneration = self.resetGeneration
+        self.flushEvent.set()
+        if not self.running:
+            self.flush()
+        return resetGeneration
+
+
+    def checkExternalReset(self):
+        """
+        This function resets the counter if another program has written 0 to the legacy counter file.
+        Our own writes are recognised by the modification time and size of the file. Returns True if reset.
+        """
+        filePath = self.legacyFilePaths['pullupCounts']
+        with self.fileLock:
+            fileStat = self.getFileStat(filePath)
+            if fileStat is None or fileStat == self.legacyCountsStat:
+                return False
+            self.legacyCountsStat = fileStat
+            legacyCounts = self.readLegacyFile('pullupCounts')
+            # Content is forgotten so the file is written again, also if it is set back to the current count
+            self.legacyWritten.pop('pullupCounts', None)
+        if legacyCounts != 0 or self.get()['pullupCounts'] == 0:
+            return False
+        print('Pullup counter file ' + filePath + ' was reset to 0')
+        self.reset()
+        return True
+
+
+    def flush(self):
+        """
+        This function writes the state record and changed legacy files if anything has changed
+        """
+        # An external reset written since the last flush must win over the count held in memory
+        self.checkExternalReset()
+        with self.lock:
+            if not self.dirty:
+                return
+            state = dict(self.state)
+            self.dirty = False
+        try:
+            record = dict(state)
+            record['updated'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+            writeFileAtomic(self.stateFilePath, json.dumps(record), self.fsync)
+            for key, filePath in self.legacyFilePaths.items():
+                # Only rewrite legacy files whose value changed
+                if self.legacyWritten.get(key) == state[key] and os.path.exists(filePath):
+                    continue
+                if key == 'pullupCounts':
+                    with self.fileLock:
+                        # Reset written after the check above, written again at next flush
+                        if self.getFileStat(filePath) != self.legacyCountsStat:
+                            with self.lock:
+                                self.dirty = True
+                            continue
+                        writeFileAtomic(filePath, str(state[key]), self.fsync)
+                        self.legacyCountsStat = self.getFileStat(filePath)
+                else:
+                    writeFileAtomic(filePath, str(state[key]), self.fsync)
+                self.legacyWritten[key] = state[key]
+        except Exception as e:
+            # Try again at next flush
+            with self.lock:
+                self.dirty = True
+            print('Failed to write pullup state to file')
+            print(e)
+
+
+    def start(self):
+        """
+        This function starts the background flush thread
+        """
+        if self.running:
+            return
+        self.running = True
+        self.flushEvent.clear()
+        self.thread = threading.Thread(target=self.worker, name='pullupStatePersistence', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """
+        This function stops the background flush thread and writes remaining changes
+        """
+        self.running = False
+        self.flushEvent.set()
+        if self.thread is not None:
+            self.thread.join(5.0)
+            self.thread = None
+        self.flush()
+
+
+    def worker(self):
+        """
+        This function flushes changed state with regular intervals until stopped
+        """
+        while self.running:
+            self.flushEvent.wait(self.flushInterval)
+            # Cleared before flushing, a reset during the flush wakes the thread again
+            self.flushEvent.clear()
+            self.flush()
@@ -4,13 +4,21 @@
 # *********************************************************************************
 import numpy as np
 import os
-import random
-import chime
-from soco.discovery import by_name
-import glob
+import threading
+import cv2
 import time 
 # Load modules
 from commonConfig import commonConfigClass
+from eventDispatcher import eventDispatcherClass
+from sonosCache import speakerCacheClass, soundCatalogClass
+from controlState import controlStateClass
+from statePersistence import statePersistenceClass
+from keypointFiles import writeKeypointTxt
+from videoRecorder import videoRecorderClass
+from metrics import metricsRegistry
+from apiServer import apiServerClass
+from soundServer import soundServerClass
+from repHistory import repHistoryClass
 conf = commonConfigClass() 
 
 
@@ -23,201 +31,352 @@ class supportMethodsClass:
         """
         Init function
         """
-        pass
-
-
-    def getRandomSoundFilePath(self, soundBasePathThemeLocal, soundBasePathWeb):
-        """
-        This function returns a random file path from the soundBasePathLocal folder.
-        This is selcted from local data. 
-        Data must also be available on a webserver.
-        This is because SOCO can only play from a webadress and not directly from a local path.
-
-        input: 
-        soundBasePathThemeLocal: string, the path to the folder containing the sound files on local disk
-        soundBasePathWeb: string, the webadress to the folder containing the sound files on the webserver
-        """
-        # Use glob to get all paths of all files in the directory. It could be wav or mp3 files.
-        # For best compatibility, use mp3 files with SONOS. 
-        # Use the '**' pattern to match all files in subdirectories. Requires mp3.
-        # Recursive=True means that it will search in all subdirectories
-        allSoundFilePathsLocal = glob.glob(os.path.join(soundBasePathThemeLocal, '**', '*.mp3'), recursive=True)
-        # Remove all files containing the word "pappa" as these are only used for pullup counts
-        allSoundFilePathsLocal = [x for x in allSoundFilePathsLocal if 'pappa' not in x]        
-        # Select a random file from the list
-        soundFilePathLocal = random.choice(allSoundFilePathsLocal)
-        # Assert that the file exists
-        assert os.path.exists(soundFilePathLocal), 'The path to the sound file does not exist'
-        # Separate the path and get only the part after 'sounds'
-        # We need to do this to get the webbadress to the file from the webserver
-        soundFilePathGeneral = soundFilePathLocal.split('sounds')[1]
-        # Add the webadress to the file path
-        soundFilePathWeb = soundBasePathWeb + soundFilePathGeneral
-        # Make sure all backslashes are replaced with forward slashes as this is a http adress
-        soundFilePathWeb = soundFilePathWeb.replace('\\', '/')
-        # Return the path to the file
-        return soundFilePathWeb
+        # Background dispatcher for pullup side effects, started by startEventDispatcher
+        self.eventDispatcher = None
+        # Cached SONOS speakers and index of sound files built once at startup
+        self.speakerCache = speakerCacheClass()
+        self.soundCatalog = soundCatalogClass()
+        # Pullup counter and time stamps, written atomically in the background
+        self.statePersistence = statePersistenceClass()
+        # Home Assistant settings held in memory and refreshed in the background
+        self.controlState = controlStateClass()
+        self.controlState.registerCallback('operationMode', self.onOperationModeChanged)
+        # Operation mode file is read once by the control state, not by the configuration
+        conf.data.operationMode = self.controlState.get('operationMode')
+        self.controlState.registerCallback('pullupCounts', self.onPullupCountsChanged)
+        # Reset generation of the pullup state the counter has counted in, a newer generation means a reset
+        self.pullupCountsGeneration = 0
+        # Segment rotated recorder for the annotated video, started at first saved frame
+        self.videoRecorder = None
+        # Local API server pushing pullup events, started by startApiServer
+        self.apiServer = None
+        # Local file server for the SONOS sound files, started by startSoundServer
+        self.soundServer = None
+        # History of every counted pullup, started by startRepHistory
+        self.repHistory = None
 
 
     def getHASoundStatus(self):
         """
         This function returns the status of the Home Assistant pullup sound switch.
+        Value is held in memory by the control state.
         """
-        # Read the file with the switch status
-        with open(conf.sonos.HASoundStatusFilePath, 'r') as f:
-            # Read the status
-            HASoundStatus = f.read()
-            # Newline character included, use in
-            if 'on' in HASoundStatus:
-                HASoundStatusLogic = True
-            else:
-                HASoundStatusLogic = False
-            # Return the status
-            return HASoundStatusLogic
+        return self.controlState.get('soundStatus')
         
 
     def getHASoundTheme(self):
         """
         This function returns the theme of the Home Assistant pullup sound.
+        Value is held in memory by the control state.
         """
-        # Read the file with the switch status
-        with open(conf.sonos.HASoundThemeFilePath, 'r') as f:
-            # Read the status
-            HASoundTheme = f.read()
-            # Newline character included, use in
-            if 'oora' in HASoundTheme:
-                HASoundTheme = 'oora'
-            if 'random' in HASoundTheme:
-                HASoundTheme = 'random'
-            # Return the status
-            return HASoundTheme
+        return self.controlState.get('soundTheme')
     
     
     def getHASonosRoom(self):
         """
         This function returns the room of the Home Assistant Sonos selection
+        Value is held in memory by the control state.
         """
-        # Read the file with the switch status
-        with open(conf.sonos.HASoundRoomFilePath, 'r') as f:
-            # Read the status
-            HASonosRoom = f.read()
-            # Newline character included, use in
-            if 'Koket' in HASonosRoom:
-                HASonosRoom = 'Koket'
-            if 'Uterummet' in HASonosRoom:
-                HASonosRoom = 'Uterummet'
-            if 'Kontoret' in HASonosRoom:
-                HASonosRoom = 'Kontoret'
-            # Return the status
-            return HASonosRoom
+        return self.controlState.get('sonosRoom')
                 
 
     def getHASonosVolume(self): 
         """
         This function returns the volume of the Home Assistant Sonos selection
+        Value is held in memory by the control state.
+        """
+        return self.controlState.get('sonosVolume')
+
+
+    def onOperationModeChanged(self, key, oldValue, newValue):
+        """
+        This function switches operation mode live when Home Assistant changes it
+        """
+        print('Operation mode changed from ' + str(oldValue) + ' to ' + str(newValue))
+        conf.data.operationMode = newValue
+
+
+    def onPullupCountsChanged(self, key, oldValue, newValue):
+        """
+        This function lets the state persistence check for a reset when the pullup counter file changes.
+        The persistence tells a reset by Home Assistant from its own writes.
+        """
+        if newValue == 0:
+            self.statePersistence.checkExternalReset()
+
+
+    def resetPullupCounts(self):
+        """
+        This function resets the pullup counter as if Home Assistant had written 0 to the counter file
+        """
+        print('Pullup counter reset from API')
+        self.statePersistence.reset()
+
+
+    def startApiServer(self):
+        """
+        This function starts the local API server if enabled. Returns the server or None.
+        """
+        if not conf.data.apiEnabled:
+            return None
+        self.apiServer = apiServerClass(self)
+        self.apiServer.start()
+        return self.apiServer
+
+
+    def stopApiServer(self):
+        """
+        This function stops the local API server if started
+        """
+        if self.apiServer is not None:
+            self.apiServer.stop()
+            self.apiServer = None
+
+
+    def publishPullupEvent(self, event):
+        """
+        This function pushes a pullup event to the clients of the API server.
+        Used as a stage in the event dispatcher.
+        """
+        if self.apiServer is None:
+            return
+        message = {'type': 'pullup', 'pullupCounts': event['pullupCounts'], 'pullupTimeLast': event['pullupTimeLast'], 'stream': event.get('streamName')}
+        if event.get('repEvent') is not None:
+            message['repDuration'] = event['repEvent']['repDuration']
+            message['peakHeight'] = event['repEvent']['peakHeight']
+        self.apiServer.publish(message)
+
+
+    def startRepHistory(self):
+        """
+        This function starts the pullup history writer if enabled. Returns the history or None.
+        """
+        if not conf.data.repHistoryEnabled:
+            return None
+        self.repHistory = repHistoryClass()
+        try:
+            self.repHistory.start()
+        except Exception as e:
+            # Counting continues without history
+            print('Failed to open pullup history ' + self.repHistory.databaseFilePath)
+            print(e)
+            self.repHistory = None
+            return None
+        metricsRegistry.registerCollector('repHistory', lambda: self.repHistory.counters)
+        return self.repHistory
+
+
+    def stopRepHistory(self):
+        """
+        This function writes the remaining pullups to the history and stops the writer
+        """
+        if self.repHistory is not None:
+            metricsRegistry.unregisterCollector('repHistory')
+            self.repHistory.stop()
+            print('Pullup history: ' + str(self.repHistory.counters))
+            self.repHistory = None
+
+
+    def startSoundServer(self):
+        """
+        This function starts the local sound file server if enabled and plays sounds from it instead of the webserver.
+        Must be called before startWarmUp so the sound catalog is built with the local web adresses.
+        """
+        if not conf.sonos.soundServerEnabled:
+            return None
+        self.soundServer = soundServerClass()
+        if not self.soundServer.start():
+            # Sounds are played from the webserver in sonos.soundBasePathWeb
+            self.soundServer = None
+            return None
+        self.soundCatalog.setWebBase(self.soundServer.getBaseUrl())
+        metricsRegistry.registerCollector('soundServer', self.soundServer.getMetrics)
+        return self.soundServer
+
+
+    def stopSoundServer(self):
+        """
+        This function stops the local sound file server if started
+        """
+        if self.soundServer is not None:
+            metricsRegistry.unregisterCollector('soundServer')
+            self.soundServer.stop()
+            self.soundServer = None
+
+
+    def prepareNextSound(self, pullupCounts):
+        """
+        This function chooses the sound of the next pullup and loads it into the sound server cache
+
+        pullupCounts: int
+            The pullup count expected next
+        """
+        soundFilePath = self.soundCatalog.prepareNextSound(pullupCounts, self.getHASoundTheme())
+        if self.soundServer is not None:
+            self.soundServer.preload(soundFilePath)
+
+
+    def startWarmUp(self):
+        """
+        This function runs slow side effect setup in the background so it does not delay the first counted pullup
+        """
+        threading.Thread(target=self.warmUp, name='pullupWarmUp', daemon=True).start()
+
+
+    def warmUp(self):
+        """
+        This function builds the sound catalog, loads the first sound and resolves the SONOS speaker before the first pullup needs them
+        """
+        try:
+            self.soundCatalog.build()
+            self.prepareNextSound(self.statePersistence.get()['pullupCounts'] + 1)
+            if conf.data.playSonos==True and self.getHASoundStatus()==True and self.getHASonosRoom() is not None:
+                self.speakerCache.getSpeaker(self.getHASonosRoom())
+        except Exception as e:
+            print('Failed to warm up SONOS')
+            print(e)
+
+
+    def startControlState(self):
+        """
+        This function starts watching the Home Assistant setting files in the background
         """
-        # Read the file with the switch status
-        with open(conf.sonos.HASoundVolumeFilePath, 'r') as f:
-            # Read the status
-            HASonosVolume = int(f.read())
-            # Should be equal to 10,20,30,40,50,60,70,80,90,100, assert this
-            assert HASonosVolume in [10,20,30,40,50,60,70,80,90,100], 'Volume is not in the list [10,20,30,40,50,60,70,80,90,100]'
-            # Return the status
-            return HASonosVolume
+        self.controlState.start()
     
 
-    def playOnSonos(self, pullupCounts):
+    def playOnSonos(self, pullupCounts, room=None):
         """
         This function plays a sound, defined from a file, on the SONOS device.
+        Speakers and sound files are taken from cache to avoid discovery and globbing on every pullup.
         inputs:
         pullupCounts: int
             The pullup counter 
+        room: string
+            SONOS room to play in, the Home Assistant selection is used if not given
         """
-        # Get the room to play sound in
-        room = self.getHASonosRoom()
-        # Define the speaker to play on using the room name and SOCO
-        speaker = by_name(room)
-        # Get the volume to play on
+        # Get the room, volume and theme to play with
+        if room is None:
+            room = self.getHASonosRoom()
         volume = self.getHASonosVolume()
+        theme = self.getHASoundTheme()
         # Print volume
         #print('Playing sound in room: ' + room + ' with volume ' + str(volume))
 
-        #print('Playing sound in room: ' + room)
-        if self.getHASoundTheme() == 'random':
-            # Get a random sound file path
-            soundFilePath = self.getRandomSoundFilePath(conf.sonos.soundBasePath, conf.sonos.soundBasePathWeb)
-            # Print the sound file path
-            #print('Playing sound from file: ' + soundFilePath)
-
-        if self.getHASoundTheme() == 'oora': 
-            # Set the path to the sound file oorah.mp3
-            soundFilePath = os.path.join('http://192.168.1.2/sounds/military', 'oorah.mp3')
-            soundFilePath = soundFilePath.replace('\\', '/')
-            #print('Playing sound from file: ' + soundFilePath)
-
-        # Override determined sound file if pullupCounts is 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, or 55
-        if pullupCounts == 5: 
-            soundFilePath = os.path.join('http://192.168.1.2/sounds/military', '5pappa.mp3')
-        if pullupCounts == 10: 
-            soundFilePath = os.path.join('http://192.168.1.2/sounds/military', '10pappa.mp3')
-        if pullupCounts == 15: 
-            soundFilePath = os.path.join('http://192.168.1.2/sounds/military', '15pappa.mp3')
-        if pullupCounts == 20: 
-            soundFilePath = os.path.join('http://192.168.1.2/sounds/military', '20pappa.mp3')
-        if pullupCounts == 25: 
-            soundFilePath = os.path.join('http://192.168.1.2/sounds/military', '25pappa.mp3')
-        if pullupCounts == 30: 
-            soundFilePath = os.path.join('http://192.168.1.2/sounds/military', '30pappa.mp3')
-        if pullupCounts == 35: 
-            soundFilePath = os.path.join('http://192.168.1.2/sounds/military', '35pappa.mp3')
-        if pullupCounts == 40: 
-            soundFilePath = os.path.join('http://192.168.1.2/sounds/military', '40pappa.mp3')
-        if pullupCounts == 45: 
-            soundFilePath = os.path.join('http://192.168.1.2/sounds/military', '45pappa.mp3')
-        if pullupCounts == 50: 
-            soundFilePath = os.path.join('http://192.168.1.2/sounds/military', '50pappa.mp3')
-        if pullupCounts == 55: 
-            soundFilePath = os.path.join('http://192.168.1.2/sounds/military', '55pappa.mp3')            
-            
-        # Set the mute status and volume 
-        speaker.mute = False
-        speaker.volume = volume
-        # Print the sound file path
-        speaker.play_uri(soundFilePath)
+        # Get sound from catalog, milestone sounds override the theme
+        # Usually chosen and loaded into the sound server after the previous pullup
+        soundFilePath = self.soundCatalog.getSoundUrl(pullupCounts, theme)
+        if soundFilePath is None:
+            print('No sound found for theme ' + str(theme))
+            return
+        #print('Playing sound from file: ' + soundFilePath)
+        # Play on cached speaker, rediscovered if it fails
+        self.speakerCache.play(room, soundFilePath, volume)
+        # Choose and load the sound of the next pullup while the athlete is doing it
+        self.prepareNextSound(pullupCounts + 1)
     
 
     def writeTimeStampFirstPullup(self, pullupTimeFirst):
         """
         This function writes the time stamps for first pullup
+        Written atomically together with the pullup state at next flush.
         """
-        # Write time stamp to first file
-        #print('Writing time stamps to first file')
-        try: 
-            with open(conf.base.pullupTimeFirstFilePath, 'w') as f:
-                f.write(str(pullupTimeFirst))
-        except Exception as e:
-            print('Failed to write time stamps to file')
-            print(e)
+        self.statePersistence.update(pullupTimeFirst=str(pullupTimeFirst))
 
 
     def writeTimeStampLastPullup(self, pullupTimeLast):
         """
         This function writes the time stamps for last pullup
+        Written atomically together with the pullup state at next flush.
         """
-        # Write time stamp to last file
-        #print('Writing time stamps to last file')
-        try: 
-            with open(conf.base.pullupTimeLastFilePath, 'w') as f:
-                f.write(str(pullupTimeLast))
-        except Exception as e:
-            print('Failed to write time stamps to file')
-            print(e)
+        self.statePersistence.update(pullupTimeLast=str(pullupTimeLast))
+
+
+    def writePullupFiles(self, event):
+        """
+        This function writes the pullup counter and time stamps of a pullup event to file.
+        Used as a stage in the event dispatcher.
+
+        event: dict
+            Pullup event with pullupCounts, pullupTimeFirst and pullupTimeLast.
+            Events from a stream in multi-stream mode carry the statePersistence of the stream.
+        """
+        values = {'pullupCounts': event['pullupCounts'], 'pullupTimeLast': str(event['pullupTimeLast'])}
+        # First time stamp is only set for the first pullup after a reset
+        if event.get('pullupTimeFirst') is not None:
+            values['pullupTimeFirst'] = str(event['pullupTimeFirst'])
+        statePersistence = event.get('statePersistence') or self.statePersistence
+        # Pullups counted before a reset that happened while the event was queued are not written
+        statePersistence.update(event.get('resetGeneration'), **values)
+
+
+    def loadPullupState(self):
+        """
+        This function loads the persisted pullup count and starts the background flush of the state.
+        Returns the pullup count.
+        """
+        state = self.statePersistence.load()
+        self.pullupCountsGeneration = self.statePersistence.resetGeneration
+        self.statePersistence.start()
+        return state['pullupCounts']
+
+
+    def stopPullupState(self):
+        """
+        This function writes remaining pullup state and stops the background flush
+        """
+        self.statePersistence.stop()
+
+
+    def playPullupSonos(self, event):
+        """
+        This function plays a sound on SONOS for a pullup event if enabled.
+        Used as a stage in the event dispatcher.
+        """
+        if conf.data.playSonos==True and self.getHASoundStatus()==True:
+            #print('Playing sound on SONOS')
+            self.playOnSonos(event['pullupCounts'], event.get('sonosRoom'))
+
+
+    def playPullupChime(self, event):
+        """
+        This function plays a beep for a pullup event if enabled.
+        Used as a stage in the event dispatcher.
+        """
+        if conf.data.playSound==True:
+            # chime is imported at first use, it is not used on the Linux server
+            import chime
+            chime.theme(conf.data.soundTheme)
+            chime.success()
 
 
-    def pullupCounterAdd(self, pullupCounts, beenUp, beenDown):
+    def startEventDispatcher(self):
+        """
+        This function starts the background dispatcher for pullup side effects.
+        Without a started dispatcher the side effects are run directly in pullupCounterAdd.
+        """
+        # Files are written first so Home Assistant is updated even if SONOS is slow
+        stages = [('files', self.writePullupFiles), ('api', self.publishPullupEvent), ('sonos', self.playPullupSonos), ('chime', self.playPullupChime)]
+        self.eventDispatcher = eventDispatcherClass(stages)
+        self.eventDispatcher.start()
+        metricsRegistry.registerCollector('eventDispatcher', self.eventDispatcher.getMetrics)
+
+
+    def stopEventDispatcher(self):
+        """
+        This function stops the background dispatcher after remaining events are handled
+        """
+        if self.eventDispatcher is not None:
+            self.eventDispatcher.stop()
+            self.eventDispatcher.printMetrics()
+            metricsRegistry.unregisterCollector('eventDispatcher')
+            self.eventDispatcher = None
+
+
+    def pullupCounterAdd(self, pullupCounts, beenUp, beenDown, repEvent=None, stream=None):
         """
         Function to add a pullup to pullup counter if conditions are met.
         Conditions helps to avoid double counting of pullups when object is above the bar.
+        SONOS, chime and file updates are handed over to the event dispatcher.
 
         pullupCounts: int
             Pullup counter
@@ -225,7 +384,13 @@ class supportMethodsClass:
             Flag if athlete has been above bar
         beenDown: bool
             Flag if athlete has been below bar
+        repEvent: dict
+            Optional pullup event from the rep detector, passed on to the side effects
+        stream: pullupStreamClass
+            Stream in multi-stream mode with its own reset flag, state files and SONOS room
         """
+        # Reset generation and state files belong to the stream in multi-stream mode
+        owner = self if stream is None else stream
         # Add pullup if conditions are met
         if (beenUp == True and beenDown == True):
             # Get time point of pullup
@@ -233,46 +398,42 @@ class supportMethodsClass:
             # Format into string
             nowString = time.strftime("%Y-%m-%d %H:%M:%S", now)
 
-            # Check if pullupCountsFilePath has a 0 after being reset
+            # Check if the counter has been reset by Home Assistant or the API since the last pullup
             # If so, set pullupCounts in this counter to 0
-            with open(conf.base.pullupCountsFilePath, 'r') as f:
-                pullupCountsFromFile = int(f.read())
-                if pullupCountsFromFile==0: 
-                    print('Pullup counter was reset, setting it to 0')
-                    pullupCounts = 0
+            resetGeneration = owner.statePersistence.resetGeneration
+            if resetGeneration != owner.pullupCountsGeneration:
+                owner.pullupCountsGeneration = resetGeneration
+                print('Pullup counter was reset, setting it to 0')
+                pullupCounts = 0
 
-            # If this is the first pullup store it in a new variable
+            # If this is the first pullup store it as both first and last time stamp
+            pullupTimeFirst = None
             if pullupCounts == 0:
                 pullupTimeFirst = nowString
-                pullupTimeLast = nowString
-                # Write time stamps to file
-                self.writeTimeStampFirstPullup(pullupTimeFirst)
-                self.writeTimeStampLastPullup(pullupTimeLast)
-            # If this is not the first pullup, store it in the last pullup variable
-            if pullupCounts >= 1:
-                pullupTimeLast = nowString
-                self.writeTimeStampLastPullup(pullupTimeLast)
+            pullupTimeLast = nowString
 
             # Add to pullup counter
             pullupCounts = pullupCounts + 1
+            metricsRegistry.increment('pullups')
 
-            # Play randomize sound on SONOS
-            # put it in try/except to avoid error for missing network access
-            try: 
-                if conf.data.playSonos==True and self.getHASoundStatus()==True:
-                    #print('Playing sound on SONOS')
-                    self.playOnSonos(pullupCounts)
-            except Exception as e:
-                print('Failed to play sound on SONOS')
-                print(e)
-
-            # Write pullup counter to file
-            with open(conf.base.pullupCountsFilePath, 'w') as f:
-                f.write(str(pullupCounts))
-            # Play a beep
-            if conf.data.playSound==True:
-                chime.theme(conf.data.soundTheme)
-                chime.success()
+            # Hand over side effects, put it in try/except to avoid error for missing network access
+            event = {'pullupCounts': pullupCounts, 'pullupTimeFirst': pullupTimeFirst, 'pullupTimeLast': pullupTimeLast, 'repEvent': repEvent, 'resetGeneration': resetGeneration}
+            if stream is not None:
+                event.update({'streamName': stream.name, 'statePersistence': stream.statePersistence, 'sonosRoom': stream.sonosRoom})
+            # Every pullup is recorded, also when events are coalesced by the dispatcher
+            if self.repHistory is not None:
+                self.repHistory.append(event)
+            if self.eventDispatcher is not None:
+                self.eventDispatcher.submit(event)
+            else:
+                try:
+                    self.writePullupFiles(event)
+                    self.publishPullupEvent(event)
+                    self.playPullupSonos(event)
+                except Exception as e:
+                    print('Failed to play sound on SONOS')
+                    print(e)
+                self.playPullupChime(event)
             beenUp = True
             beenDown = False
 
@@ -284,20 +445,71 @@ class supportMethodsClass:
         return pullupCounts, beenUp, beenDown
     
 
-    def deleteVideoWhenNeeded(self, videoFilePath): 
-        """
-        Video file created from annotated stream should not be too big, make sure it is deleted with regular intervals. 
-        Get seconds of current time and delete video file if it is 0 or 1 seconds
-        This decreases the reading of the file size from every frame to twice every minute only
-        """
-        now = time.localtime()
-        # Check if it is 0 or 1 seconds
-        if (now.tm_sec == 0 or now.tm_sec == 1):
-            # Check if video exist
-            if os.path.exists(videoFilePath):
-                # Get the size of the video file
-                videoFileSize = os.path.getsize(videoFilePath)
-                # If the file is bigger than 1000 MB, delete it
-                if (videoFileSize > conf.data.maxVideoFileSize):
-                    os.remove(videoFilePath)
-            
+    def closeVideoRecorder(self):
+        """
+        This function writes the remaining annotated frames and closes the recorder if started
+        """
+        if self.videoRecorder is not None:
+            self.videoRecorder.stop()
+            print('Annotated video frames: ' + str(self.videoRecorder.counters))
+            self.videoRecorder = None
+
+
+    def markVideoRep(self, timestamp=None):
+        """
+        This function records the window around a counted pullup when only pullups are recorded
+        """
+        if self.videoRecorder is not None:
+            self.videoRecorder.markRep(timestamp)
+
+
+    def saveAnnotatedFrame(self, r, frameIndex, pose, frame, offset=(0, 0), fullShape=None, frameTime=None):
+        """
+        This function saves, shows and writes keypoints for an inferred frame as configured.
+        Replaces the saving done by YOLO when it was reading the stream itself.
+        If only a region of the frame was inferred, the annotated region is put back in the full frame.
+        With inference worker processes r and frame are None and only keypoints are saved.
+
+        r: ultralytics Results
+            Pose estimation result of the frame or region
+        frameIndex: int
+            Index of the frame in the stream, used for the keypoint txt file name
+        pose: dict
+            Full frame pose from getFullFramePose
+        frame: numpy array
+            Full frame
+        offset: tuple
+            Pixel position (x, y) of the inferred region in the full frame
+        fullShape: tuple
+            Shape of the full frame, taken from frame if not given
+        frameTime: float
+            Time the frame was decoded, used for the video segments
+        """
+        if not (conf.data.saveStream or conf.data.showStream or conf.data.saveTxt):
+            return
+        if fullShape is None:
+            fullShape = frame.shape
+        if conf.data.saveTxt:
+            # Same file naming as YOLO uses for streams, one txt file per frame
+            labelsFolderPath = os.path.join(conf.base.streamSaveFolderPath, 'labels')
+            os.makedirs(labelsFolderPath, exist_ok=True)
+            videoName = os.path.splitext(conf.base.streamSaveFileName)[0]
+            writeKeypointTxt(os.path.join(labelsFolderPath, videoName + '_' + str(frameIndex) + '.txt'), pose, fullShape, conf.data.saveConf)
+        if not (conf.data.saveStream or conf.data.showStream) or r is None:
+            return
+        # Draw keypoints, labels, confidence and boxes on the frame
+        annotatedFrame = r.plot(labels=True, conf=True, boxes=True)
+        if annotatedFrame.shape != frame.shape:
+            annotatedRegion = annotatedFrame
+            annotatedFrame = frame.copy()
+            annotatedFrame[offset[1]:offset[1] + annotatedRegion.shape[0], offset[0]:offset[0] + annotatedRegion.shape[1]] = annotatedRegion
+        if conf.data.saveStream:
+            if self.videoRecorder is None:
+                self.videoRecorder = videoRecorderClass()
+                self.videoRecorder.start()
+                metricsRegistry.registerCollector('videoRecorder', lambda: self.videoRecorder.counters if self.videoRecorder is not None else {})
+            # Encoded on the recorder thread, the annotated frame is not used here afterwards
+            self.videoRecorder.write(annotatedFrame, frameTime)
+        if conf.data.showStream:
+            cv2.imshow('pullupCounter', annotatedFrame)
+            cv2.waitKey(1)
@@ -0,0 +1,253 @@
+# *********************************************************************************
+# Author: Christian Jamtheim Gustafsson, PhD, Medical Physcist Expert
+# Description: Recorder of the annotated stream.
+# Frames are encoded on a background thread into fixed length segment files.
+# Inference runs at a varying rate, so frames are placed on a fixed frame rate by
+# their time stamps: gaps repeat the last frame and frames ahead of time are skipped.
+# The oldest segments are deleted when the total size is over the disk budget.
+# Optionally only a window around each counted pullup is recorded.
+# *********************************************************************************
+import os
+import threading
+import time
+from collections import deque
+import cv2
+# Load modules
+from commonConfig import commonConfigClass
+conf = commonConfigClass()
+
+
+class videoRecorderClass:
+    """
+    Class describing the segment rotated video recorder.
+    Frames are handed over without blocking, they are dropped if the encoder can not keep up.
+    """
+
+    def __init__ (self, folderPath=None, segmentSeconds=None, maxBytes=None, repWindowOnly=None, fps=None):
+        """
+        Init function
+
+        folderPath: string
+            Folder for the segment files
+        segmentSeconds: float
+            Length in seconds of each segment file
+        maxBytes: int
+            Total size in bytes of all segment files
+        repWindowOnly: bool
+            Only record frames around counted pullups
+        fps: float
+            Frame rate of the segment files, frames are repeated or skipped to keep real time playback
+        """
+        # Use configuration if not set
+        self.folderPath = conf.base.streamSaveFolderPath if folderPath is None else folderPath
+        self.segmentSeconds = conf.data.videoSegmentSeconds if segmentSeconds is None else segmentSeconds
+        self.maxBytes = conf.data.videoMaxBytes if maxBytes is None else maxBytes
+        self.repWindowOnly = conf.data.videoRepWindowOnly if repWindowOnly is None else repWindowOnly
+        self.fps = 1.0 / conf.data.schedulerNormalInterval if fps is None else fps
+        # Segment files are named after the configured video file name and the start time
+        self.videoName, self.videoExtension = os.path.splitext(conf.base.streamSaveFileName)
+        # Frames waiting for the encoder
+        self.queue = deque()
+        self.condition = threading.Condition()
+        # Frames kept before a pullup and time until frames are recorded after it, rep window mode only
+        self.preFrames = deque()
+        self.recordUntil = 0.0
+        self.running = False
+        self.thread = None
+        # Writer, start and last frame time, frames written and last frame of the current segment, only used by the encoder thread
+        self.writer = None
+        self.segmentFilePath = None
+        self.segmentStart = None
+        self.segmentLastTime = None
+        self.segmentShape = None
+        self.segmentFrames = 0
+        self.lastFrame = None
+        self.counters = {'written': 0, 'repeated': 0, 'skipped': 0, 'dropped': 0, 'segments': 0, 'deleted': 0}
+
+
+    def start(self):
+        """
+        This function starts the encoder thread and applies the disk budget to segments of earlier runs
+        """
+        if self.running:
+            return
+        os.makedirs(self.folderPath, exist_ok=True)
+        self.deleteOldSegments()
+        self.running = True
+        self.thread = threading.Thread(target=self.worker, name='pullupVideoRecorder', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """
+        This function stops the encoder thread after the waiting frames are written and closes the segment
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(10.0)
+            self.thread = None
+        self.closeSegment()
+
+
+    def write(self, frame, frameTime=None):
+        """
+        This function hands over an annotated frame to the encoder without blocking.
+        The frame must not be changed by the caller afterwards.
+
+        frame: numpy array
+            Annotated frame
+        frameTime: float
+            Time the frame was decoded, current time if not given
+        """
+        if frameTime is None:
+            frameTime = time.time()
+        with self.condition:
+            if self.repWindowOnly and frameTime > self.recordUntil:
+                # Keep the frames before a possible pullup, older ones are never recorded
+                self.preFrames.append((frameTime, frame))
+                while self.preFrames and self.preFrames[0][0] < frameTime - conf.data.videoRepPreSeconds:
+                    self.preFrames.popleft()
+                return
+            self.enqueue(frameTime, frame)
+
+
+    def enqueue(self, frameTime, frame):
+        """
+        This function puts a frame on the encoder queue, dropping it if the queue is full. Called with the condition held.
+        """
+        if len(self.queue) >= conf.data.videoQueueSize:
+            self.counters['dropped'] += 1
+            return
+        self.queue.append((frameTime, frame))
+        self.condition.notify()
+
+
+    def markRep(self, timestamp=None):
+        """
+        This function records the window around a counted pullup in rep window mode.
+        Frames kept before the pullup are written and frames are recorded for a while after it.
+
+        timestamp: float
+            Time of the pullup, current time if not given
+        """
+        if not self.repWindowOnly:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        with self.condition:
+            while self.preFrames:
+                frameTime, frame = self.preFrames.popleft()
+                self.enqueue(frameTime, frame)
+            self.recordUntil = max(self.recordUntil, timestamp + conf.data.videoRepPostSeconds)
+
+
+    def listSegments(self):
+        """
+        This function returns the segment file paths, oldest first
+        """
+        if not os.path.isdir(self.folderPath):
+            return []
+        fileNames = [fileName for fileName in os.listdir(self.folderPath)
+                     if fileName.startswith(self.videoName + '_') and fileName.endswith(self.videoExtension)]
+        # Start time in the file name sorts in time order
+        return [os.path.join(self.folderPath, fileName) for fileName in sorted(fileNames)]
+
+
+    def deleteOldSegments(self):
+        """
+        This function deletes the oldest segments until the total size is within the disk budget.
+        The segment being written is never deleted.
+        """
+        segmentFilePaths = [filePath for filePath in self.listSegments() if filePath != self.segmentFilePath]
+        sizes = {filePath: os.path.getsize(filePath) for filePath in segmentFilePaths}
+        totalBytes = sum(sizes.values())
+        if self.segmentFilePath is not None and os.path.exists(self.segmentFilePath):
+            totalBytes += os.path.getsize(self.segmentFilePath)
+        for filePath in segmentFilePaths:
+            if totalBytes <= self.maxBytes:
+                break
+            os.remove(filePath)
+            totalBytes -= sizes[filePath]
+            self.counters['deleted'] += 1
+
+
+    def openSegment(self, frameTime, frame):
+        """
+        This function opens a new segment file starting at the time of the frame.
+        Milliseconds are part of the name so segments started within the same second do not overwrite each other.
+        """
+        fileTime = frameTime
+        while True:
+            timeString = time.strftime('%Y%m%d_%H%M%S', time.localtime(fileTime)) + '_' + '{:03d}'.format(int(fileTime * 1000) % 1000)
+            self.segmentFilePath = os.path.join(self.folderPath, self.videoName + '_' + timeString + self.videoExtension)
+            if not os.path.exists(self.segmentFilePath):
+                break
+            fileTime += 0.001
+        frameHeight, frameWidth = frame.shape[:2]
+        self.writer = cv2.VideoWriter(self.segmentFilePath, cv2.VideoWriter_fourcc(*'MJPG'), self.fps, (frameWidth, frameHeight))
+        self.segmentStart = frameTime
+        self.segmentShape = frame.shape
+        self.segmentFrames = 0
+        self.lastFrame = None
+        self.counters['segments'] += 1
+
+
+    def writeFrame(self, frameTime, frame):
+        """
+        This function writes a frame at the position of its time stamp in the segment.
+        The gap since the last frame is filled by repeating it, a frame whose position is already written is skipped.
+        """
+        framePosition = int(round((frameTime - self.segmentStart) * self.fps))
+        if framePosition < self.segmentFrames:
+            self.counters['skipped'] += 1
+            return
+        while self.lastFrame is not None and self.segmentFrames < framePosition:
+            self.writer.write(self.lastFrame)
+            self.segmentFrames += 1
+            self.counters['repeated'] += 1
+        self.writer.write(frame)
+        self.segmentFrames = framePosition + 1
+        self.lastFrame = frame
+        self.counters['written'] += 1
+
+
+    def closeSegment(self):
+        """
+        This function closes the current segment file and applies the disk budget
+        """
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+        self.segmentFilePath = None
+        self.lastFrame = None
+        self.deleteOldSegments()
+
+
+    def worker(self):
+        """
+        This function encodes frames from the queue until stopped.
+        A new segment is started when the segment length is reached, the frame size changes,
+        frames stop for longer than data.videoMaxGapSeconds or, in rep window mode, when there is a gap between recorded windows.
+        """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or not self.running)
+                if not self.queue:
+                    break
+                frameTime, frame = self.queue.popleft()
+            try:
+                if self.writer is not None:
+                    segmentFull = frameTime - self.segmentStart >= self.segmentSeconds
+                    windowGap = self.repWindowOnly and frameTime - self.segmentLastTime > conf.data.videoRepPreSeconds + conf.data.videoRepPostSeconds
+                    longGap = frameTime - self.segmentLastTime > conf.data.videoMaxGapSeconds
+                    if segmentFull or windowGap or longGap or frame.shape != self.segmentShape:
+                        self.closeSegment()
+                if self.writer is None:
+                    self.openSegment(frameTime, frame)
+                self.writeFrame(frameTime, frame)
+                self.segmentLastTime = frameTime
+            except Exception as e:
+                print('Failed to write video frame')
+                print(e)